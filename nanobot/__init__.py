@@ -1 +1 @@
-from .run import run
+from .run import create_app, load_rows, run
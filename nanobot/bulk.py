@@ -0,0 +1,302 @@
+import csv
+import io
+import json
+import time
+
+from cmi_pb_script.load import insert_new_row, update_row
+from cmi_pb_script.validate import validate_row
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+
+class DeferredCommitConnection:
+    """Wrapper for a sqlite3 connection that ignores commits, so that the cmi_pb_script load
+    functions (which commit after every row) can run inside one transaction."""
+
+    def __init__(self, conn):
+        """
+        :param conn: sqlite3 connection to wrap
+        """
+        self.conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def commit(self):
+        pass
+
+
+def get_columns(conn, table_name: str) -> List[str]:
+    """Get the names of the columns of a table, excluding the row number.
+
+    :param conn: sqlite3 connection
+    :param table_name: table to get columns of
+    :return: list of column names
+    """
+    cur = conn.execute(f'PRAGMA table_info("{table_name}")')
+    return [res[1] for res in cur.fetchall() if res[1] != "row_number"]
+
+
+def get_row_messages(data: dict) -> Dict[str, list]:
+    """Extract messages from a validated row into a dictionary of messages.
+
+    :param data: validated row
+    :return: dict of message level -> list of messages at that level
+    """
+    messages = defaultdict(list)
+    for header, details in data.items():
+        if header == "row_number":
+            continue
+        for msg in details.get("messages") or []:
+            if msg["level"] in ["error", "warn", "info"]:
+                messages[msg["level"]].append(msg["message"])
+    return messages
+
+
+def get_row_values(row: dict) -> Dict[str, str]:
+    """Get the values of a row from the view of a table, as they were entered. An invalid value is
+    stored as NULL with the entered value in the meta column, so that value is used instead.
+
+    :param row: dict of column -> value, including meta columns
+    :return: dict of column -> value, excluding meta columns
+    """
+    values = {}
+    for column, value in row.items():
+        if column.endswith("_meta"):
+            continue
+        meta_row = row.get(column + "_meta")
+        if meta_row:
+            meta = json.loads(meta_row)
+            if meta.get("value"):
+                value = meta["value"]
+        values[column] = "" if value is None else value
+    return values
+
+
+def get_rows(conn, table_name: str, row_numbers: List[int]) -> Dict[int, Optional[dict]]:
+    """Get the current values of rows from the view of a table, excluding meta columns (see
+    get_row_values).
+
+    :param conn: sqlite3 connection
+    :param table_name: table to get rows of
+    :param row_numbers: row numbers to get
+    :return: dict of row number -> dict of column -> value
+    """
+    params = ", ".join(["?"] * len(row_numbers))
+    cur = conn.execute(
+        f'SELECT * FROM "{table_name}_view" WHERE row_number IN ({params})', row_numbers
+    )
+    columns = [d[0] for d in cur.description]
+    rows = {}
+    for res in cur.fetchall():
+        row = dict(zip(columns, res))
+        row_number = row.pop("row_number")
+        rows[row_number] = get_row_values(row)
+    return rows
+
+
+def get_text_value(value) -> str:
+    """Get a JSON value as the text of a cell: null is empty, and other values that are not
+    strings are written as JSON.
+
+    :param value: JSON value
+    :return: text value
+    """
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def import_rows(config: dict, table_name: str, rows: List[dict]) -> dict:
+    """Validate rows and insert them into a table in a single transaction. Rows with validation
+    errors are still inserted, as they are from the form, and their messages are reported. Rows
+    with columns that are not in the table are not inserted.
+
+    Each row is inserted before the next one is validated, so that unique and primary key
+    constraints are checked against the earlier rows of the same import.
+
+    :param config: CONFIG dict
+    :param table_name: table to insert rows into
+    :param rows: rows to insert - dicts of column -> value
+    :return: import results - counts, timing and per-row row numbers & messages
+    """
+    start = time.perf_counter()
+    results = []
+    with write_transaction(config):
+        columns = get_columns(config["db"], table_name)
+        for i, row in enumerate(rows):
+            unknown = [c for c in row.keys() if c not in columns]
+            if unknown:
+                results.append(
+                    {
+                        "row": i + 1,
+                        "row_number": None,
+                        "messages": {"error": [f"Unknown column(s): {', '.join(unknown)}"]},
+                    }
+                )
+                continue
+            validated_row = validate_row(config, table_name, row, existing_row=False)
+            row_number = insert_new_row(config, table_name, validated_row)
+            results.append(
+                {
+                    "row": i + 1,
+                    "row_number": row_number,
+                    "messages": dict(get_row_messages(validated_row)),
+                }
+            )
+    seconds = time.perf_counter() - start
+    inserted = len([r for r in results if r["row_number"] is not None])
+    return {
+        "table": table_name,
+        "inserted": inserted,
+        "errors": len([r for r in results if r["messages"].get("error")]),
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(inserted / seconds, 1) if seconds else None,
+        "results": results,
+    }
+
+
+def parse_rows(text: str, fmt: str) -> List[dict]:
+    """Parse rows from TSV text (with a header line) or a JSON array of objects.
+
+    :param text: rows to parse
+    :param fmt: format of text (tsv or json)
+    :return: list of dicts of column -> value
+    :raises ValueError: if the text cannot be parsed, or a TSV row does not have one value for each
+                        column of the header
+    """
+    fmt = fmt.lower()
+    if fmt == "tsv":
+        reader = csv.DictReader(io.StringIO(text), delimiter="\t", quoting=csv.QUOTE_NONE)
+        rows = []
+        for i, row in enumerate(reader):
+            # Extra values are put under None, and missing values are None
+            if None in row or None in row.values():
+                count = len([v for k, v in row.items() if k is not None and v is not None])
+                count += len(row.get(None) or [])
+                raise ValueError(
+                    f"Row {i + 1} (line {reader.line_num}) has {count} values, "
+                    f"but the header has {len(reader.fieldnames)} columns"
+                )
+            rows.append(dict(row))
+        return rows
+    if fmt == "json":
+        rows = json.loads(text)
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise ValueError("JSON rows must be an array of objects")
+        return [{k: get_text_value(v) for k, v in row.items()} for row in rows]
+    raise ValueError("Unknown import format: " + fmt)
+
+
+def replace_rows(config: dict, table_name: str, rows: List[dict]) -> dict:
+    """Replace all rows of a table (and its conflict table, if any) with new rows, validated and
+    inserted one at a time in a single transaction (see import_rows).
+
+    :param config: CONFIG dict
+    :param table_name: table to replace rows of
+    :param rows: new rows - dicts of column -> value
+    :return: import results (see import_rows)
+    """
+    with write_transaction(config):
+        conn = config["db"]
+        for t in [table_name, table_name + "_conflict"]:
+            res = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (t,)
+            ).fetchone()
+            if res:
+                conn.execute(f'DELETE FROM "{t}"')
+        return import_rows(config, table_name, rows)
+
+
+def to_result_row(data: dict) -> dict:
+    """Convert a row of values to the result row format expected by validate_row for existing rows.
+
+    :param data: dict of column -> value
+    :return: dict of column -> value, valid & messages
+    """
+    return {c: {"value": v, "valid": True, "messages": []} for c, v in data.items()}
+
+
+def update_rows(config: dict, table_name: str, patches: List[dict], batch_size: int = 500) -> dict:
+    """Apply patches to existing rows of a table. The patched rows are loaded with one query,
+    validated, and updated in a single transaction. Rows with validation errors are still updated,
+    as they are from the form, and their messages are reported.
+
+    :param config: CONFIG dict
+    :param table_name: table to update rows in
+    :param patches: list of patches - dicts with a "row_number" and a dict of column -> new value
+                    as "values" (several patches to the same row are applied in order)
+    :param batch_size: number of rows to load, validate & update at a time
+    :return: update results - counts, timing and per-row messages
+    """
+    start = time.perf_counter()
+    merged = {}  # type: Dict[int, dict]
+    for patch in patches:
+        row_number = int(patch["row_number"])
+        values = {k: get_text_value(v) for k, v in (patch.get("values") or {}).items()}
+        merged.setdefault(row_number, {}).update(values)
+
+    results = []
+    row_numbers = list(merged.keys())
+    with write_transaction(config):
+        conn = config["db"]
+        for i in range(0, len(row_numbers), batch_size):
+            batch = row_numbers[i : i + batch_size]
+            current = get_rows(conn, table_name, batch)
+            for row_number in batch:
+                result = {"row_number": row_number, "updated": False, "messages": {}}
+                results.append(result)
+                row = current.get(row_number)
+                if row is None:
+                    result["messages"] = {"error": [f"Row {row_number} does not exist"]}
+                    continue
+                unknown = [c for c in merged[row_number].keys() if c not in row]
+                if unknown:
+                    result["messages"] = {"error": [f"Unknown column(s): {', '.join(unknown)}"]}
+                    continue
+                row.update(merged[row_number])
+                validated_row = validate_row(
+                    config, table_name, to_result_row(row), row_number=row_number
+                )
+                update_row(config, table_name, validated_row, row_number)
+                result["updated"] = True
+                result["messages"] = dict(get_row_messages(validated_row))
+    seconds = time.perf_counter() - start
+    return {
+        "table": table_name,
+        "updated": len([r for r in results if r["updated"]]),
+        "errors": len([r for r in results if r["messages"].get("error")]),
+        "seconds": round(seconds, 3),
+        "results": results,
+    }
+
+
+@contextmanager
+def write_transaction(config: dict) -> Iterator[dict]:
+    """Run all writes made through config["db"] in a single transaction, which is committed when
+    the block exits and rolled back if the block raises an exception. The app runs its writes on
+    its WriteQueue, which already serializes them, so no lock is taken here.
+
+    :param config: CONFIG dict with the sqlite3 connection as "db"
+    :return: config, with "db" replaced while the transaction is open
+    """
+    conn = config["db"]
+    if isinstance(conn, DeferredCommitConnection):
+        # Already inside a transaction
+        yield config
+        return
+    if not conn.in_transaction:
+        conn.execute("BEGIN")
+    config["db"] = DeferredCommitConnection(conn)
+    try:
+        yield config
+    except Exception:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+    finally:
+        config["db"] = conn
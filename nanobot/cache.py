@@ -0,0 +1,382 @@
+import copy
+import gadget.sql as gs
+import hashlib
+import hmac
+import json
+import os
+import threading
+
+from collections import OrderedDict
+from sqlalchemy.engine import Connection
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from .catalog import get_data_version
+
+
+# Cached value for an ID or label that the database could not resolve
+MISSING = object()
+
+
+class LRUCache:
+    """Thread-safe mapping that holds at most maxsize entries (and, optionally, at most max_bytes of
+    values), evicting the least recently used entries when full."""
+
+    def __init__(
+        self,
+        maxsize: Optional[int] = 1024,
+        max_bytes: Optional[int] = None,
+        get_size: Callable[[Any], int] = None,
+    ):
+        """
+        :param maxsize: max number of entries to hold, or None for no limit
+        :param max_bytes: max total size of the values to hold, or None for no limit
+        :param get_size: function to get the size in bytes of a value (required with max_bytes)
+        """
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.get_size = get_size or (lambda value: 0)
+        self.entries = OrderedDict()  # type: OrderedDict
+        self.sizes = {}  # type: Dict[Hashable, int]
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def clear(self):
+        """Remove all entries."""
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.size = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get the value of an entry and mark it as recently used.
+
+        :param key: entry key
+        :param default: value to return if there is no entry for the key
+        :return: entry value or default
+        """
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key: Hashable, value: Any):
+        """Add or replace an entry, evicting the least recently used entries if the cache is full.
+
+        :param key: entry key
+        :param value: entry value
+        """
+        size = self.get_size(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            # Never hold a value that would evict everything else
+            return
+        with self.lock:
+            self.size += size - self.sizes.get(key, 0)
+            self.sizes[key] = size
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while (self.maxsize is not None and len(self.entries) > self.maxsize) or (
+                self.max_bytes is not None and self.size > self.max_bytes
+            ):
+                old_key, _ = self.entries.popitem(last=False)
+                self.size -= self.sizes.pop(old_key)
+
+
+class LabelCache:
+    """Memoizing layer over the gadget.sql label and ID lookups.
+
+    Entries are keyed by statement table and the database data version, so an entry loaded before a
+    write to the database is never served after it.
+    """
+
+    def __init__(self, conn: Connection, maxsize: int = 10000):
+        """
+        :param conn: database connection to resolve labels and IDs with
+        :param maxsize: max number of labels and IDs to hold
+        """
+        self.conn = conn
+        self.cache = LRUCache(maxsize=maxsize)
+        self.data_version = None  # type: Optional[int]
+        self.lock = threading.Lock()
+
+    def get_version(self) -> int:
+        """Get the current data version, dropping all entries if it has changed.
+
+        :return: data version
+        """
+        with self.lock:
+            data_version = get_data_version(self.conn)
+            if data_version != self.data_version:
+                # Stale entries can never be hit again, so free them now
+                self.cache.clear()
+                self.data_version = data_version
+            return data_version
+
+    def get_ids(self, table_name: str, id_or_labels: List[str]) -> List[str]:
+        """Resolve term IDs or labels to term IDs. Values that cannot be resolved are skipped.
+
+        :param table_name: ontology statement table
+        :param id_or_labels: term IDs or labels
+        :return: list of term IDs
+        """
+        version = self.get_version()
+        term_ids = []
+        for id_or_label in id_or_labels:
+            key = ("id", table_name, version, id_or_label)
+            cached = self.cache.get(key)
+            if cached is None:
+                # gadget.sql does not say which value each ID was resolved from, so misses are
+                # resolved one at a time
+                cached = gs.get_ids(self.conn, id_or_labels=[id_or_label], statement=table_name)
+                self.cache.put(key, cached)
+            term_ids.extend(cached)
+        return term_ids
+
+    def get_labels(self, table_name: str, term_ids: List[str]) -> Dict[str, str]:
+        """Get the labels of terms, querying the database once for all terms that are not cached.
+
+        :param table_name: ontology statement table
+        :param term_ids: term IDs to get labels of
+        :return: dict of term ID -> label
+        """
+        version = self.get_version()
+        labels = {}
+        missing = []
+        for term_id in term_ids:
+            cached = self.cache.get(("label", table_name, version, term_id))
+            if cached is None:
+                missing.append(term_id)
+            elif cached is not MISSING:
+                labels[term_id] = cached
+        if missing:
+            loaded = gs.get_labels(self.conn, missing, statement=table_name)
+            for term_id in missing:
+                label = loaded.get(term_id, MISSING)
+                self.cache.put(("label", table_name, version, term_id), label)
+                if label is not MISSING:
+                    labels[term_id] = label
+        return labels
+
+
+class RenderCache:
+    """Memory-bounded LRU cache of the rendered HTML cells of ontology terms.
+
+    Entries are keyed by statement table, URL root, term ID, the predicates of the term and the
+    database data version, so a term rendered before a write to the database is never served after
+    it.
+    """
+
+    def __init__(self, conn: Connection, max_bytes: int):
+        """
+        :param conn: database connection that terms are rendered from
+        :param max_bytes: max total size of the rendered HTML to hold
+        """
+        self.conn = conn
+        self.cache = LRUCache(maxsize=None, max_bytes=max_bytes, get_size=get_rendered_size)
+        self.data_version = None  # type: Optional[int]
+        self.lock = threading.Lock()
+
+    def get_version(self) -> int:
+        """Get the current data version, dropping all entries if it has changed.
+
+        :return: data version
+        """
+        with self.lock:
+            data_version = get_data_version(self.conn)
+            if data_version != self.data_version:
+                self.cache.clear()
+                self.data_version = data_version
+            return data_version
+
+    def get_many(
+        self, table_name: str, url_root: str, version: int, data: Dict[str, dict]
+    ) -> Tuple[Dict[str, dict], List[str]]:
+        """Get the rendered cells of terms.
+
+        :param table_name: ontology statement table
+        :param url_root: root of the URLs in the rendered HTML (the request script root)
+        :param version: data version that the term objects were loaded at (from get_version)
+        :param data: term objects to render - dict of term ID -> predicate ID -> list of objects
+        :return: dict of term ID -> predicate ID -> HTML for the cached terms, and the list of term
+                 IDs that still need to be rendered
+        """
+        rendered = {}
+        missing = []
+        for term_id, predicate_objects in data.items():
+            key = self._get_key(table_name, url_root, version, term_id, predicate_objects.keys())
+            cached = self.cache.get(key)
+            if cached is None:
+                missing.append(term_id)
+            else:
+                rendered[term_id] = cached
+        return rendered, missing
+
+    def put_many(
+        self,
+        table_name: str,
+        url_root: str,
+        version: int,
+        data: Dict[str, dict],
+        rendered: Dict[str, dict],
+    ):
+        """Add the rendered cells of terms.
+
+        :param table_name: ontology statement table
+        :param url_root: root of the URLs in the rendered HTML (the request script root)
+        :param version: data version that the term objects were loaded at (from get_version)
+        :param data: term objects that were rendered
+        :param rendered: dict of term ID -> predicate ID -> HTML
+        """
+        for term_id, rendered_term in rendered.items():
+            if term_id not in data:
+                continue
+            key = self._get_key(table_name, url_root, version, term_id, data[term_id].keys())
+            self.cache.put(key, rendered_term)
+
+    @staticmethod
+    def _get_key(
+        table_name: str, url_root: str, version: int, term_id: str, predicates: Iterable[str]
+    ) -> tuple:
+        return table_name, url_root, version, term_id, frozenset(predicates)
+
+
+def get_rendered_size(rendered_term: Dict[str, Optional[str]]) -> int:
+    """Get the approximate size in bytes of the rendered cells of a term.
+
+    :param rendered_term: dict of predicate ID -> HTML
+    :return: size in bytes
+    """
+    return sum(len(k) + len(v or "") for k, v in rendered_term.items())
+
+
+class ResponseCache:
+    """Memory-bounded LRU cache of full responses, with single-flight request coalescing.
+
+    When several requests for the same key arrive while the response is being built, only the first
+    builds it and the others wait for the result instead of building the same page again.
+    """
+
+    def __init__(self, max_bytes: int, timeout: float = 60):
+        """
+        :param max_bytes: max total size of the response bodies to hold
+        :param timeout: max seconds to wait for another request to build a response
+        """
+        self.cache = LRUCache(maxsize=None, max_bytes=max_bytes, get_size=lambda r: len(r[0]))
+        self.timeout = timeout
+        self.in_flight = {}  # type: Dict[Hashable, threading.Event]
+        self.lock = threading.Lock()
+
+    def begin(self, key: Hashable) -> Tuple[Optional[tuple], bool]:
+        """Get a cached response, waiting for it if another request is building it. If the response
+        is not cached and not being built, the caller must build it and call finish.
+
+        :param key: response key
+        :return: cached response (body, status, headers) or None, and True if the caller must
+                 build the response & call finish
+        """
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached, False
+            event = self.in_flight.get(key)
+            if not event:
+                self.in_flight[key] = threading.Event()
+                return None, True
+        event.wait(self.timeout)
+        # If the other request failed or timed out, the response is built without being cached
+        return self.cache.get(key), False
+
+    def finish(self, key: Hashable, cached: Optional[tuple] = None):
+        """Store a built response (if it can be cached) and wake up the requests waiting for it.
+
+        :param key: response key
+        :param cached: response (body, status, headers), or None if it cannot be cached
+        """
+        with self.lock:
+            if cached is not None:
+                self.cache.put(key, cached)
+            event = self.in_flight.pop(key, None)
+        if event:
+            event.set()
+
+
+class ValidationCache:
+    """Validated rows from the "validate" form action, stored under signed tokens so that a matching
+    "submit" can reuse them instead of validating the row again.
+
+    A token is an HMAC of the table, the row number, the exact submitted values and the database
+    version, so a submit only matches if nothing it depends on has changed.
+    """
+
+    def __init__(self, maxsize: int = 1000):
+        """
+        :param maxsize: max number of validated rows to hold
+        """
+        self.secret = os.urandom(32)
+        self.cache = LRUCache(maxsize=maxsize)
+
+    def get_token(
+        self, table_name: str, row_number: Optional[int], values: Dict[str, str], version: str
+    ) -> str:
+        """Get the token for a row.
+
+        :param table_name: table the row belongs to
+        :param row_number: row number of an existing row, or None for a new row
+        :param values: submitted values of the row
+        :param version: current database version
+        :return: token
+        """
+        content = json.dumps([table_name, row_number, values, version], sort_keys=True)
+        return hmac.new(self.secret, content.encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def issue(
+        self,
+        table_name: str,
+        row_number: Optional[int],
+        values: Dict[str, str],
+        version: str,
+        validated_row: dict,
+    ) -> str:
+        """Store a validated row and get its token.
+
+        :param table_name: table the row belongs to
+        :param row_number: row number of an existing row, or None for a new row
+        :param values: submitted values that were validated
+        :param version: database version the row was validated at
+        :param validated_row: result of validation
+        :return: token to include in the form
+        """
+        token = self.get_token(table_name, row_number, values, version)
+        self.cache.put(token, copy.deepcopy(validated_row))
+        return token
+
+    def redeem(
+        self,
+        token: Optional[str],
+        table_name: str,
+        row_number: Optional[int],
+        values: Dict[str, str],
+        version: str,
+    ) -> Optional[dict]:
+        """Get the stored validated row for a token, if the token matches the submitted values and
+        the current database version.
+
+        :param token: token from the submitted form
+        :param table_name: table the row belongs to
+        :param row_number: row number of an existing row, or None for a new row
+        :param values: submitted values
+        :param version: current database version
+        :return: validated row, or None if the row must be validated again
+        """
+        if not token:
+            return None
+        expected = self.get_token(table_name, row_number, values, version)
+        if not hmac.compare_digest(token, expected):
+            return None
+        validated_row = self.cache.get(token)
+        if validated_row is None:
+            return None
+        return copy.deepcopy(validated_row)
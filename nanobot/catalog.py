@@ -0,0 +1,410 @@
+import logging
+import os
+import sqlite3
+import threading
+
+from lark import Lark
+from lark.exceptions import LarkError
+from sprocket import get_sql_columns, get_sql_tables
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql.expression import text as sql_text
+from typing import Dict, List, Optional, Tuple
+
+
+# Tables that describe other tables - when these are edited, the catalog must be reloaded
+CONFIG_TABLES = ["column", "datatype", "table"]
+# Tables used by nanobot itself, which are never displayed (see sources & install_change_triggers)
+INTERNAL_TABLES = ["nanobot_config", "nanobot_database", "nanobot_source", "nanobot_table_version"]
+ONTOLOGY_COLUMNS = {"subject", "predicate", "object", "datatype", "annotation"}
+# Triggers that keep the change counters of a table - event, inserts & changes to count
+CHANGE_TRIGGERS = [("INSERT", 1, 0), ("UPDATE", 0, 1), ("DELETE", 0, 1)]
+LOGGER = logging.getLogger("cmi_pb_logger")
+
+
+def get_data_version(conn: Connection) -> int:
+    """Get the SQLite data version of a database connection. This value changes whenever another
+    connection commits changes to the database. For an immutable database, this is always 0.
+
+    :param conn: database connection
+    :return: data version
+    """
+    if getattr(conn, "immutable", False):
+        return 0
+    return conn.execute("PRAGMA data_version").fetchone()[0]
+
+
+def get_database_token(conn: Connection) -> Optional[str]:
+    """Get the random token of a database (see install_change_triggers), which tells a database
+    that was built again apart from the old one.
+
+    :param conn: database connection
+    :return: token, or None if the database has no token
+    """
+    res = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'nanobot_database'"
+    ).fetchone()
+    if not res:
+        return None
+    return conn.execute("SELECT token FROM nanobot_database").scalar()
+
+
+def get_schema_version(conn: Connection) -> int:
+    """Get the SQLite schema version of a database. This value changes whenever a table, view or
+    index is created, altered or dropped. For an immutable database, this is always 0.
+
+    :param conn: database connection
+    :return: schema version
+    """
+    if getattr(conn, "immutable", False):
+        return 0
+    return conn.execute("PRAGMA schema_version").fetchone()[0]
+
+
+def get_table_fingerprint(conn: Connection, table_name: str) -> Tuple[int, int, int]:
+    """Get a cheap fingerprint of the contents of a table, used to detect changes to a table after
+    the database data version changes. For an immutable database, this is only queried once.
+
+    The fingerprint is made of the change counters kept by the triggers on the table (see
+    install_change_triggers) and the schema version, so that recreating the table is a change too.
+    If the table has no triggers, the data version is used as its change counter, so that any
+    commit to the database counts as a change to the table.
+
+    :param conn: database connection
+    :param table_name: table to get fingerprint of
+    :return: schema version, number of rows inserted (-1 if the table has no triggers) and number
+             of rows updated or deleted
+    """
+    immutable = getattr(conn, "immutable", False)
+    if immutable and table_name in conn.fingerprints:
+        return conn.fingerprints[table_name]
+    schema_version = get_schema_version(conn)
+    res = conn.execute(
+        sql_text(
+            """SELECT COUNT(*) FROM sqlite_master
+            WHERE type = 'trigger' AND tbl_name = :table_name AND name LIKE 'nanobot_version_%'"""
+        ),
+        table_name=table_name,
+    ).fetchone()
+    if res[0] < len(CHANGE_TRIGGERS):
+        fingerprint = schema_version, -1, get_data_version(conn)
+    else:
+        res = conn.execute(
+            sql_text(
+                """SELECT inserts, changes FROM nanobot_table_version
+                WHERE table_name = :table_name"""
+            ),
+            table_name=table_name,
+        ).fetchone()
+        fingerprint = (schema_version, res[0], res[1]) if res else (schema_version, 0, 0)
+    if immutable:
+        conn.fingerprints[table_name] = fingerprint
+    return fingerprint
+
+
+def install_change_triggers(conn):
+    """Create the triggers that count the rows inserted, updated and deleted in every table in the
+    nanobot_table_version table. The triggers are part of the database, so they also count the
+    changes made by other processes and tools.
+
+    This also gives the database a random token in the nanobot_database table, so that the
+    versions of a database that was built again never match the versions of the old one.
+
+    :param conn: sqlite3 connection to write to
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS nanobot_database (token TEXT NOT NULL)")
+    conn.execute(
+        """INSERT INTO nanobot_database SELECT lower(hex(randomblob(8)))
+        WHERE NOT EXISTS (SELECT 1 FROM nanobot_database)"""
+    )
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS nanobot_table_version (
+            table_name TEXT PRIMARY KEY,
+            inserts INTEGER NOT NULL,
+            changes INTEGER NOT NULL
+        )"""
+    )
+    tables = [
+        r[0]
+        for r in conn.execute(
+            """SELECT name FROM sqlite_master
+            WHERE type = 'table' AND name NOT LIKE 'sqlite_%' AND sql NOT LIKE 'CREATE VIRTUAL%'"""
+        )
+        if r[0] not in INTERNAL_TABLES
+    ]
+    for table_name in tables:
+        name = table_name.replace('"', '""')
+        value = table_name.replace("'", "''")
+        for event, inserts, changes in CHANGE_TRIGGERS:
+            column = "inserts" if inserts else "changes"
+            try:
+                conn.execute(
+                    f"""CREATE TRIGGER IF NOT EXISTS "nanobot_version_{name}_{event}"
+                    AFTER {event} ON "{name}" BEGIN
+                        INSERT INTO nanobot_table_version VALUES ('{value}', {inserts}, {changes})
+                        ON CONFLICT (table_name) DO UPDATE SET {column} = {column} + 1;
+                    END"""
+                )
+            except sqlite3.Error:
+                # e.g. a shadow table of a virtual table - any commit counts as a change to it
+                break
+
+
+def unquote(value: str) -> str:
+    """Remove the quotes around a value of an 'in(...)' condition. Values that are not quoted
+    (e.g., numbers) are returned as they are.
+
+    :param value: value as it was parsed
+    :return: value without quotes
+    """
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in "'\"":
+        return value[1:-1]
+    return value
+
+
+class DatabaseVersion:
+    """Version of the database contents that is the same in every process serving the database,
+    made of the token of the database, its schema version and the sum of the change counters of
+    all tables (see install_change_triggers). Databases without change counters are versioned by
+    the size and modification time of the database & WAL files instead.
+
+    The version is only read again when the SQLite data version changes, i.e. after a commit by
+    any connection, so checking it costs one PRAGMA query.
+    """
+
+    def __init__(self, conn: Connection, path: str):
+        """
+        :param conn: database connection to get the version of
+        :param path: path to the database file
+        """
+        self.conn = conn
+        self.path = path
+        self.data_version = None  # type: Optional[int]
+        self.version = None  # type: Optional[str]
+        self.lock = threading.Lock()
+
+    def get(self) -> str:
+        """Get the current version.
+
+        :return: version string
+        """
+        with self.lock:
+            data_version = get_data_version(self.conn)
+            if self.version is None or data_version != self.data_version:
+                self.data_version = data_version
+                self.version = self._load()
+            return self.version
+
+    def _get_file_version(self) -> str:
+        parts = []
+        for path in [self.path, self.path + "-wal"]:
+            try:
+                st = os.stat(path)
+            except OSError:
+                parts.append("0-0-0")
+                continue
+            parts.append(f"{st.st_ino}-{st.st_size}-{st.st_mtime_ns}")
+        return "-".join(parts)
+
+    def _load(self) -> str:
+        res = self.conn.execute(
+            """SELECT COUNT(*) FROM sqlite_master
+            WHERE type = 'table' AND name IN ('nanobot_database', 'nanobot_table_version')"""
+        ).fetchone()
+        if res[0] < 2:
+            return self._get_file_version()
+        token = get_database_token(self.conn)
+        changes = self.conn.execute(
+            "SELECT COALESCE(SUM(inserts + changes), 0) FROM nanobot_table_version"
+        ).scalar()
+        return f"{token}-{get_schema_version(self.conn)}-{changes}"
+
+
+class DatatypeGraph:
+    """In-memory copy of the 'datatype' table hierarchy.
+
+    The ancestor closure, resolved HTML type and allowed values of every datatype are computed when
+    the graph is loaded, so that lookups never need to query the database.
+    """
+
+    def __init__(self, conn: Connection, parser: Optional[Lark] = None):
+        """
+        :param conn: database connection to load datatypes from
+        :param parser: parser for datatype conditions (CONFIG["parser"]), used to get the allowed
+                       values of 'in(...)' conditions
+        """
+        self.parents = {}  # type: Dict[str, Optional[str]]
+        self.html_types = {}  # type: Dict[str, Optional[str]]
+        self.values = {}  # type: Dict[str, Optional[list]]
+        results = conn.execute('SELECT datatype, parent, "HTML type", condition FROM datatype')
+        for res in results:
+            datatype = res["datatype"]
+            self.parents[datatype] = res["parent"]
+            self.html_types[datatype] = res["HTML type"]
+            condition = res["condition"]
+            if parser and condition and condition.startswith("in"):
+                # A malformed condition only loses the allowed values of its datatype
+                try:
+                    parsed = parser.parse(condition)[0]
+                    self.values[datatype] = [unquote(x["value"]) for x in parsed["args"]]
+                except (LarkError, IndexError, KeyError, TypeError) as e:
+                    LOGGER.error(f"Cannot parse condition of datatype '{datatype}': {e}")
+
+        self.ancestors = {dt: self._get_ancestors(dt) for dt in self.parents.keys()}
+        self.resolved = {dt: self._resolve_html_type(dt) for dt in self.parents.keys()}
+
+    def _get_ancestors(self, datatype: str) -> List[str]:
+        ancestors = [datatype]
+        parent = self.parents.get(datatype)
+        # Guard against cycles in the datatype table
+        while parent and parent not in ancestors:
+            ancestors.append(parent)
+            parent = self.parents.get(parent)
+        return ancestors
+
+    def _resolve_html_type(self, datatype: str) -> Tuple[Optional[str], Optional[list]]:
+        values = None
+        for dt in self._get_ancestors(datatype):
+            if dt not in self.parents:
+                break
+            if not values:
+                # The first values found (closest to the datatype) override any ancestor values
+                values = self.values.get(dt)
+            html_type = self.html_types[dt]
+            if html_type:
+                return html_type, values
+        return None, None
+
+    def get_ancestors(self, datatype: str) -> List[str]:
+        """Get all ancestor datatypes of a datatype.
+
+        :param datatype: datatype to get all ancestor datatypes of
+        :return: all ancestor datatypes of given datatype (inclusive of given datatype)
+        """
+        return self.ancestors.get(datatype, [datatype])
+
+    def get_html_type_and_values(
+        self, datatype: str, values: list = None
+    ) -> Tuple[Optional[str], Optional[list]]:
+        """Get the HTML form field type and, maybe, a list of allowed values for a datatype. If the
+        datatype does not have an HTML type, the first ancestor HTML type is used.
+
+        :param datatype: datatype to get HTML type and allowed values of
+        :param values: allowed values from column (overrides datatype values)
+        :return: tuple of HTML type and allowed values for given datatype
+        """
+        html_type, dt_values = self.resolved.get(datatype, (None, None))
+        if not html_type:
+            return None, None
+        return html_type, values or dt_values
+
+
+class SchemaCatalog:
+    """In-process cache of the table, column, ontology and primary key metadata of a database.
+
+    The catalog is loaded once and only reloaded when the SQLite schema version changes, so that
+    looking up table details costs a dictionary access instead of one or more queries.
+    """
+
+    def __init__(self, conn: Connection, parser: Optional[Lark] = None):
+        """
+        :param conn: database connection to load metadata from
+        :param parser: parser for datatype conditions (CONFIG["parser"])
+        """
+        self.conn = conn
+        self.parser = parser
+        self.datatypes = None  # type: Optional[DatatypeGraph]
+        self.schema_version = None  # type: Optional[int]
+        self.tables = []  # type: List[str]
+        self.columns = {}  # type: Dict[str, List[str]]
+        self.ontologies = []  # type: List[str]
+        self.primary_keys = {}  # type: Dict[str, str]
+        self.term_index = None  # type: Optional[str]
+        # Derived per-table details, filled in on demand & cleared when the catalog is reloaded
+        self.form_schemas = {}  # type: Dict[str, Dict[str, dict]]
+        self.link_patterns = {}  # type: Dict[str, Dict[str, str]]
+        self.transformations = {}  # type: Dict[Tuple[str, str], dict]
+        # Requests refresh the catalog from several threads - only one of them reloads it
+        self.lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self, force: bool = False) -> bool:
+        """Reload the catalog if the schema version of the database has changed since it was last
+        loaded.
+
+        :param force: if True, reload the catalog regardless of the schema version
+        :return: True if the catalog was reloaded
+        """
+        schema_version = get_schema_version(self.conn)
+        if not force and schema_version == self.schema_version:
+            return False
+        with self.lock:
+            if not force and schema_version == self.schema_version:
+                # Reloaded by another thread while this one waited
+                return False
+            self.load()
+            self.schema_version = schema_version
+        return True
+
+    def load(self):
+        """Load all metadata from the database. Everything is read before any attribute is
+        replaced, so that other threads see the old catalog until the new one is complete."""
+        tables = [t for t in get_sql_tables(self.conn) if t not in INTERNAL_TABLES]
+        columns = {t: get_sql_columns(self.conn, t) for t in tables}
+        ontologies = [t for t in tables if ONTOLOGY_COLUMNS.issubset(set(columns[t]))]
+
+        primary_keys = {}
+        if "column" in columns:
+            results = self.conn.execute(
+                """SELECT "table", "column" FROM "column"
+                WHERE "structure" LIKE '%%primary%%'"""
+            )
+            for res in results:
+                # Keep the first primary key, which is what a single-row lookup returned
+                if res["table"] not in primary_keys:
+                    primary_keys[res["table"]] = res["column"]
+
+        term_index = None
+        if "table" in columns:
+            res = self.conn.execute(
+                """SELECT "table" FROM "table" WHERE "type" = 'index'"""
+            ).fetchone()
+            if res:
+                term_index = res["table"]
+
+        datatypes = None
+        if "datatype" in columns:
+            datatypes = DatatypeGraph(self.conn, parser=self.parser)
+
+        self.tables = tables
+        self.columns = columns
+        self.ontologies = ontologies
+        self.primary_keys = primary_keys
+        self.term_index = term_index
+        self.datatypes = datatypes
+        self.form_schemas = {}
+        self.link_patterns = {}
+        self.transformations = {}
+
+    def get_columns(self, table_name: str) -> List[str]:
+        """Get the columns of a table.
+
+        :param table_name: table to get columns of
+        :return: list of column names, or an empty list if the table does not exist
+        """
+        return self.columns.get(table_name, [])
+
+    def get_primary_key(self, table_name: str) -> str:
+        """Get the primary key of a table. Otherwise, 'row_number' is used as the primary key.
+
+        :param table_name: table to get primary key of
+        :return: primary key or 'row_number'
+        """
+        return self.primary_keys.get(table_name, "row_number")
+
+    def is_ontology(self, table_name: str) -> bool:
+        """Check if a given table is an LDTab ontology statement table.
+
+        :param table_name: table to check
+        :return: True if table is an LDTab ontology statement table
+        """
+        return table_name in self.ontologies
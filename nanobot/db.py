@@ -0,0 +1,228 @@
+import queue
+import sqlite3
+import threading
+
+from concurrent.futures import Future
+from sqlalchemy.engine import Connection, Engine
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import quote
+
+from .bulk import DeferredCommitConnection
+
+
+# Statements whose results depend on the connection they run on (see SerializedConnection)
+CONNECTION_STATEMENTS = ["PRAGMA data_version"]
+# Seconds that a writer waits for the SQLite write lock held by another process
+WRITE_TIMEOUT = 30
+
+class BufferedResult:
+    """Result of a query whose rows were all fetched when it was run."""
+
+    def __init__(self, keys: List[str], rows: Optional[list], rowcount: int = -1):
+        """
+        :param keys: column names of the result
+        :param rows: result rows, or None if the statement does not return rows
+        :param rowcount: number of rows matched by the statement
+        """
+        self._keys = keys
+        self.returns_rows = rows is not None
+        self.rows = rows or []
+        self.rowcount = rowcount
+        self.position = 0
+
+    def __iter__(self):
+        while self.position < len(self.rows):
+            yield self.fetchone()
+
+    def close(self):
+        self.position = len(self.rows)
+
+    def fetchall(self) -> list:
+        rows = self.rows[self.position :]
+        self.position = len(self.rows)
+        return rows
+
+    def fetchmany(self, size: int = 1) -> list:
+        rows = self.rows[self.position : self.position + size]
+        self.position += len(rows)
+        return rows
+
+    def fetchone(self) -> Any:
+        if self.position >= len(self.rows):
+            return None
+        row = self.rows[self.position]
+        self.position += 1
+        return row
+
+    def first(self) -> Any:
+        row = self.fetchone()
+        self.close()
+        return row
+
+    def keys(self) -> List[str]:
+        return self._keys
+
+    def scalar(self) -> Any:
+        row = self.first()
+        return row[0] if row is not None else None
+
+
+def connect_reader(path: str, immutable: bool = False) -> sqlite3.Connection:
+    """Open a read-only connection to a database. In WAL mode, readers never wait on the writer.
+
+    :param path: absolute path to database
+    :param immutable: if True, tell SQLite that the database file never changes, so that no
+                      locking or change detection is done at all
+    :return: sqlite3 connection
+    """
+    uri = f"file:{quote(path)}?mode=ro"
+    if immutable:
+        uri += "&immutable=1"
+    return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+
+def connect_writer(path: str) -> sqlite3.Connection:
+    """Open the writer connection to a database and switch the database to WAL mode.
+
+    :param path: absolute path to database
+    :return: sqlite3 connection
+    """
+    # The timeout is the busy timeout: BEGIN IMMEDIATE waits this long for the writers of other
+    # processes to commit
+    conn = sqlite3.connect(path, timeout=WRITE_TIMEOUT, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # With WAL, NORMAL sync is safe against corruption and makes commits much cheaper
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class SerializedConnection:
+    """Wrapper for a SQLAlchemy connection that is shared by several threads. Statements are run
+    one at a time and their rows are fetched before the next statement runs, so results from
+    different threads never interleave on the connection.
+
+    This is used by the caches of an app, which must all check PRAGMA data_version on one
+    connection so that it is comparable between checks. Only these checks need the shared
+    connection: if an engine is provided, all other statements run on a connection from its pool,
+    so a cache that loads a large table does not hold up the reads of other threads. Request
+    handlers use their own connections (see state.get_request_conn).
+
+    When the database is immutable, the version checks of the caches are answered without
+    querying the database (see catalog.get_data_version).
+    """
+
+    def __init__(
+        self, conn: Connection, immutable: bool = False, engine: Optional[Engine] = None
+    ):
+        """
+        :param conn: connection to wrap
+        :param immutable: if True, the database never changes
+        :param engine: engine to run statements that do not need the shared connection on
+        """
+        self.conn = conn
+        self.engine = engine
+        self.immutable = immutable
+        # Table fingerprints of an immutable database, computed once
+        self.fingerprints = {}  # type: Dict[str, Tuple[int, int, int]]
+        self.lock = threading.RLock()
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def execute(self, *args, **kwargs) -> BufferedResult:
+        if self.engine is None or (args and args[0] in CONNECTION_STATEMENTS):
+            with self.lock:
+                return self._execute(self.conn, *args, **kwargs)
+        with self.engine.connect() as conn:
+            return self._execute(conn, *args, **kwargs)
+
+    @staticmethod
+    def _execute(conn: Connection, *args, **kwargs) -> BufferedResult:
+        result = conn.execute(*args, **kwargs)
+        if not result.returns_rows:
+            return BufferedResult([], None, rowcount=result.rowcount)
+        try:
+            return BufferedResult(list(result.keys()), result.fetchall())
+        finally:
+            result.close()
+
+
+class WriteQueue:
+    """Single writer for a database in one process. Writes from all threads are queued and run
+    one at a time on one dedicated connection, so they never contend for the SQLite write lock in
+    this process. Each worker process (see server.serve_prefork) has its own writer: the writers of
+    different processes take the write lock with BEGIN IMMEDIATE and wait up to WRITE_TIMEOUT
+    seconds for each other, so writes from all processes are still applied one at a time.
+
+    Writes that queue up while a transaction runs are committed together in the next transaction
+    (group commit), up to max_batch at a time. Each write runs in its own savepoint, so a write
+    that fails is rolled back without affecting the others in its group.
+    """
+
+    def __init__(self, config: dict, conn: sqlite3.Connection, max_batch: int = 100):
+        """
+        :param config: CONFIG dict - "db" is set to the writer connection for each write
+        :param conn: writer connection (see connect_writer)
+        :param max_batch: max number of writes to commit in one transaction
+        """
+        self.config = config
+        self.conn = conn
+        self.max_batch = max_batch
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="nanobot-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, write: Callable[[dict], Any]) -> Any:
+        """Run a write on the writer connection and wait until it is committed.
+
+        :param write: function that takes the CONFIG dict and writes through its "db" connection
+        :return: the return value of write
+        """
+        if threading.current_thread() is self.thread:
+            # A write submitted from another write joins its transaction
+            return write(self._get_config())
+        future = Future()
+        self.jobs.put((write, future))
+        return future.result()
+
+    def _get_config(self) -> dict:
+        config = dict(self.config)
+        config["db"] = DeferredCommitConnection(self.conn)
+        return config
+
+    def _run(self):
+        while True:
+            jobs = [self.jobs.get()]
+            while len(jobs) < self.max_batch:
+                try:
+                    jobs.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+            self._run_group(jobs)
+
+    def _run_group(self, jobs: List[tuple]):
+        config = self._get_config()
+        results = []
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            for write, future in jobs:
+                self.conn.execute("SAVEPOINT write")
+                try:
+                    result = write(config)
+                except Exception as e:
+                    self.conn.execute("ROLLBACK TO write")
+                    self.conn.execute("RELEASE write")
+                    results.append((future, None, e))
+                else:
+                    self.conn.execute("RELEASE write")
+                    results.append((future, result, None))
+            self.conn.commit()
+        except Exception as e:
+            if self.conn.in_transaction:
+                self.conn.rollback()
+            results = [(future, None, e) for _, future in jobs]
+        for future, result, exc in results:
+            if exc:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
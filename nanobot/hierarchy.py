@@ -0,0 +1,502 @@
+import sqlite3
+import threading
+
+from array import array
+from collections import defaultdict
+from sqlalchemy.engine import Connection
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .catalog import get_data_version, get_table_fingerprint
+
+
+# Guard against cycles in the class hierarchy when computing the closure
+MAX_DEPTH = 100
+
+
+class ClassHierarchy:
+    """In-memory class hierarchy of one ontology statement table, used to render the tree view
+    without querying the database.
+
+    CURIEs are interned as integer node IDs; parent and child lists are stored as integer arrays
+    (children sorted by label) alongside a list of labels. The hierarchy is loaded on first use and
+    reloaded when the statement table changes.
+    """
+
+    def __init__(self, conn: Connection, table_name: str):
+        """
+        :param conn: database connection to load statements from
+        :param table_name: ontology statement table
+        """
+        self.conn = conn
+        self.table_name = table_name
+        self.data_version = None  # type: Optional[int]
+        self.fingerprint = None  # type: Optional[Tuple[int, int, int]]
+        self.loaded = False
+        self.curies = []  # type: List[str]
+        self.ids = {}  # type: Dict[str, int]
+        self.labels = []  # type: List[Optional[str]]
+        self.parents = []  # type: List[array]
+        self.children = []  # type: List[array]
+        self.classes = set()  # type: Set[int]
+        self.top_level = array("I")
+        self.lock = threading.Lock()
+
+    def build(self):
+        """Load (or reload) the hierarchy from the statement table."""
+        curies = []
+        ids = {}
+
+        def intern(curie):
+            node_id = ids.get(curie)
+            if node_id is None:
+                node_id = len(curies)
+                ids[curie] = node_id
+                curies.append(curie)
+            return node_id
+
+        parents = defaultdict(set)
+        classes = set()
+        results = self.conn.execute(
+            f"""SELECT subject, object FROM "{self.table_name}"
+            WHERE predicate = 'rdfs:subClassOf' AND datatype = '_IRI'"""
+        )
+        for res in results:
+            child = intern(res["subject"])
+            parent = intern(res["object"])
+            classes.add(child)
+            classes.add(parent)
+            if child != parent:
+                parents[child].add(parent)
+        results = self.conn.execute(
+            f"""SELECT subject FROM "{self.table_name}"
+            WHERE predicate = 'rdf:type' AND object = 'owl:Class'"""
+        )
+        for res in results:
+            classes.add(intern(res["subject"]))
+        for curie in ["owl:Class", "owl:Thing"]:
+            classes.discard(ids.get(curie))
+
+        labels = [None] * len(curies)
+        results = self.conn.execute(
+            f"""SELECT subject, object FROM "{self.table_name}"
+            WHERE predicate = 'rdfs:label' AND subject NOT LIKE '<%%'"""
+        )
+        for res in results:
+            node_id = ids.get(res["subject"])
+            if node_id is not None and labels[node_id] is None:
+                labels[node_id] = res["object"]
+
+        def sort_key(node_id):
+            return (labels[node_id] or curies[node_id]).casefold(), curies[node_id]
+
+        children = defaultdict(list)
+        for child, child_parents in parents.items():
+            for parent in child_parents:
+                children[parent].append(child)
+        owl_thing = ids.get("owl:Thing")
+        top_level = [n for n in classes if not (parents.get(n, set()) - {owl_thing})]
+
+        self.curies = curies
+        self.ids = ids
+        self.labels = labels
+        self.parents = [array("I", sorted(parents.get(n, []), key=sort_key)) for n in range(len(curies))]
+        self.children = [
+            array("I", sorted(children.get(n, []), key=sort_key)) for n in range(len(curies))
+        ]
+        self.classes = classes
+        self.top_level = array("I", sorted(top_level, key=sort_key))
+        self.loaded = True
+
+    def refresh(self):
+        """Load the hierarchy if it has not been loaded, or reload it if the statement table has
+        changed since it was loaded."""
+        data_version = get_data_version(self.conn)
+        if self.loaded and data_version == self.data_version:
+            return
+        fingerprint = get_table_fingerprint(self.conn, self.table_name)
+        if not self.loaded or fingerprint != self.fingerprint:
+            self.build()
+        self.data_version = data_version
+        self.fingerprint = fingerprint
+
+    def is_class(self, term_id: str) -> bool:
+        """Check if a term is a class in the hierarchy.
+
+        :param term_id: term to check
+        :return: True if the term is a named class
+        """
+        with self.lock:
+            self.refresh()
+            return self.ids.get(term_id) in self.classes
+
+    def get_child_page(
+        self, term_id: str, offset: int = 0, limit: int = 20
+    ) -> Tuple[List[dict], int]:
+        """Get one page of the subclasses of a class, ordered by label, with the number of children
+        of each subclass. For 'owl:Class', the top-level classes are returned.
+
+        :param term_id: class to get subclasses of
+        :param offset: number of subclasses to skip
+        :param limit: max number of subclasses to return
+        :return: list of subclass details (id, label, child_count), and the total number of
+                 subclasses
+        """
+        with self.lock:
+            self.refresh()
+            if term_id == "owl:Class":
+                children = self.top_level
+            else:
+                node_id = self.ids.get(term_id)
+                if node_id is None:
+                    return [], 0
+                children = self.children[node_id]
+            return (
+                [
+                    {
+                        "id": self.curies[child],
+                        "label": self.labels[child],
+                        "child_count": len(self.children[child]),
+                    }
+                    for child in children[offset : offset + limit]
+                ],
+                len(children),
+            )
+
+    def get_label(self, term_id: str) -> str:
+        """Get the label of a term, or the term ID if it does not have a label.
+
+        :param term_id: term to get label of
+        :return: label
+        """
+        node_id = self.ids.get(term_id)
+        if node_id is None:
+            return term_id
+        return self.labels[node_id] or term_id
+
+    def _get_path(self, node_id: int) -> List[int]:
+        # Follow the first parent (by label) up to a top-level class
+        path = [node_id]
+        owl_thing = self.ids.get("owl:Thing")
+        while True:
+            parents = [p for p in self.parents[path[-1]] if p != owl_thing and p not in path]
+            if not parents:
+                break
+            path.append(parents[0])
+        path.reverse()
+        return path
+
+    def _get_item(self, node_id: int, href: str) -> list:
+        curie = self.curies[node_id]
+        return [
+            "a",
+            {
+                "resource": curie,
+                "rev": "rdfs:subClassOf",
+                "href": href.format(curie=curie),
+                "data-children": str(len(self.children[node_id])),
+            },
+            self.labels[node_id] or curie,
+        ]
+
+    def _get_children(
+        self, parent: str, children: Iterable[int], href: str, max_children: int
+    ) -> list:
+        # The rest of the children are loaded from the children route by the page script, in the
+        # same way as the children of expanded nodes
+        children = list(children)
+        element = ["ul", {"id": "children", "class": "children"}]
+        for child in children[:max_children]:
+            element.append(["li", self._get_item(child, href)])
+        if len(children) > max_children:
+            element.append(
+                [
+                    "li",
+                    [
+                        "a",
+                        {
+                            "href": "#",
+                            "class": "show-more",
+                            "data-parent": parent,
+                            "data-offset": str(max_children),
+                        },
+                        f"Show more ({len(children) - max_children} remaining)",
+                    ],
+                ]
+            )
+        return element
+
+    def get_tree(self, term_id: Optional[str], href: str, max_children: int = 20) -> list:
+        """Get the hierarchy for a term as a hiccup-style list: the path from the top level down to
+        the term, with the children of the term. If the term is None or 'owl:Class', the top-level
+        classes are shown.
+
+        :param term_id: term to get hierarchy for
+        :param href: link pattern for terms, with '{curie}' as the placeholder for the term ID
+        :param max_children: max number of children to display
+        :return: hiccup-style list
+        """
+        with self.lock:
+            self.refresh()
+            top = [
+                "a",
+                {"href": href.format(curie="owl:Class")},
+                "Class",
+            ]
+            node_id = self.ids.get(term_id) if term_id else None
+            if node_id is None or node_id not in self.classes:
+                return [
+                    "ul",
+                    {"id": "hierarchy", "class": "hierarchy multiple-children col-md"},
+                    [
+                        "li",
+                        top,
+                        self._get_children("owl:Class", self.top_level, href, max_children),
+                    ],
+                ]
+
+            path = self._get_path(node_id)
+            # Build the nested lists from the term back up to the top
+            element = [
+                "li",
+                ["strong", self.labels[node_id] or term_id],
+                self._get_children(term_id, self.children[node_id], href, max_children),
+            ]
+            for ancestor in reversed(path[:-1]):
+                element = ["li", self._get_item(ancestor, href), ["ul", element]]
+            return [
+                "ul",
+                {"id": "hierarchy", "class": "hierarchy multiple-children col-md"},
+                ["li", top, ["ul", element]],
+            ]
+
+
+class ClosureTable:
+    """Transitive closure of the rdfs:subClassOf hierarchy of one ontology statement table.
+
+    The closure is stored as (ancestor, descendant, depth) rows in an in-memory SQLite database, with
+    CURIEs interned as integers, so that descendant and ancestor lookups for any number of terms are
+    a single indexed query. Depth is the length of the shortest path between the two terms. When
+    statements are only appended to the statement table, the closure is updated with the new
+    subClassOf statements; any other change rebuilds it.
+    """
+
+    def __init__(self, conn: Connection, table_name: str):
+        """
+        :param conn: database connection to load statements from
+        :param table_name: ontology statement table
+        """
+        self.conn = conn
+        self.table_name = table_name
+        self.data_version = None  # type: Optional[int]
+        self.fingerprint = None  # type: Optional[Tuple[int, int, int]]
+        self.max_rowid = 0
+        self.store = None  # type: Optional[sqlite3.Connection]
+        self.lock = threading.Lock()
+
+    def _get_edges(self, min_rowid: int = 0) -> list:
+        results = self.conn.execute(
+            f"""SELECT subject, object FROM "{self.table_name}"
+            WHERE predicate = 'rdfs:subClassOf' AND datatype = '_IRI' AND rowid > :min_rowid""",
+            min_rowid=min_rowid,
+        )
+        return [(res["subject"], res["object"]) for res in results if res["subject"] != res["object"]]
+
+    def _get_max_rowid(self) -> int:
+        res = self.conn.execute(f'SELECT MAX(rowid) FROM "{self.table_name}"').fetchone()
+        return res[0] or 0
+
+    def build(self):
+        """Build (or rebuild) the closure from all subClassOf statements."""
+        store = sqlite3.connect(":memory:", check_same_thread=False)
+        store.executescript(
+            """CREATE TABLE node (id INTEGER PRIMARY KEY, curie TEXT UNIQUE NOT NULL);
+            CREATE TABLE edge (child INTEGER, parent INTEGER, PRIMARY KEY (child, parent))
+                WITHOUT ROWID;
+            CREATE INDEX edge_parent_idx ON edge(parent);
+            CREATE TABLE closure (
+                ancestor INTEGER,
+                descendant INTEGER,
+                depth INTEGER,
+                PRIMARY KEY (ancestor, descendant)
+            ) WITHOUT ROWID;"""
+        )
+        # Get the max rowid first - statements added while the edges are read are read again by
+        # the next update, which is harmless
+        max_rowid = self._get_max_rowid()
+        self._insert_edges(store, self._get_edges())
+        store.execute(
+            f"""INSERT INTO closure
+            WITH RECURSIVE walk(ancestor, descendant, depth) AS (
+                SELECT parent, child, 1 FROM edge
+                UNION
+                SELECT edge.parent, walk.descendant, walk.depth + 1
+                FROM edge JOIN walk ON edge.child = walk.ancestor
+                WHERE walk.depth < {MAX_DEPTH}
+            )
+            SELECT ancestor, descendant, MIN(depth) FROM walk
+            WHERE ancestor != descendant
+            GROUP BY ancestor, descendant"""
+        )
+        store.execute("CREATE INDEX closure_descendant_idx ON closure(descendant, ancestor)")
+        store.commit()
+
+        old_store = self.store
+        self.store = store
+        self.max_rowid = max_rowid
+        if old_store:
+            old_store.close()
+
+    def _insert_edges(self, store: sqlite3.Connection, edges: list) -> list:
+        curies = set()
+        for child, parent in edges:
+            curies.add(child)
+            curies.add(parent)
+        store.executemany("INSERT OR IGNORE INTO node (curie) VALUES (?)", [(c,) for c in curies])
+        ids = self._get_ids(store, curies)
+        id_edges = [(ids[child], ids[parent]) for child, parent in edges]
+        store.executemany("INSERT OR IGNORE INTO edge VALUES (?, ?)", id_edges)
+        return id_edges
+
+    def update(self):
+        """Add the subClassOf statements inserted since the closure was last built or updated."""
+        store = self.store
+        max_rowid = self._get_max_rowid()
+        for child, parent in self._insert_edges(store, self._get_edges(min_rowid=self.max_rowid)):
+            # Every ancestor of the parent (and the parent) gets every descendant of the child
+            # (and the child)
+            store.execute(
+                """INSERT INTO closure
+                SELECT a.ancestor, d.descendant, a.depth + 1 + d.depth
+                FROM (SELECT :parent AS ancestor, 0 AS depth
+                      UNION ALL
+                      SELECT ancestor, depth FROM closure WHERE descendant = :parent) a,
+                     (SELECT :child AS descendant, 0 AS depth
+                      UNION ALL
+                      SELECT descendant, depth FROM closure WHERE ancestor = :child) d
+                WHERE a.ancestor != d.descendant
+                ON CONFLICT (ancestor, descendant) DO UPDATE SET depth = MIN(depth, excluded.depth)""",
+                {"parent": parent, "child": child},
+            )
+        store.commit()
+        self.max_rowid = max_rowid
+
+    def refresh(self):
+        """Build the closure if it has not been built. Otherwise, if the statement table has changed
+        since the closure was built, update it with appended statements or rebuild it."""
+        data_version = get_data_version(self.conn)
+        if self.store and data_version == self.data_version:
+            return
+        fingerprint = get_table_fingerprint(self.conn, self.table_name)
+        if not self.store:
+            self.build()
+        elif fingerprint != self.fingerprint:
+            old_schema, old_inserts, old_changes = self.fingerprint
+            schema, inserts, changes = fingerprint
+            if schema == old_schema and changes == old_changes and inserts > old_inserts >= 0:
+                # Rows were only inserted
+                self.update()
+            else:
+                self.build()
+        self.data_version = data_version
+        self.fingerprint = fingerprint
+
+    @staticmethod
+    def _get_ids(store: sqlite3.Connection, curies: Iterable[str]) -> Dict[str, int]:
+        curies = list(curies)
+        ids = {}
+        # Stay under the SQLite variable limit
+        for i in range(0, len(curies), 500):
+            chunk = curies[i : i + 500]
+            params = ", ".join(["?"] * len(chunk))
+            for node_id, curie in store.execute(
+                f"SELECT id, curie FROM node WHERE curie IN ({params})", chunk
+            ):
+                ids[curie] = node_id
+        return ids
+
+    def _lookup(self, term_ids: Iterable[str], select: str, where: str, max_depth: int) -> Set[str]:
+        with self.lock:
+            self.refresh()
+            ids = list(self._get_ids(self.store, term_ids).values())
+            if not ids:
+                return set()
+            params = ", ".join(["?"] * len(ids))
+            query = f"""SELECT DISTINCT node.curie FROM closure
+                JOIN node ON node.id = closure.{select}
+                WHERE closure.{where} IN ({params})"""
+            args = ids
+            if max_depth:
+                query += " AND closure.depth <= ?"
+                args = ids + [max_depth]
+            return {res[0] for res in self.store.execute(query, args)}
+
+    def get_ancestors(self, term_ids: Iterable[str], max_depth: int = None) -> Set[str]:
+        """Get the ancestors of one or more terms.
+
+        :param term_ids: terms to get ancestors of
+        :param max_depth: if provided, only include ancestors up to this many levels up
+        :return: set of ancestor term IDs
+        """
+        return self._lookup(term_ids, "ancestor", "descendant", max_depth)
+
+    def get_descendants(self, term_ids: Iterable[str], max_depth: int = None) -> Set[str]:
+        """Get the descendants of one or more terms.
+
+        :param term_ids: terms to get descendants of
+        :param max_depth: if provided, only include descendants up to this many levels down (e.g.,
+                          1 for direct children)
+        :return: set of descendant term IDs
+        """
+        return self._lookup(term_ids, "descendant", "ancestor", max_depth)
+
+
+class ClassHierarchies:
+    """Lazily loaded class hierarchies for all ontology statement tables."""
+
+    def __init__(self, conn: Connection):
+        """
+        :param conn: database connection to load statements from
+        """
+        self.conn = conn
+        self.hierarchies = {}  # type: Dict[str, ClassHierarchy]
+        self.lock = threading.Lock()
+
+    def get(self, table_name: str) -> ClassHierarchy:
+        """Get the class hierarchy for an ontology statement table, creating it if needed. The
+        hierarchy itself is loaded on first use.
+
+        :param table_name: ontology statement table
+        :return: class hierarchy
+        """
+        with self.lock:
+            hierarchy = self.hierarchies.get(table_name)
+            if not hierarchy:
+                hierarchy = ClassHierarchy(self.conn, table_name)
+                self.hierarchies[table_name] = hierarchy
+            return hierarchy
+
+
+class ClosureTables:
+    """Lazily created closure tables for all ontology statement tables."""
+
+    def __init__(self, conn: Connection):
+        """
+        :param conn: database connection to load statements from
+        """
+        self.conn = conn
+        self.tables = {}  # type: Dict[str, ClosureTable]
+        self.lock = threading.Lock()
+
+    def get(self, table_name: str) -> ClosureTable:
+        """Get the closure table for an ontology statement table, creating it if needed. The
+        closure itself is built on the first lookup.
+
+        :param table_name: ontology statement table
+        :return: closure table
+        """
+        with self.lock:
+            closure = self.tables.get(table_name)
+            if not closure:
+                closure = ClosureTable(self.conn, table_name)
+                self.tables[table_name] = closure
+            return closure
@@ -0,0 +1,413 @@
+import gadget.sql as gs
+import json
+import threading
+
+from collections import OrderedDict
+from collections.abc import Sequence
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql.expression import text as sql_text
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from .catalog import get_data_version, get_table_fingerprint
+
+
+# Max number of orders of the terms of one table to keep (see OntologyMetadata.get_term_page)
+ORDERED_TERMS_SIZE = 4
+
+class OntologyMetadata:
+    """Metadata bundle for one ontology statement table: the ontology IRI and title, the prefix
+    map, the IDs and labels of all predicates used in the table, the number of terms, and the
+    ordered term IDs for the last few orders of table pages.
+
+    The bundle is loaded on first use and reloaded only when the statement table changes.
+    """
+
+    def __init__(self, conn: Connection, table_name: str):
+        """
+        :param conn: database connection to load metadata from
+        :param table_name: ontology statement table
+        """
+        self.conn = conn
+        self.table_name = table_name
+        self.data_version = None  # type: Optional[int]
+        self.fingerprint = None  # type: Optional[Tuple[int, int, int]]
+        self.loaded = False
+        self.iri = None  # type: Optional[str]
+        self.title = None  # type: Optional[str]
+        self.prefixes = {}  # type: Dict[str, str]
+        self.predicates = []  # type: List[str]
+        self.predicate_ids = set()  # type: Set[str]
+        self.predicate_labels = {}  # type: Dict[str, str]
+        self.label_to_predicate = {}  # type: Dict[str, str]
+        self.term_count = None  # type: Optional[int]
+        self.ordered_terms = OrderedDict()  # type: OrderedDict[str, List[str]]
+        self.lock = threading.Lock()
+        self.order_lock = threading.Lock()
+
+    def load(self):
+        """Load (or reload) the metadata from the database."""
+        iri = gs.get_ontology_iri(self.conn, statement=self.table_name)
+        prefixes = gs.get_prefixes(self.conn)
+        title = None
+        if iri:
+            title = gs.get_ontology_title(self.conn, prefixes, iri, statement=self.table_name)
+        predicates = gs.get_ids(self.conn, id_type="predicate", statement=self.table_name)
+        predicate_labels = gs.get_labels(self.conn, predicates, statement=self.table_name)
+
+        self.iri = iri
+        self.title = title
+        self.prefixes = prefixes
+        self.predicates = predicates
+        self.predicate_ids = set(predicates)
+        self.predicate_labels = predicate_labels
+        self.label_to_predicate = {v: k for k, v in predicate_labels.items() if v}
+        # Counted & ordered on first use, as only table pages need them
+        self.term_count = None
+        self.ordered_terms = OrderedDict()
+        self.loaded = True
+
+    def refresh(self):
+        """Load the metadata if it has not been loaded, or reload it if the statement table has
+        changed since it was loaded."""
+        with self.lock:
+            data_version = get_data_version(self.conn)
+            if self.loaded and data_version == self.data_version:
+                return
+            fingerprint = get_table_fingerprint(self.conn, self.table_name)
+            if not self.loaded or fingerprint != self.fingerprint:
+                self.load()
+            self.data_version = data_version
+            self.fingerprint = fingerprint
+
+    def get_predicate_labels(self, predicate_ids: List[str]) -> Dict[str, str]:
+        """Get the labels of predicates. Predicates that are not used in the table are looked up in
+        the database.
+
+        :param predicate_ids: predicate IDs to get labels of
+        :return: dict of predicate ID -> label
+        """
+        labels = {}
+        missing = []
+        for predicate_id in predicate_ids:
+            if predicate_id in self.predicate_labels:
+                labels[predicate_id] = self.predicate_labels[predicate_id]
+            elif predicate_id not in self.predicate_ids:
+                missing.append(predicate_id)
+        if missing:
+            labels.update(gs.get_labels(self.conn, missing, statement=self.table_name))
+        return labels
+
+    def get_predicate_ids(self, id_or_labels: List[str]) -> List[str]:
+        """Resolve predicate IDs or labels to predicate IDs. Values that are not the ID or label of
+        a predicate used in the table are skipped.
+
+        :param id_or_labels: predicate IDs or labels
+        :return: list of predicate IDs
+        """
+        predicate_ids = []
+        for id_or_label in id_or_labels:
+            if id_or_label in self.predicate_ids:
+                predicate_ids.append(id_or_label)
+            elif id_or_label in self.label_to_predicate:
+                predicate_ids.append(self.label_to_predicate[id_or_label])
+        return predicate_ids
+
+    def get_term_page(
+        self, order_by: list = None, offset: int = 0, limit: Optional[int] = 100
+    ) -> List[str]:
+        """Get one page of term IDs in the given order (see get_term_page). The IDs of all terms are
+        ordered in SQL once per order and change to the table, so paging through the table does not
+        sort the table again for each page.
+
+        :param order_by: parsed order-by entries, in order of precedence
+        :param offset: number of terms to skip
+        :param limit: max number of terms to return, or None for all terms
+        :return: list of term IDs
+        """
+        key = json.dumps(order_by or [], sort_keys=True)
+        # Requests for the same order wait for the first one instead of sorting the table again
+        with self.order_lock:
+            with self.lock:
+                term_ids = self.ordered_terms.get(key)
+                fingerprint = self.fingerprint
+            if term_ids is None:
+                term_ids = get_term_page(self.conn, self.table_name, order_by=order_by, limit=None)
+            with self.lock:
+                # Only keep the order if the table was not reloaded in the meantime
+                if self.fingerprint == fingerprint:
+                    self.ordered_terms[key] = term_ids
+                    self.ordered_terms.move_to_end(key)
+                    while len(self.ordered_terms) > ORDERED_TERMS_SIZE:
+                        self.ordered_terms.popitem(last=False)
+        if limit is None:
+            return term_ids[offset:]
+        return term_ids[offset : offset + limit]
+
+    def get_term_count(self) -> int:
+        """Get the number of named terms in the table (see count_terms), counted once per change to
+        the table.
+
+        :return: number of terms
+        """
+        with self.lock:
+            if self.term_count is None:
+                self.term_count = count_terms(self.conn, self.table_name)
+            return self.term_count
+
+
+class OntologyMetadataCache:
+    """Lazily loaded metadata bundles for all ontology statement tables."""
+
+    def __init__(self, conn: Connection):
+        """
+        :param conn: database connection to load metadata from
+        """
+        self.conn = conn
+        self.bundles = {}  # type: Dict[str, OntologyMetadata]
+        self.lock = threading.Lock()
+
+    def get(self, table_name: str) -> OntologyMetadata:
+        """Get the up-to-date metadata bundle for an ontology statement table.
+
+        :param table_name: ontology statement table
+        :return: metadata bundle
+        """
+        with self.lock:
+            bundle = self.bundles.get(table_name)
+            if not bundle:
+                bundle = OntologyMetadata(self.conn, table_name)
+                self.bundles[table_name] = bundle
+        bundle.refresh()
+        return bundle
+
+
+class TermPage(Sequence):
+    """A sequence of rendered term rows that only holds one page of rows in memory.
+
+    The length is the total number of rows, but only the rows of the page can be read: other
+    indexes raise IndexError, and iterating yields the rows of the page. This is what
+    render_html_table of ontodev-sprocket (the standalone-table branch in requirements.txt) needs,
+    as it uses the length for the total count and only reads the page with a slice of the offset
+    and limit request args.
+    """
+
+    def __init__(self, rows: list, offset: int, total: int):
+        """
+        :param rows: rows for the current page
+        :param offset: position of the first row of the page
+        :param total: total number of rows
+        """
+        self.rows = rows
+        self.offset = offset
+        self.total = max(total, offset + len(rows))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.total))]
+        if index < 0:
+            index += self.total
+        if index < 0 or index >= self.total:
+            raise IndexError("TermPage index out of range")
+        if not self.offset <= index < self.offset + len(self.rows):
+            raise IndexError(
+                f"TermPage index {index} is not on the page of rows "
+                f"{self.offset} to {self.offset + len(self.rows) - 1}"
+            )
+        return self.rows[index - self.offset]
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return self.total
+
+
+def count_terms(conn: Connection, table_name: str) -> int:
+    """Count the named terms (excluding full IRIs) in an ontology statement table.
+
+    :param conn: database connection
+    :param table_name: ontology statement table
+    :return: number of distinct subjects
+    """
+    res = conn.execute(
+        f"""SELECT COUNT(DISTINCT subject) FROM "{table_name}"
+        WHERE subject NOT LIKE '<%%'"""
+    ).fetchone()
+    return res[0]
+
+
+def get_child_page(
+    conn: Connection, table_name: str, term_id: str, offset: int = 0, limit: int = 20
+) -> Tuple[List[dict], int]:
+    """Get one page of the named subclasses of a class, ordered by label, with the number of
+    children of each subclass. For 'owl:Class', the top-level classes are returned.
+
+    :param conn: database connection
+    :param table_name: ontology statement table
+    :param term_id: class to get subclasses of
+    :param offset: number of subclasses to skip
+    :param limit: max number of subclasses to return
+    :return: list of subclass details (id, label, child_count), and the total number of subclasses
+    """
+    if term_id == "owl:Class":
+        children = f"""SELECT DISTINCT subject FROM "{table_name}"
+            WHERE predicate = 'rdf:type' AND object = 'owl:Class' AND subject NOT IN (
+                SELECT subject FROM "{table_name}"
+                WHERE predicate = 'rdfs:subClassOf' AND datatype = '_IRI'
+                  AND object != 'owl:Thing'
+            )"""
+    else:
+        children = f"""SELECT DISTINCT subject FROM "{table_name}"
+            WHERE predicate = 'rdfs:subClassOf' AND datatype = '_IRI' AND object = :term_id"""
+    total = conn.execute(
+        sql_text(f"SELECT COUNT(*) FROM ({children})"), term_id=term_id
+    ).fetchone()[0]
+    results = conn.execute(
+        sql_text(
+            f"""SELECT c.subject AS id, MIN(l.object) AS label, (
+                SELECT COUNT(DISTINCT g.subject) FROM "{table_name}" g
+                WHERE g.predicate = 'rdfs:subClassOf' AND g.datatype = '_IRI'
+                  AND g.object = c.subject
+            ) AS child_count
+            FROM ({children}) c
+            LEFT JOIN "{table_name}" l ON l.subject = c.subject AND l.predicate = 'rdfs:label'
+            GROUP BY c.subject
+            ORDER BY lower(COALESCE(label, c.subject)), c.subject
+            LIMIT :limit OFFSET :offset"""
+        ),
+        term_id=term_id,
+        limit=limit,
+        offset=offset,
+    )
+    return [dict(res) for res in results], total
+
+
+def get_term_page(
+    conn: Connection,
+    table_name: str,
+    order_by: list = None,
+    offset: int = 0,
+    limit: Optional[int] = 100,
+) -> List[str]:
+    """Get one page of term IDs from an ontology statement table, ordered in SQL.
+
+    Each order-by entry is a dict with a 'key' (either 'ID' or a predicate ID), an 'order' ('asc' or
+    'desc') and 'nulls' ('first' or 'last'), as returned by sprocket's parse_order_by. Terms are
+    ordered by the lowest object value for each predicate, then by ID.
+
+    :param conn: database connection
+    :param table_name: ontology statement table
+    :param order_by: parsed order-by entries, in order of precedence
+    :param offset: number of terms to skip
+    :param limit: max number of terms to return, or None for all terms
+    :return: list of term IDs
+    """
+    joins = []
+    order = []
+    params = {}
+    for i, ob in enumerate(order_by or []):
+        direction = "DESC" if ob.get("order") == "desc" else "ASC"
+        if ob["key"] == "ID":
+            # ID is never null
+            order.append(f"t.subject {direction}")
+            continue
+        alias = f"o{i}"
+        params[f"p{i}"] = ob["key"]
+        joins.append(
+            f"""LEFT JOIN (
+                SELECT subject, MIN(object) AS object FROM "{table_name}"
+                WHERE predicate = :p{i} AND datatype IS NOT '_JSON'
+                GROUP BY subject
+            ) {alias} ON {alias}.subject = t.subject"""
+        )
+        nulls = "DESC" if ob.get("nulls") == "first" else "ASC"
+        order.append(f"({alias}.object IS NULL) {nulls}")
+        order.append(f"{alias}.object {direction}")
+    order.append("t.subject ASC")
+
+    query = f"""SELECT t.subject FROM (
+            SELECT DISTINCT subject FROM "{table_name}" WHERE subject NOT LIKE '<%%'
+        ) t
+        {" ".join(joins)}
+        ORDER BY {", ".join(order)}"""
+    if limit is not None:
+        query += " LIMIT :limit OFFSET :offset"
+        params["limit"] = limit
+        params["offset"] = offset
+    elif offset:
+        query += " LIMIT -1 OFFSET :offset"
+        params["offset"] = offset
+    return [res["subject"] for res in conn.execute(sql_text(query), **params)]
+
+
+def iter_term_chunks(conn: Connection, table_name: str, chunk_size: int = 500) -> Iterator[list]:
+    """Iterate over all named terms (excluding full IRIs) of an ontology statement table in ID order,
+    in chunks. The term IDs are read from a single cursor, so only one chunk is held in memory.
+
+    :param conn: database connection
+    :param table_name: ontology statement table
+    :param chunk_size: number of term IDs per chunk
+    :return: iterator over lists of term IDs
+    """
+    results = conn.execute(
+        f"""SELECT DISTINCT subject FROM "{table_name}"
+        WHERE subject NOT LIKE '<%%'
+        ORDER BY subject"""
+    )
+    try:
+        while True:
+            chunk = results.fetchmany(chunk_size)
+            if not chunk:
+                break
+            yield [res["subject"] for res in chunk]
+    finally:
+        results.close()
+
+
+def order_terms(data: dict, predicate_ids: list, term_ids: list) -> dict:
+    """Put term data (as returned by gadget.sql.get_objects) in the order of the given term IDs.
+    Terms that have no data are included with an empty list for each predicate.
+
+    :param data: dict of term ID -> predicate ID -> list of objects
+    :param predicate_ids: predicates to include for terms that have no data
+    :param term_ids: ordered list of term IDs
+    :return: ordered dict of term ID -> predicate ID -> list of objects
+    """
+    ordered = {}
+    for term_id in term_ids:
+        term_data = data.get(term_id)
+        if term_data is None:
+            term_data = {p: [] for p in predicate_ids}
+        ordered[term_id] = term_data
+    return ordered
+
+
+def sort_terms(items: list, order_by: list, label_to_id: dict) -> List[Tuple[str, dict]]:
+    """Sort term data in Python. This is used for the bounded sets of terms from search results and
+    subclass queries; full table listings are ordered in SQL with get_term_page.
+
+    :param items: list of (term ID, predicate ID -> list of objects) pairs
+    :param order_by: parsed order-by entries, in order of precedence
+    :param label_to_id: map of predicate label -> predicate ID, used to resolve order-by keys
+    :return: sorted list of (term ID, term data) pairs
+    """
+    items = list(items)
+    # Apply the keys in reverse so that the first key takes precedence (sort is stable)
+    for ob in reversed(order_by):
+        reverse = ob["order"] == "desc"
+        if ob["key"] == "ID":
+            items.sort(key=lambda itm: itm[0], reverse=reverse)
+            continue
+
+        key = label_to_id.get(ob["key"], ob["key"])  # e.g., rdfs:label
+        # Separate out the items with no list entries for this predicate
+        nulls = [itm for itm in items if not itm[1].get(key)]
+        non_nulls = [itm for itm in items if itm[1].get(key)]
+        # Sort the items with entries for this predicate
+        non_nulls.sort(key=lambda itm: itm[1][key][0]["object"], reverse=reverse)
+        # ... then put the nulls in the correct spot
+        if ob["nulls"] == "first":
+            items = nulls + non_nulls
+        else:
+            items = non_nulls + nulls
+    return items
@@ -0,0 +1,414 @@
+import gadget.sql as gs
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql.expression import text as sql_text
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from .catalog import get_database_token, get_table_fingerprint
+
+
+# Number of statements to read at a time when hashing a statement table
+HASH_CHUNK_SIZE = 10000
+
+
+def clear_stored_trees(path: str):
+    """Drop all tree fragments from a render store, e.g. after the database was reconfigured.
+
+    :param path: path to the sidecar database
+    """
+    if not os.path.exists(path):
+        return
+    db = sqlite3.connect(path, timeout=30)
+    try:
+        with db:
+            db.execute("DELETE FROM tree_html")
+            db.execute("DELETE FROM table_stamp")
+            db.execute("DELETE FROM table_state")
+    except sqlite3.OperationalError:
+        # The tables have not been created yet
+        pass
+    finally:
+        db.close()
+
+
+def get_render_store_path(db: str) -> str:
+    """Get the path to the render store of a database, next to the database.
+
+    :param db: path to database
+    :return: path to the sidecar database
+    """
+    return os.path.splitext(os.path.abspath(db))[0] + ".render.db"
+
+
+def get_referenced_curies(value: Any) -> Iterator[str]:
+    """Get the CURIEs referenced by LDTab objects, including those nested in _JSON objects.
+
+    :param value: object, list of objects or nested JSON value
+    :return: iterator over CURIEs
+    """
+    if isinstance(value, list):
+        for v in value:
+            yield from get_referenced_curies(v)
+    elif isinstance(value, dict):
+        if value.get("datatype") == "_IRI" and isinstance(value.get("object"), str):
+            yield value["object"]
+        for v in value.values():
+            yield from get_referenced_curies(v)
+
+
+class RenderStore:
+    """Persistent cache of rendered term rows and tree fragments, kept in a sidecar SQLite database
+    next to the main database.
+
+    Each entry is stamped with a hash of what it was rendered from: for a term row, the statements
+    of the term and the labels of the terms it references; for a tree fragment, all statements of
+    the statement table. Entries are only served while their stamp matches, so the store survives
+    restarts and can be shared by any number of processes.
+
+    The hash of a statement table is stored with the fingerprint of the table it was computed at,
+    so each change to the table is only hashed once, by whichever process sees it first.
+    """
+
+    def __init__(self, path: str, conn: Connection, get_labels: Callable[[str, List[str]], dict]):
+        """
+        :param path: path to the sidecar database
+        :param conn: connection to the main database
+        :param get_labels: function that takes a statement table and a list of term IDs and
+                           returns a dict of term ID -> label
+        """
+        self.path = path
+        self.conn = conn
+        self.get_labels = get_labels
+        # Set whenever the main database is written to, to wake up the background rebuild
+        self.changed = threading.Event()
+        # Content hash of each statement table, with the fingerprint it was computed at
+        self.table_stamps = {}  # type: Dict[str, Tuple[str, str]]
+        # Set when a background thread runs rebuild, which then hashes tables for requests
+        self.background = False
+        self.local = threading.local()
+        self.connect()
+
+    def connect(self) -> sqlite3.Connection:
+        """Get the connection to the sidecar database for the current thread, creating the tables
+        if needed.
+
+        :return: sidecar database connection
+        """
+        db = getattr(self.local, "db", None)
+        if db:
+            return db
+        db = sqlite3.connect(self.path, timeout=30)
+        # WAL lets readers in other processes work while one process writes
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(
+            """CREATE TABLE IF NOT EXISTS term_html (
+                table_name TEXT,
+                url_root TEXT,
+                term_id TEXT,
+                predicates TEXT,
+                stamp TEXT,
+                html TEXT,
+                PRIMARY KEY (table_name, url_root, term_id, predicates)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS tree_html (
+                table_name TEXT,
+                url_root TEXT,
+                term_id TEXT,
+                variant TEXT,
+                stamp TEXT,
+                html TEXT,
+                PRIMARY KEY (table_name, url_root, term_id, variant)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS table_stamp (
+                table_name TEXT PRIMARY KEY,
+                fingerprint TEXT,
+                stamp TEXT
+            );
+            CREATE TABLE IF NOT EXISTS table_state (
+                table_name TEXT PRIMARY KEY,
+                fingerprint TEXT
+            );"""
+        )
+        self.local.db = db
+        return db
+
+    def get_table_stamp(self, table_name: str, compute: bool = True) -> Optional[str]:
+        """Get the stamp of a statement table, used for tree fragments: a hash of all statements.
+        The hash is only computed again when the fingerprint of the table changes, and is stored
+        in the sidecar database for other processes.
+
+        :param table_name: ontology statement table
+        :param compute: if False, return None instead of computing a hash that is out of date
+        :return: stamp
+        """
+        fingerprint = json.dumps(
+            [get_database_token(self.conn), get_table_fingerprint(self.conn, table_name)]
+        )
+        cached = self.table_stamps.get(table_name)
+        if cached and cached[0] == fingerprint:
+            return cached[1]
+        db = self.connect()
+        res = db.execute(
+            "SELECT stamp FROM table_stamp WHERE table_name = ? AND fingerprint = ?",
+            (table_name, fingerprint),
+        ).fetchone()
+        if res:
+            self.table_stamps[table_name] = (fingerprint, res[0])
+            return res[0]
+        if not compute:
+            return None
+        h = hashlib.sha1()
+        last_rowid = None
+        while True:
+            where = "WHERE rowid > :last_rowid" if last_rowid is not None else ""
+            rows = self.conn.execute(
+                sql_text(
+                    f"""SELECT rowid, * FROM "{table_name}" {where}
+                    ORDER BY rowid LIMIT {HASH_CHUNK_SIZE}"""
+                ),
+                last_rowid=last_rowid,
+            ).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                h.update(json.dumps(list(row)[1:], default=str).encode("utf-8"))
+            last_rowid = rows[-1][0]
+        stamp = h.hexdigest()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO table_stamp VALUES (?, ?, ?)",
+                (table_name, fingerprint, stamp),
+            )
+        self.table_stamps[table_name] = (fingerprint, stamp)
+        return stamp
+
+    def get_term_stamps(self, table_name: str, data: Dict[str, dict]) -> Dict[str, str]:
+        """Get the stamps of terms. The labels of all referenced terms are resolved at once.
+
+        :param table_name: ontology statement table
+        :param data: term objects - dict of term ID -> predicate ID -> list of objects
+        :return: dict of term ID -> stamp
+        """
+        curies = {term_id: set(get_referenced_curies(objs)) for term_id, objs in data.items()}
+        labels = self.get_labels(table_name, list(set().union(*curies.values())))
+        stamps = {}
+        for term_id, predicate_objects in data.items():
+            referenced = {c: labels.get(c) for c in curies[term_id]}
+            content = json.dumps([predicate_objects, referenced], sort_keys=True, default=str)
+            stamps[term_id] = hashlib.sha1(content.encode("utf-8")).hexdigest()
+        return stamps
+
+    def get_terms(
+        self, table_name: str, url_root: str, data: Dict[str, dict]
+    ) -> Tuple[Dict[str, dict], List[str]]:
+        """Get the rendered cells of terms whose stamps still match.
+
+        :param table_name: ontology statement table
+        :param url_root: root of the URLs in the rendered HTML (the request script root)
+        :param data: term objects to render - dict of term ID -> predicate ID -> list of objects
+        :return: dict of term ID -> predicate ID -> HTML for the stored terms, and the list of term
+                 IDs that still need to be rendered
+        """
+        if not data:
+            return {}, []
+        stamps = self.get_term_stamps(table_name, data)
+        db = self.connect()
+        rendered = {}
+        missing = []
+        for term_id, predicate_objects in data.items():
+            res = db.execute(
+                """SELECT html FROM term_html
+                WHERE table_name = ? AND url_root = ? AND term_id = ? AND predicates = ?
+                  AND stamp = ?""",
+                (
+                    table_name,
+                    url_root,
+                    term_id,
+                    self._get_predicates(predicate_objects),
+                    stamps[term_id],
+                ),
+            ).fetchone()
+            if res:
+                rendered[term_id] = json.loads(res[0])
+            else:
+                missing.append(term_id)
+        return rendered, missing
+
+    def put_terms(
+        self,
+        table_name: str,
+        url_root: str,
+        data: Dict[str, dict],
+        rendered: Dict[str, dict],
+    ):
+        """Store the rendered cells of terms.
+
+        :param table_name: ontology statement table
+        :param url_root: root of the URLs in the rendered HTML (the request script root)
+        :param data: term objects that were rendered
+        :param rendered: dict of term ID -> predicate ID -> HTML
+        """
+        data = {term_id: data[term_id] for term_id in rendered.keys() if term_id in data}
+        stamps = self.get_term_stamps(table_name, data)
+        rows = [
+            (
+                table_name,
+                url_root,
+                term_id,
+                self._get_predicates(predicate_objects),
+                stamps[term_id],
+                json.dumps(rendered[term_id]),
+            )
+            for term_id, predicate_objects in data.items()
+        ]
+        db = self.connect()
+        with db:
+            db.executemany("INSERT OR REPLACE INTO term_html VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def get_tree(
+        self, table_name: str, url_root: str, term_id: str, variant: str
+    ) -> Tuple[Optional[str], Optional[str]]:
+        """Get a tree fragment if it was rendered from the current statement table. If no process
+        has hashed the current table yet and a background rebuild is running, the table is not
+        hashed here: no fragment is returned and the rebuild is woken up to hash it.
+
+        :param table_name: ontology statement table
+        :param url_root: root of the URLs in the rendered HTML (the request script root)
+        :param term_id: term the tree was rendered for ('' for the top level)
+        :param variant: tree options the fragment was rendered with
+        :return: HTML or None, and the current stamp of the table (None if it is not known yet)
+        """
+        stamp = self.get_table_stamp(table_name, compute=not self.background)
+        if not stamp:
+            self.changed.set()
+            return None, None
+        res = (
+            self.connect()
+            .execute(
+                """SELECT html FROM tree_html
+                WHERE table_name = ? AND url_root = ? AND term_id = ? AND variant = ?
+                  AND stamp = ?""",
+                (table_name, url_root, term_id, variant, stamp),
+            )
+            .fetchone()
+        )
+        return (res[0] if res else None), stamp
+
+    def put_tree(
+        self, table_name: str, url_root: str, term_id: str, variant: str, stamp: str, html: str
+    ):
+        """Store a tree fragment.
+
+        :param table_name: ontology statement table
+        :param url_root: root of the URLs in the rendered HTML (the request script root)
+        :param term_id: term the tree was rendered for ('' for the top level)
+        :param variant: tree options the fragment was rendered with
+        :param stamp: stamp of the table the fragment was rendered from (from get_tree)
+        :param html: rendered tree fragment
+        """
+        db = self.connect()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO tree_html VALUES (?, ?, ?, ?, ?, ?)",
+                (table_name, url_root, term_id, variant, stamp, html),
+            )
+
+    def rebuild(
+        self,
+        table_name: str,
+        variant: str,
+        render_terms: Callable[[str, str, Dict[str, dict]], Dict[str, dict]],
+        render_tree: Callable[[str, str, str], str],
+        chunk_size: int = 100,
+    ) -> int:
+        """Re-render the stored entries of a statement table that are out of date. Nothing is done
+        if the table has not changed since the last rebuild (by any process).
+
+        :param table_name: ontology statement table
+        :param variant: tree options of this process - tree fragments rendered with other options
+                        are dropped when out of date
+        :param render_terms: function that takes a URL root, a statement table and term objects
+                             and returns the rendered cells of each term
+        :param render_tree: function that takes a URL root, a statement table and a term ID and
+                            returns the rendered tree fragment
+        :param chunk_size: number of terms to check & re-render at a time
+        :return: number of entries re-rendered
+        """
+        db = self.connect()
+        stamp = self.get_table_stamp(table_name)
+        res = db.execute(
+            "SELECT fingerprint FROM table_state WHERE table_name = ?", (table_name,)
+        ).fetchone()
+        if res and res[0] == stamp:
+            return 0
+
+        count = 0
+        groups = db.execute(
+            "SELECT DISTINCT url_root, predicates FROM term_html WHERE table_name = ?",
+            (table_name,),
+        ).fetchall()
+        for url_root, predicates in groups:
+            stored = db.execute(
+                """SELECT term_id, stamp FROM term_html
+                WHERE table_name = ? AND url_root = ? AND predicates = ?""",
+                (table_name, url_root, predicates),
+            ).fetchall()
+            for i in range(0, len(stored), chunk_size):
+                chunk = dict(stored[i : i + chunk_size])
+                data = gs.get_objects(
+                    self.conn,
+                    json.loads(predicates),
+                    statement=table_name,
+                    term_ids=list(chunk.keys()),
+                )
+                # Terms that were removed or whose predicates changed get a new entry when viewed
+                removed = [
+                    t
+                    for t in chunk.keys()
+                    if t not in data or self._get_predicates(data[t]) != predicates
+                ]
+                if removed:
+                    with db:
+                        db.executemany(
+                            """DELETE FROM term_html WHERE table_name = ? AND url_root = ?
+                            AND term_id = ? AND predicates = ?""",
+                            [(table_name, url_root, t, predicates) for t in removed],
+                        )
+                data = {t: objs for t, objs in data.items() if t in chunk and t not in removed}
+                stamps = self.get_term_stamps(table_name, data)
+                stale = {t: objs for t, objs in data.items() if stamps[t] != chunk[t]}
+                if stale:
+                    rendered = render_terms(url_root, table_name, stale)
+                    self.put_terms(table_name, url_root, stale, rendered)
+                    count += len(stale)
+
+        trees = db.execute(
+            """SELECT url_root, term_id, variant FROM tree_html
+            WHERE table_name = ? AND stamp != ?""",
+            (table_name, stamp),
+        ).fetchall()
+        for url_root, term_id, tree_variant in trees:
+            if tree_variant != variant:
+                with db:
+                    db.execute(
+                        """DELETE FROM tree_html WHERE table_name = ? AND url_root = ?
+                        AND term_id = ? AND variant = ?""",
+                        (table_name, url_root, term_id, tree_variant),
+                    )
+                continue
+            html = render_tree(url_root, table_name, term_id)
+            self.put_tree(table_name, url_root, term_id, variant, stamp, html)
+            count += 1
+
+        with db:
+            db.execute("INSERT OR REPLACE INTO table_state VALUES (?, ?)", (table_name, stamp))
+        return count
+
+    @staticmethod
+    def _get_predicates(predicate_objects: Dict[str, list]) -> str:
+        return json.dumps(sorted(predicate_objects.keys()))
@@ -1,8 +1,14 @@
+import copy
+import csv
 import gadget.sql as gs
+import hashlib
+import io
 import json
 import logging
 import os
 import sqlite3
+import threading
+import time
 import traceback
 
 from collections import defaultdict
@@ -10,11 +16,15 @@ from collections import defaultdict
 from flask import (
     abort,
     Blueprint,
+    current_app,
     Flask,
+    g,
+    has_request_context,
     redirect,
     request,
     render_template,
     Response,
+    stream_with_context,
     url_for,
 )
 from gadget.export import dicts2tsv, terms2dicts
@@ -26,26 +36,67 @@ from itertools import chain
 from lark import Lark, UnexpectedCharacters
 from logging import Logger
 from sprocket import (
-    get_sql_columns,
-    get_sql_tables,
     parse_order_by,
     render_database_table,
     render_html_table,
     SprocketError,
 )
 from sprocket.grammar import PARSER, SprocketTransformer
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.engine import Connection
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.sql.expression import bindparam
 from sqlalchemy.sql.expression import text as sql_text
 from typing import Dict, Optional, Tuple, Union
-from urllib.parse import unquote
+from urllib.parse import unquote, urlencode
 from werkzeug.exceptions import HTTPException
+from werkzeug.local import LocalProxy
 
 from cmi_pb_script.cmi_pb_grammar import grammar, TreeToDict
 from cmi_pb_script.load import configure_db, insert_new_row, read_config_files, update_row
 from cmi_pb_script.validate import get_matching_values, validate_row
 
+from .bulk import (
+    get_row_messages,
+    get_row_values,
+    import_rows,
+    parse_rows,
+    replace_rows,
+    to_result_row,
+    update_rows,
+)
+from .cache import LabelCache, RenderCache, ResponseCache, ValidationCache
+from .catalog import CONFIG_TABLES, DatabaseVersion, install_change_triggers, SchemaCatalog
+from .db import connect_reader, connect_writer, SerializedConnection, WriteQueue
+from .hierarchy import ClassHierarchies, ClosureTables
+from .ontology import (
+    OntologyMetadataCache,
+    get_child_page,
+    iter_term_chunks,
+    order_terms,
+    sort_terms,
+    TermPage,
+)
+from .render_store import clear_stored_trees, get_render_store_path, RenderStore
+from .search_index import SearchIndexes
+from .sources import (
+    get_changed_sources,
+    get_referenced_tables,
+    get_source_fingerprints,
+    is_config_change,
+    load_config_state,
+    RELOAD_MAX_ROWS,
+    save_config_state,
+)
+from .server import serve_prefork
+from .state import (
+    AppState,
+    get_request_config,
+    get_request_conn,
+    release_request_handles,
+    state_proxy,
+)
+
 
 BUILTIN_LABELS = {
     "rdfs:subClassOf": "parent class",
@@ -60,7 +111,20 @@ BUILTIN_LABELS = {
     "owl:sameAs": "same individual",
     "owl:differentFrom": "different individual",
 }
-FORM_ROW_ID = 0
+# Max number of subclasses returned by one request to the children route
+CHILDREN_LIMIT = 500
+DEFAULT_FORM_FIELD = {
+    "allowed_values": None,
+    "description": None,
+    "html_type": "text",
+    "readonly": False,
+}
+# Seconds between checks of the persistent render store for writes by other processes
+RENDER_STORE_INTERVAL = 30
+# Max number of results for typeahead searches
+SEARCH_LIMIT = 30
+# GET routes that send an ETag & answer conditional requests
+VALIDATED_ENDPOINTS = ["cmi-pb.children", "cmi-pb.row", "cmi-pb.table", "cmi-pb.term"]
 LOGIC_PREDICATES = [
     "rdfs:subClassOf",
     "owl:equivalentClass",
@@ -76,27 +140,135 @@ BLUEPRINT = Blueprint(
     __name__,
     template_folder=os.path.abspath(os.path.join(os.path.dirname(__file__), "templates")),
 )
-CONFIG = None  # type: Optional[dict]
-CONN = None  # type: Optional[Connection]
-LOGGER = None  # type: Optional[Logger]
-
-OPTIONS = {
+# Each app keeps its connections & caches in its own AppState - these resolve to the state of the
+# current app (see create_app), and CONFIG & CONN to the database handles of the current request
+APP_TOKEN = state_proxy("app_token")  # type: str
+CATALOG = state_proxy("catalog")  # type: SchemaCatalog
+CLOSURE_TABLES = state_proxy("closure_tables")  # type: Optional[ClosureTables]
+HIERARCHIES = state_proxy("hierarchies")  # type: Optional[ClassHierarchies]
+CONFIG = LocalProxy(get_request_config)  # type: dict
+CONN = LocalProxy(get_request_conn)  # type: Connection
+LABELS = state_proxy("labels")  # type: LabelCache
+LOGGER = state_proxy("logger")  # type: Logger
+METADATA = state_proxy("metadata")  # type: OntologyMetadataCache
+OPTIONS = state_proxy("options")  # type: dict
+RENDER_CACHE = state_proxy("render_cache")  # type: Optional[RenderCache]
+RENDER_STORE = state_proxy("render_store")  # type: Optional[RenderStore]
+RESPONSE_CACHE = state_proxy("response_cache")  # type: Optional[ResponseCache]
+SEARCH_INDEXES = state_proxy("search_indexes")  # type: Optional[SearchIndexes]
+VALIDATIONS = state_proxy("validations")  # type: ValidationCache
+VERSION = state_proxy("version")  # type: DatabaseVersion
+WRITER = state_proxy("writer")  # type: WriteQueue
+
+DEFAULT_OPTIONS = {
     "base_ontology": None,
+    "change_counters": False,
+    "class_hierarchy": False,
     "default_params": {},
     "default_table": None,
     "hide_index": False,
     "import_table": None,
     "max_children": 20,
+    "readonly": False,
+    "search_index": False,
+    "subclass_closure": False,
     "synonym": "IAO:0000118",
     "title": "Terminology",
     "tree_predicates": None,
 }
 
 
+@BLUEPRINT.before_request
+def check_etag():
+    # Answer conditional requests before any other work is done for the request
+    if request.method != "GET" or request.endpoint not in VALIDATED_ENDPOINTS:
+        return None
+    g.etag = APP_TOKEN + "-" + VERSION.get()
+    if request.if_none_match.contains(g.etag):
+        response = Response(status=304)
+        response.set_etag(g.etag)
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+    return None
+
+
+@BLUEPRINT.before_request
+def get_cached_response():
+    # Serve popular pages from the response cache; concurrent requests for a page that is being
+    # built wait for it instead of building it again
+    if not RESPONSE_CACHE or not g.get("etag"):
+        return None
+    args = urlencode(sorted(request.args.items(multi=True)))
+    key = (request.script_root + request.path + "?" + args, g.etag)
+    cached, build = RESPONSE_CACHE.begin(key)
+    if build:
+        g.response_key = key
+    elif cached:
+        body, status, headers = cached
+        return Response(body, status=status, headers=headers)
+    return None
+
+
+@BLUEPRINT.before_request
+def refresh_catalog():
+    # Check the schema version once per request so that lookups in the request are O(1)
+    CATALOG.refresh()
+
+
+@BLUEPRINT.before_request
+def reject_writes():
+    # A read-only app never changes the database
+    if OPTIONS["readonly"] and request.method not in ["GET", "HEAD", "OPTIONS"]:
+        return abort(
+            405, valid_methods=["GET", "HEAD"], description="This nanobot instance is read-only"
+        )
+    return None
+
+
+@BLUEPRINT.after_request
+def add_etag(response):
+    # The ETag is the app token & the database version from before the page was built, so a write
+    # made while the page was built can only cause an extra download, never a stale page
+    if g.get("etag") and response.status_code == 200:
+        response.set_etag(g.etag)
+        response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+@BLUEPRINT.after_request
+def cache_response(response):
+    key = g.pop("response_key", None)
+    if key:
+        cached = None
+        if response.status_code == 200 and not response.is_streamed:
+            cached = (response.get_data(), response.status_code, list(response.headers.items()))
+        RESPONSE_CACHE.finish(key, cached)
+    return response
+
+
+@BLUEPRINT.after_request
+def report_query_count(response):
+    # In debug mode, report the number of queries run for each page so regressions are visible
+    if current_app.debug:
+        query_count = g.get("query_count", 0)
+        response.headers["X-Query-Count"] = str(query_count)
+        LOGGER.debug(f"{request.method} {request.full_path} ran {query_count} queries")
+    return response
+
+
+@BLUEPRINT.teardown_request
+def release_response(exc):
+    # Wake up any requests waiting for a response that failed to build
+    key = g.pop("response_key", None)
+    if key:
+        RESPONSE_CACHE.finish(key)
+
+
 @BLUEPRINT.errorhandler(Exception)
 def handle_exception(e):
     if isinstance(e, HTTPException):
         return e
+    # Errors are sent as 500s, so they are never cached or sent with an ETag
     return (
         render_template(
             "template.html",
@@ -105,7 +277,8 @@ def handle_exception(e):
             ontologies=get_display_ontologies(),
             html="<code>" + "<br>".join(traceback.format_exc().split("\n")),
         )
-        + "</code>"
+        + "</code>",
+        500,
     )
 
 
@@ -137,6 +310,82 @@ def row(table_name, row_number):
     return render_row_from_database(table_name, None, row_number)
 
 
+@BLUEPRINT.route("/<table_name>/import", methods=["POST"])
+def bulk_import(table_name):
+    # Validate & insert many rows from a TSV or JSON array in a single transaction
+    if table_name not in CATALOG.tables:
+        return abort(404, f"'{table_name}' is not a table")
+    if is_ontology(table_name):
+        return abort(400, f"Rows cannot be imported into ontology table '{table_name}'")
+    fmt = request.args.get("format")
+    if not fmt:
+        fmt = "json" if request.is_json else "tsv"
+    try:
+        rows = parse_rows(request.get_data(as_text=True), fmt)
+    except ValueError as e:
+        return abort(400, str(e))
+    result = WRITER.submit(lambda config: import_rows(config, table_name, rows))
+    record_write(table_name)
+    LOGGER.info(
+        f"Imported {result['inserted']} rows into '{table_name}' in {result['seconds']}s "
+        f"({result['rows_per_second']} rows/s)"
+    )
+    return Response(json.dumps(result), mimetype="application/json")
+
+
+@BLUEPRINT.route("/<table_name>/update", methods=["POST"])
+def bulk_update(table_name):
+    # Validate & apply patches to many existing rows in a single transaction
+    if table_name not in CATALOG.tables:
+        return abort(404, f"'{table_name}' is not a table")
+    if is_ontology(table_name):
+        return abort(400, f"Rows cannot be updated in ontology table '{table_name}'")
+    patches = request.get_json(silent=True)
+    if not isinstance(patches, list) or not all(
+        isinstance(p, dict) and "row_number" in p for p in patches
+    ):
+        return abort(400, "Patches must be a JSON array of objects with a 'row_number'")
+    result = WRITER.submit(lambda config: update_rows(config, table_name, patches))
+    record_write(table_name)
+    LOGGER.info(f"Updated {result['updated']} rows in '{table_name}' in {result['seconds']}s")
+    return Response(json.dumps(result), mimetype="application/json")
+
+
+@BLUEPRINT.route("/<table_name>/<term_id>/children")
+def children(table_name, term_id):
+    # One page of subclasses as JSON, used for lazy expansion in the tree view
+    if not is_ontology(table_name):
+        return abort(418, "Cannot get children for non-ontology table")
+    try:
+        offset = int(request.args.get("offset", "0"))
+        limit = int(request.args.get("limit", str(OPTIONS["max_children"])))
+    except ValueError:
+        return abort(400, "'offset' and 'limit' must be integers")
+    offset = max(offset, 0)
+    limit = min(max(limit, 1), CHILDREN_LIMIT)
+    if HIERARCHIES:
+        child_page, total = HIERARCHIES.get(table_name).get_child_page(
+            term_id, offset=offset, limit=limit
+        )
+    else:
+        child_page, total = get_child_page(CONN, table_name, term_id, offset=offset, limit=limit)
+    href = unquote(url_for("cmi-pb.term", table_name=table_name, view="tree", term_id="{curie}"))
+    for child in child_page:
+        child["href"] = href.format(curie=child["id"])
+    return Response(
+        json.dumps(
+            {
+                "id": term_id,
+                "offset": offset,
+                "limit": limit,
+                "total": total,
+                "children": child_page,
+            }
+        ),
+        mimetype="application/json",
+    )
+
+
 @BLUEPRINT.route("/<table_name>", methods=["GET", "POST"])
 def table(table_name):
     messages = defaultdict(list)
@@ -172,20 +421,23 @@ def table(table_name):
         if select:
             # TODO: add form at top of page for user to select predicates to show?
             pred_labels = select.split(",")
-            predicates = gs.get_ids(
-                CONN, id_or_labels=pred_labels, id_type="predicate", statement=table_name
-            )
+            predicates = METADATA.get(table_name).get_predicate_ids(pred_labels)
 
         search_text = request.args.get("text")
-        if search_text or request.args.get("format"):
+        fmt = request.args.get("format")
+        if not search_text and request.args.get("export") == "all" and fmt:
+            # Stream the full table instead of the current page
+            return stream_ontology_export(table_name, predicates, fmt)
+
+        if search_text or fmt:
             # Get matching terms
             if request.args.get("exact") and not request.args.get("format") == "json":
-                term_ids = gs.get_ids(CONN, id_or_labels=[search_text], statement=table_name)
+                term_ids = LABELS.get_ids(table_name, [search_text])
+            elif request.args.get("format") == "json":
+                # Support for typeahead search
+                return json.dumps(search_terms(table_name, search_text or ""))
             else:
                 data = search(CONN, limit=None, search_text=search_text or "", statement=table_name)
-                if request.args.get("format") == "json":
-                    # Support for typeahead search
-                    return json.dumps(data)
                 term_ids = [x["id"] for x in data]
             if len(term_ids) == 1:
                 # Single result, redirect to the tree view of that term
@@ -207,8 +459,11 @@ def table(table_name):
                     tables=tables,
                     title=get_ontology_title(table_name),
                 )
+            version = get_render_version()
             data = gs.get_objects(CONN, predicates, statement=table_name, term_ids=term_ids)
-            response = render_ontology_table(table_name, data, predicates=predicates)
+            response = render_ontology_table(
+                table_name, data, predicates=predicates, version=version
+            )
             if isinstance(response, Response):
                 return response
             return render_template(
@@ -226,8 +481,11 @@ def table(table_name):
             )
 
         # Export the data - excluding anon objects
-        data = gs.get_objects(CONN, predicates, exclude_json=True, statement=table_name)
-        response = render_ontology_table(table_name, data, predicates=predicates)
+        version = get_render_version()
+        data, total = get_ontology_page(table_name, predicates)
+        response = render_ontology_table(
+            table_name, data, predicates=predicates, total=total, version=version
+        )
         if isinstance(response, Response):
             return response
         return render_template(
@@ -256,7 +514,7 @@ def table(table_name):
 
     form_html = None
     pk = get_primary_key(table_name)
-    cols = get_sql_columns(CONN, table_name)
+    cols = CATALOG.get_columns(table_name)
     if request.method == "POST":
         # Override view, which isn't passed in POST
         view = "form"
@@ -272,12 +530,24 @@ def table(table_name):
                 v = request.form.get(c + "_other", "")
             new_row[c] = v
 
-        validated_row = validate_table_row(table_name, new_row)
         if request.form["action"] == "validate":
-            form_html = get_row_as_form(table_name, validated_row)
+            # Get the version first, so a write made during validation invalidates the token
+            version = VERSION.get()
+            validated_row = validate_table_row(table_name, new_row)
+            token = VALIDATIONS.issue(table_name, None, new_row, version, validated_row)
+            form_html = get_row_as_form(table_name, validated_row, validation_token=token)
         elif request.form["action"] == "submit":
+            # Reuse the result of the validate action if nothing has changed since
+            validated_row = VALIDATIONS.redeem(
+                request.form.get("validation_token"), table_name, None, new_row, VERSION.get()
+            )
+            if not validated_row:
+                validated_row = validate_table_row(table_name, new_row)
             # Add row to the database and get the new row number
-            row_number = insert_new_row(CONFIG, table_name, validated_row)
+            row_number = WRITER.submit(
+                lambda config: insert_new_row(config, table_name, validated_row)
+            )
+            record_write(table_name)
             # Use row number to get the primary key for this row & redirect to new term
             if pk == "row_number":
                 row_pk = row_number
@@ -297,6 +567,9 @@ def table(table_name):
                     row_pk = f"row/{row_number}"
             return redirect(url_for("cmi-pb.term", table_name=table_name, term_id=row_pk))
 
+    if view == "grid":
+        return render_grid(table_name)
+
     if view == "form":
         if not form_html:
             # Some values may be filled in from request args, otherwise values are blank
@@ -345,6 +618,16 @@ def table(table_name):
             "url": url_for("cmi-pb.table", table_name=table_name, view="form"),
         },
         base_ontology=OPTIONS["base_ontology"],
+        edit_btn={
+            "text": "Edit rows in grid",
+            "url": url_for(
+                "cmi-pb.table",
+                table_name=table_name,
+                view="grid",
+                offset=request.args.get("offset", "0"),
+                limit=request.args.get("limit", "100"),
+            ),
+        },
         html=response,
         import_table=OPTIONS["import_table"],
         project_name=OPTIONS["title"],
@@ -382,23 +665,23 @@ def term(table_name, term_id):
     elif request.args.get("format") == "json":
         return dump_search_results(table_name)
     else:
+        metadata = METADATA.get(table_name)
         select = request.args.get("select")
         if select:
             # TODO: add form at top of page for user to select predicates to show?
             pred_labels = select.split(",")
-            predicates = gs.get_ids(
-                CONN, id_or_labels=pred_labels, id_type="predicate", statement=table_name
-            )
+            predicates = metadata.get_predicate_ids(pred_labels)
         else:
-            predicates = gs.get_ids(CONN, id_type="predicate", statement=table_name)
+            predicates = metadata.predicates
 
+        version = get_render_version()
         data = gs.get_objects(
             CONN, predicates, include_all_predicates=False, statement=table_name, term_ids=[term_id]
         )
         lbls = data[term_id].get("rdfs:label")
         subtitle = lbls[0]["object"] if lbls else term_id
 
-        response = render_ontology_table(table_name, data, predicates=predicates)
+        response = render_ontology_table(table_name, data, predicates=predicates, version=version)
         if isinstance(response, Response):
             return response
 
@@ -420,7 +703,7 @@ def term(table_name, term_id):
                 }
         elif table_name != OPTIONS["base_ontology"] and OPTIONS["import_table"]:
             # Only include add button if its not already in import
-            term_label = gs.get_labels(CONN, [term_id], statement=table_name)[term_id]
+            term_label = LABELS.get_labels(table_name, [term_id]).get(term_id)
             url_args = {
                 "table_name": OPTIONS["import_table"],
                 "view": "form",
@@ -450,6 +733,13 @@ def term(table_name, term_id):
         )
 
 
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    """Count a query run on the database connection during the current request. This is registered
+    as a listener for the SQLAlchemy 'before_cursor_execute' event."""
+    if has_request_context():
+        g.query_count = g.get("query_count", 0) + 1
+
+
 def flatten(lst: list) -> list:
     """Flatten a nested list.
 
@@ -463,12 +753,30 @@ def flatten(lst: list) -> list:
             yield el
 
 
+def get_app_token(options: dict) -> str:
+    """Get a token for the app that changes with anything other than the database that changes
+    the pages: the run options, and the modules & templates of this package (by their modification
+    times, which also change when another version is installed).
+
+    :param options: run options of the app
+    :return: token
+    """
+    h = hashlib.sha256(json.dumps(options, sort_keys=True, default=str).encode("utf-8"))
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    template_dir = os.path.join(package_dir, "templates")
+    for d in [package_dir, template_dir]:
+        for name in sorted(os.listdir(d)):
+            if name.endswith((".py", ".html")):
+                h.update(f"{name}:{os.stat(os.path.join(d, name)).st_mtime_ns};".encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
 def get_display_ontologies() -> list:
     """Return a list of ontology tables from all database tables to display in navigation.
 
     :return: list of ontology tables
     """
-    return [t for t in get_sql_tables(CONN) if is_ontology(t)]
+    return CATALOG.ontologies
 
 
 def get_display_tables() -> list:
@@ -478,21 +786,29 @@ def get_display_tables() -> list:
     """
     term_index = get_term_index()
     if term_index and OPTIONS["hide_index"]:
-        tables = [x for x in get_sql_tables(CONN) if x != term_index]
+        tables = [x for x in CATALOG.tables if x != term_index]
     else:
-        tables = get_sql_tables(CONN)
+        tables = CATALOG.tables
     return [t for t in tables if not is_ontology(t)]
 
 
+def get_form_row_id() -> int:
+    """Get the next ID for a form row. IDs are unique within the current request, so concurrent
+    requests never share a counter.
+
+    :return: form row ID
+    """
+    form_row_id = g.get("form_row_id", 0)
+    g.form_row_id = form_row_id + 1
+    return form_row_id
+
+
 def get_term_index() -> Union[str, None]:
     """Get the table of type 'index'.
 
     :return: table name of index table, or None
     """
-    res = CONN.execute('SELECT "table" FROM "table" WHERE "type" = "index"').fetchone()
-    if res:
-        return res["table"]
-    return None
+    return CATALOG.term_index
 
 
 def get_term_location(term_id: str) -> Union[str, None]:
@@ -511,35 +827,86 @@ def get_term_location(term_id: str) -> Union[str, None]:
     return None
 
 
+def record_write(table_name: str):
+    """Update the in-process state that depends on the database after a row was written to a table.
+
+    :param table_name: table that was written to
+    """
+    if table_name in CONFIG_TABLES:
+        CATALOG.refresh(force=True)
+    if RENDER_STORE:
+        RENDER_STORE.changed.set()
+
+
 # ----- DATA TABLE METHODS -----
 
 
 def get_all_datatypes(datatype: str) -> list:
-    """Given a datatype, get all ancestor datatypes from the 'datatype' table.
+    """Given a datatype, get all ancestor datatypes from the 'datatype' table hierarchy.
 
     :param datatype: datatype to get all ancestor datatypes of
     :return: all ancestor datatypes of given datatype (inclusive of given datatype)
     """
-    query = sql_text(
-        """WITH RECURSIVE ancestors(child, parent) AS (
-            SELECT DISTINCT
-                :dt AS child,
-                parent AS parent
-            FROM datatype
-            WHERE datatype = :dt
-            UNION
-            SELECT
-                datatype AS child,
-                datatype.parent AS parent
-            FROM datatype, ancestors
-            WHERE ancestors.parent = datatype)
-        SELECT DISTINCT parent FROM ancestors"""
-    )
-    results = CONN.execute(query, dt=datatype)
-    all_types = [datatype]
-    for res in results:
-        all_types.append(res["parent"])
-    return all_types
+    if not CATALOG.datatypes:
+        return [datatype]
+    return CATALOG.datatypes.get_ancestors(datatype)
+
+
+def get_form_schema(table_name: str) -> Dict[str, dict]:
+    """Get the form schema for a table: the HTML type, allowed values, description and readonly flag
+    of each column. The schema is built from the 'column' and 'datatype' tables the first time it is
+    requested and kept in the schema catalog until the catalog is reloaded.
+
+    :param table_name: table to get form schema of
+    :return: dict of column name -> form field details
+    """
+    form_schema = CATALOG.form_schemas.get(table_name)
+    if form_schema is not None:
+        return form_schema
+
+    form_schema = {}
+    tables = CATALOG.tables
+    if "column" in tables:
+        # Use column table to get description & datatype for each col
+        results = CONN.execute(
+            sql_text(
+                """SELECT "column", description, datatype, structure FROM "column"
+                WHERE "table" = :table"""
+            ),
+            table=table_name,
+        )
+        for res in results:
+            # Default HTML type is a simple text input
+            html_type = "text"
+            allowed_values = None
+            datatype = res["datatype"]
+            structure = res["structure"]
+            if structure and structure.split("(")[0] in ["from", "in", "tree", "under"]:
+                # Given the from structure, we always turn the input into a search
+                html_type = "search"
+            elif datatype and "datatype" in tables:
+                # Everything else uses an HTML type defined in the datatype table
+                # If a datatype does not have an HTML type, search for first ancestor type
+                html_type, allowed_values = get_html_type_and_values(datatype)
+            if allowed_values and not html_type:
+                # Default to search when allowed_values are provided
+                # This will still allow users to input invalid values
+                html_type = "search"
+
+            readonly = False
+            if html_type == "readonly":
+                html_type = "text"
+                readonly = True
+
+            form_schema[res["column"]] = {
+                "allowed_values": allowed_values,
+                "description": res["description"],
+                "html_type": html_type,
+                "readonly": readonly,
+            }
+
+    CATALOG.form_schemas[table_name] = form_schema
+    return form_schema
 
 
 def get_hiccup_form_row(
@@ -575,24 +942,23 @@ def get_hiccup_form_row(
     """
     # TODO: support other HTML types: dropdown, boolean, etc...
     # TODO: handle datatypes for ontology forms (include_datatypes?)
-    global FORM_ROW_ID
+    form_row_id = get_form_row_id()
 
     if html_type in ["select", "radio", "checkbox"] and not allowed_values:
         # TODO: error handling - allowed_values should always be included for these
         raise Exception(f"A list of allowed values is required for HTML type '{html_type}'")
 
     # Create the header label for this form row
-    header_col = ["div", {"class": "col-md-3", "id": FORM_ROW_ID}]
+    header_col = ["div", {"class": "col-md-3", "id": form_row_id}]
     if allow_delete:
         header_col.append(
             [
                 "a",
-                {"href": f"javascript:del({FORM_ROW_ID})"},
+                {"href": f"javascript:del({form_row_id})"},
                 ["i", {"class": "bi-x-circle", "style": "font-size: 16px; color: #dc3545;"}],
                 "&nbsp",
             ]
         )
-    FORM_ROW_ID += 1
     if display_header:
         header_col.append(["b", display_header])
     else:
@@ -772,31 +1138,41 @@ def get_hiccup_form_row(
 
 
 def get_html_type_and_values(datatype: str, values: list = None) -> Tuple[Optional[str], Optional[list]]:
-    """Query the 'datatype' table for the HTML form field type and, maybe, a list of allowed values for the field.
+    """Get the HTML form field type and, maybe, a list of allowed values for the field.
 
     :param datatype: datatype to get HTML type and allowed values of
     :param values: allowed values from column (overrides datatype values)
     :return: tuple of HTML type and allowed values for given datatype
     """
-    res = CONN.execute(
-        'SELECT parent, "HTML type", condition FROM datatype WHERE datatype = :datatype',
-        datatype=datatype,
-    ).fetchone()
-    if res:
-        if not values:
-            condition = res["condition"]
-            if condition and condition.startswith("in"):
-                parsed = CONFIG["parser"].parse(condition)[0]
-                # TODO: the in conditions are parsed with surrounding quotes
-                #       looks like there are always quotes? Maybe not with numbers?
-                values = [x["value"][1:-1] for x in parsed["args"]]
-        html_type = res["HTML type"]
-        if html_type:
-            return html_type, values
-        parent = res["parent"]
-        if parent:
-            return get_html_type_and_values(parent, values=values)
-    return None, None
+    if not CATALOG.datatypes:
+        return None, None
+    return CATALOG.datatypes.get_html_type_and_values(datatype, values=values)
+
+
+def get_link_patterns() -> Dict[str, str]:
+    """Get the URL patterns used to link ontology term values to the base ontology. The term ID or
+    label is represented by 'TERM' in each pattern.
+
+    :return: dict of link datatype -> URL pattern
+    """
+    patterns = CATALOG.link_patterns.get(request.script_root)
+    if patterns is not None:
+        return patterns
+    base_ontology = OPTIONS["base_ontology"]
+    id_pat = unquote(
+        url_for("cmi-pb.term", table_name=base_ontology, term_id="TERM", view="tree")
+    ).replace("+", " ")
+    label_pat = unquote(
+        url_for("cmi-pb.table", table_name=base_ontology, text="TERM", exact="true")
+    ).replace("+", " ")
+    patterns = {
+        "split_ontology_id": id_pat,
+        "split_ontology_label": label_pat,
+        "ontology_id": id_pat,
+        "ontology_label": label_pat,
+    }
+    CATALOG.link_patterns[request.script_root] = patterns
+    return patterns
 
 
 def get_messages(data: dict) -> Dict[str, list]:
@@ -805,25 +1181,7 @@ def get_messages(data: dict) -> Dict[str, list]:
     :param data: row data from database
     :return: dict of message level -> list of messages at that level
     """
-    messages = defaultdict(list)
-    for header, details in data.items():
-        if header == "row_number":
-            continue
-        if details["messages"]:
-            for msg in details["messages"]:
-                if msg["level"] == "error":
-                    if "error" not in messages:
-                        messages["error"] = list()
-                    messages["error"].append(msg["message"])
-                elif msg["level"] == "warn":
-                    if "warn" not in messages:
-                        messages["warn"] = list()
-                    messages["warn"].append(msg["message"])
-                elif msg["level"] == "info":
-                    if "info" not in messages:
-                        messages["info"] = list()
-                    messages["info"].append(msg["message"])
-    return messages
+    return get_row_messages(data)
 
 
 def get_primary_key(table_name: str) -> str:
@@ -832,25 +1190,25 @@ def get_primary_key(table_name: str) -> str:
     :param table_name: table to get primary key of
     :return: primary key or 'row_number'
     """
-    query = sql_text(
-        'SELECT "column" FROM "column" WHERE "table" = :table AND "structure" LIKE "%%primary%%"'
-    )
-    res = CONN.execute(query, table=table_name).fetchone()
-    if res:
-        return res["column"]
-    else:
-        return "row_number"
+    return CATALOG.get_primary_key(table_name)
 
 
-def get_row_as_form(table_name: str, data: dict) -> str:
+def get_row_as_form(table_name: str, data: dict, validation_token: str = None) -> str:
     """Transform a row either from query results or validation into an editable HTML form.
 
     :param table_name: source table for row
     :param data: row data from table
+    :param validation_token: token for the validated row, submitted with the form so that the
+                             validation can be reused
     :return: string HTML for editable form for this row
     """
     html = ["form", {"method": "post"}]
+    if validation_token:
+        html.append(
+            ["input", {"type": "hidden", "name": "validation_token", "value": validation_token}]
+        )
     row_valid = None
+    form_schema = get_form_schema(table_name)
 
     for header, value in data.items():
         if header == "row_number" or header.endswith("_meta"):
@@ -881,51 +1239,17 @@ def get_row_as_form(table_name: str, data: dict) -> str:
                 # If value is still None, we couldn't find nulltype or invalid value
                 value = ""
 
-        desc = None
-        # Default HTML type is a simple text input
-        html_type = "text"
-        allowed_values = None
-        tables = get_sql_tables(CONN)
-        if "column" in tables:
-            # Use column table to get description & datatype for this col
-            res = CONN.execute(
-                sql_text(
-                    """SELECT description, datatype, structure FROM "column"
-                    WHERE "table" = :table AND "column" = :column"""
-                ),
-                table=table_name,
-                column=header,
-            ).fetchone()
-            if res:
-                desc = res["description"]
-                datatype = res["datatype"]
-                structure = res["structure"]
-                if structure and structure.split("(")[0] in ["from", "in", "tree", "under"]:
-                    # Given the from structure, we always turn the input into a search
-                    html_type = "search"
-                elif datatype and "datatype" in tables:
-                    # Everything else uses an HTML type defined in the datatype table
-                    # If a datatype does not have an HTML type, search for first ancestor type
-                    html_type, allowed_values = get_html_type_and_values(datatype)
-        if allowed_values and not html_type:
-            # Default to search when allowed_values are provided
-            # This will still allow users to input invalid values
-            html_type = "search"
-
-        readonly = False
-        if html_type == "readonly":
-            html_type = "text"
-            readonly = True
+        field = form_schema.get(header, DEFAULT_FORM_FIELD)
 
         # Add the hiccup vector for this field as a Bootstrap row containing form elements
         html.append(
             get_hiccup_form_row(
                 header,
-                allowed_values=allowed_values,
-                description=desc,
-                html_type=html_type,
+                allowed_values=field["allowed_values"],
+                description=field["description"],
+                html_type=field["html_type"],
                 message=message,
-                readonly=readonly,
+                readonly=field["readonly"],
                 valid=valid,
                 value=value,
             )
@@ -995,13 +1319,23 @@ def get_row_number(table_name: str, pk_value: str) -> Optional[int]:
 
 def get_transformations(table_name: str) -> dict:
     """Get display value transformations for all columns given table. These are used to create links for ontology terms
-    from templates to the tree browser.
+    from templates to the tree browser. Transformations are cached in the schema catalog until it is reloaded.
 
     :param table_name: table to get any value transformations of
     :return: dict of column name -> transformation
     """
+    # URLs depend on the script root, which may differ between requests (e.g., CGI)
+    key = (table_name, request.script_root)
+    transform = CATALOG.transformations.get(key)
+    if transform is not None:
+        return transform
+
     transform = {}
-    cols = get_sql_columns(CONN, table_name)
+    if "column" not in CATALOG.tables:
+        CATALOG.transformations[key] = transform
+        return transform
+    patterns = get_link_patterns()
+    cols = CATALOG.get_columns(table_name)
     query = sql_text(
         f'SELECT "column", "datatype" FROM "column" WHERE "table" = :t AND "column" IN :cols'
     ).bindparams(bindparam("cols", expanding=True))
@@ -1012,62 +1346,78 @@ def get_transformations(table_name: str) -> dict:
         all_types = get_all_datatypes(dt)
         # Currently we are only transforming ontology_id to tree links
         if "split_ontology_id" in all_types:
-            url_pat = (
-                unquote(
-                    url_for(
-                        "cmi-pb.term",
-                        table_name=OPTIONS["base_ontology"],
-                        term_id="TERM",
-                        view="tree",
-                    )
-                )
-                .replace("+", " ")
-                .replace("TERM", "''' + c + '''")
-            )
+            url_pat = patterns["split_ontology_id"].replace("TERM", "''' + c + '''")
             transform[
                 col
             ] = f""""|".join(
             [f'''<a href="{url_pat}">''' + c + "</a>" for c in '''{{{col}}}'''.split('|')])"""
         elif "split_ontology_label" in all_types:
-            url_pat = (
-                unquote(
-                    url_for(
-                        "cmi-pb.table",
-                        table_name=OPTIONS["base_ontology"],
-                        text="TERM",
-                        exact="true",
-                    )
-                )
-                .replace("+", " ")
-                .replace("TERM", "''' + c + '''")
-            )
+            url_pat = patterns["split_ontology_label"].replace("TERM", "''' + c + '''")
             transform[
                 col
             ] = f""""|".join(
             [f'''<a href="{url_pat}">''' + c + "</a>" for c in '''{{{col}}}'''.split('|')])"""
         elif "ontology_id" in all_types:
-            url_pat = unquote(
-                url_for(
-                    "cmi-pb.term",
-                    table_name=OPTIONS["base_ontology"],
-                    term_id=f"{{{col}}}",
-                    view="tree",
-                )
-            ).replace("+", " ")
+            url_pat = patterns["ontology_id"].replace("TERM", f"{{{col}}}")
             transform[col] = f'''"""<a href="{url_pat}">{{{col}}}</a>"""'''
         elif "ontology_label" in all_types:
-            url_pat = unquote(
-                url_for(
-                    "cmi-pb.table",
-                    table_name=OPTIONS["base_ontology"],
-                    text=f"{{{col}}}",
-                    exact="true",
-                )
-            ).replace("+", " ")
+            url_pat = patterns["ontology_label"].replace("TERM", f"{{{col}}}")
             transform[col] = f'''"""<a href="{url_pat}">{{{col}}}</a>"""'''
+    CATALOG.transformations[key] = transform
     return transform
 
 
+def render_grid(table_name: str) -> str:
+    """Render a page of rows from a data table as an editable grid. Changed cells are sent to the
+    batch update endpoint together.
+
+    :param table_name: table to edit
+    :return: HTML page with grid
+    """
+    offset = int(request.args.get("offset", "0"))
+    limit = int(request.args.get("limit", "100"))
+    results = CONN.execute(
+        sql_text(
+            f"""SELECT * FROM "{table_name}_view"
+            ORDER BY row_number LIMIT :limit OFFSET :offset"""
+        ),
+        limit=limit,
+        offset=offset,
+    )
+    columns = [c for c in results.keys() if not c.endswith("_meta")]
+    rows = [get_row_values(dict(res)) for res in results]
+    total = CONN.execute(f'SELECT COUNT(*) FROM "{table_name}_view"').fetchone()[0]
+
+    pages = {}
+    if offset > 0:
+        pages["previous"] = url_for(
+            "cmi-pb.table",
+            table_name=table_name,
+            view="grid",
+            offset=max(offset - limit, 0),
+            limit=limit,
+        )
+    if offset + limit < total:
+        pages["next"] = url_for(
+            "cmi-pb.table", table_name=table_name, view="grid", offset=offset + limit, limit=limit
+        )
+    return render_template(
+        "grid.html",
+        base_ontology=OPTIONS["base_ontology"],
+        columns=[c for c in columns if c != "row_number"],
+        import_table=OPTIONS["import_table"],
+        ontologies=get_display_ontologies(),
+        pages=pages,
+        project_name=OPTIONS["title"],
+        rows=rows,
+        subtitle=f"Rows {offset + 1}-{offset + len(rows)} of {total}",
+        table_name=table_name,
+        tables=get_display_tables(),
+        title=f'Edit rows in <a href="{url_for("cmi-pb.table", table_name=table_name)}">{table_name}</a>',
+        update_url=url_for("cmi-pb.bulk_update", table_name=table_name),
+    )
+
+
 def render_row_from_database(table_name: str, term_id: str, row_number: int) -> Optional[Response]:
     """Render the data from a row in a database using query parameters. If a format is not specified, an HTML string is
     returned. Otherwise, the data in given format is returned as a Response object for the client to download.
@@ -1084,7 +1434,7 @@ def render_row_from_database(table_name: str, term_id: str, row_number: int) ->
         # Use the cols from the table, in case a value wasn't given to something
         # - we always ignore meta columns & row_number (for new row)
         new_row = {}
-        for c in get_sql_columns(CONN, table_name):
+        for c in CATALOG.get_columns(table_name):
             if c.endswith("_meta") or c == "row_number":
                 continue
             v = request.form.get(c)
@@ -1096,18 +1446,31 @@ def render_row_from_database(table_name: str, term_id: str, row_number: int) ->
         # Manually override view, which is not included in request.args in CGI app
         view = "form"
         if request.form["action"] == "validate":
+            # Get the version first, so a write made during validation invalidates the token
+            version = VERSION.get()
             validated_row = validate_table_row(table_name, new_row, row_number=row_number)
+            token = VALIDATIONS.issue(table_name, row_number, new_row, version, validated_row)
             # Place row_number first
             validated_row_2 = {"row_number": row_number}
             validated_row_2.update(validated_row)
             validated_row = validated_row_2
-            form_html = get_row_as_form(table_name, validated_row)
+            form_html = get_row_as_form(table_name, validated_row, validation_token=token)
         elif request.form["action"] == "submit":
-            # First validate the row to get the meta columns
-            validated_row = validate_table_row(table_name, new_row, row_number=row_number)
+            # First validate the row to get the meta columns, unless the result of the validate
+            # action can be reused because nothing has changed since
+            validated_row = VALIDATIONS.redeem(
+                request.form.get("validation_token"),
+                table_name,
+                row_number,
+                new_row,
+                VERSION.get(),
+            )
+            if not validated_row:
+                validated_row = validate_table_row(table_name, new_row, row_number=row_number)
             # Update the row regardless of results
             # Row ID may be different than row number, if exists
-            update_row(CONFIG, table_name, validated_row, row_number)
+            WRITER.submit(lambda config: update_row(config, table_name, validated_row, row_number))
+            record_write(table_name)
             messages = get_messages(validated_row)
             if messages.get("error"):
                 warn = messages.get("warn", [])
@@ -1201,15 +1564,8 @@ def validate_table_row(table_name: str, data: dict, row_number: int = None) -> d
     """
     # Transform row into dict expected for validate
     if row_number:
-        result_row = {}
-        for column, value in data.items():
-            result_row[column] = {
-                "value": value,
-                "valid": True,
-                "messages": [],
-            }
         # Row number may be different than row ID, if this column is used
-        return validate_row(CONFIG, table_name, result_row, row_number=row_number)
+        return validate_row(CONFIG, table_name, to_result_row(data), row_number=row_number)
     else:
         return validate_row(CONFIG, table_name, data, existing_row=False)
 
@@ -1227,9 +1583,37 @@ def dump_search_results(table_name: str) -> str:
     if not search_text:
         return json.dumps([])
     # return the raw search results to use in typeahead
-    return json.dumps(
-        search(CONN, limit=30, search_text=search_text, statement=table_name)
-    )
+    return json.dumps(search_terms(table_name, search_text))
+
+
+def get_ontology_page(table_name: str, predicates: list) -> Tuple[dict, int]:
+    """Get the objects for the page of terms selected by the order, offset and limit request args.
+    Terms are ordered in SQL (and the order is kept until the table changes) so that only the
+    terms on the page are loaded.
+
+    :param table_name: ontology statement table
+    :param predicates: predicate IDs to get objects of
+    :return: ordered dict of term ID -> predicate ID -> list of objects for the page, and the total
+             number of terms in the table
+    """
+    order_by = []
+    if request.args.get("order"):
+        predicate_labels = METADATA.get(table_name).get_predicate_labels(list(predicates))
+        label_to_id = {v: k for k, v in predicate_labels.items()}
+        for ob in parse_order_by(request.args["order"]):
+            ob = dict(ob)
+            ob["key"] = label_to_id.get(ob["key"], ob["key"])  # e.g., rdfs:label
+            order_by.append(ob)
+    offset = int(request.args.get("offset", "0"))
+    limit = int(request.args.get("limit", "100"))
+    metadata = METADATA.get(table_name)
+    term_ids = metadata.get_term_page(order_by=order_by, offset=offset, limit=limit)
+    data = {}
+    if term_ids:
+        data = gs.get_objects(
+            CONN, predicates, exclude_json=True, statement=table_name, term_ids=term_ids
+        )
+    return order_terms(data, predicates, term_ids), metadata.get_term_count()
 
 
 def get_ontology_title(table_name: str, table_active: bool = True, term_id: str = None) -> str:
@@ -1242,11 +1626,7 @@ def get_ontology_title(table_name: str, table_active: bool = True, term_id: str
     :return: string HTML element
     """
     # Try to get an ontology title using the dce:title property
-    ontology_title = None
-    ontology_iri = gs.get_ontology_iri(CONN, statement=table_name)
-    if ontology_iri:
-        prefixes = gs.get_prefixes(CONN)
-        ontology_title = gs.get_ontology_title(CONN, prefixes, ontology_iri, statement=table_name)
+    ontology_title = METADATA.get(table_name).title
 
     # Create the links
     if term_id:
@@ -1278,6 +1658,17 @@ def get_ontology_title(table_name: str, table_active: bool = True, term_id: str
     )
 
 
+def get_render_version() -> Optional[int]:
+    """Get the data version to cache rendered terms at. This must be read before the terms are
+    loaded, so that terms loaded before a write are never cached at the version after it.
+
+    :return: data version, or None if rendered terms are not cached
+    """
+    if not RENDER_CACHE:
+        return None
+    return RENDER_CACHE.get_version()
+
+
 def get_terms_from_arg(table_name: str, arg: str) -> dict:
     """Using a Swagger-like query parameter, get a dict of the ontology term IDs -> labels matched by that arg.
 
@@ -1294,7 +1685,7 @@ def get_terms_from_arg(table_name: str, arg: str) -> dict:
     except UnexpectedCharacters:
         parent_terms = [arg]
     # We don't know if we were passed ID or label, so get both for all terms
-    return gs.get_labels(CONN, parent_terms, statement=table_name)
+    return LABELS.get_labels(table_name, parent_terms)
 
 
 def get_terms_of_type(table_name: str, entity_type: str) -> list:
@@ -1313,112 +1704,221 @@ def get_terms_of_type(table_name: str, entity_type: str) -> list:
     return [res["subject"] for res in results]
 
 
+def get_tree_variant() -> str:
+    """Get the tree options that rendered trees depend on, used to tell stored tree fragments that
+    were rendered with other options apart.
+
+    :return: JSON string of tree options
+    """
+    return json.dumps(
+        [OPTIONS["tree_predicates"], OPTIONS["max_children"], bool(HIERARCHIES)], sort_keys=True
+    )
+
+
 def is_ontology(table_name: str) -> bool:
     """Check if a given table is an LDTab ontology statement table.
 
     :param table_name: table to check
     :return: True if table is an LDTab ontology statement table"""
-    columns = get_sql_columns(CONN, table_name)
-    return {"subject", "predicate", "object", "datatype", "annotation"}.issubset(set(columns))
+    return CATALOG.is_ontology(table_name)
+
+
+def rebuild_render_store(app: Flask):
+    """Re-render the out-of-date entries of the persistent render store in the background. The
+    store is checked whenever this process writes to the database, and every RENDER_STORE_INTERVAL
+    seconds to pick up writes by other processes.
+
+    :param app: Flask app to render in
+    """
+
+    def render_stored_terms(url_root: str, table_name: str, data: Dict[str, dict]) -> dict:
+        with app.test_request_context(base_url="http://localhost" + url_root):
+            return render_terms(table_name, data)
+
+    def render_stored_tree(url_root: str, table_name: str, term_id: str) -> str:
+        with app.test_request_context(base_url="http://localhost" + url_root):
+            return render_tree_html(table_name, term_id=term_id or None)
+
+    with app.app_context():
+        RENDER_STORE.background = True
+        while True:
+            RENDER_STORE.changed.wait(RENDER_STORE_INTERVAL)
+            RENDER_STORE.changed.clear()
+            try:
+                CATALOG.refresh()
+                variant = get_tree_variant()
+                for table_name in CATALOG.ontologies:
+                    count = RENDER_STORE.rebuild(
+                        table_name, variant, render_stored_terms, render_stored_tree
+                    )
+                    if count:
+                        LOGGER.info(f"Re-rendered {count} stored entries for '{table_name}'")
+            except Exception:
+                LOGGER.error(traceback.format_exc())
 
 
-def render_ontology_table(table_name, data, predicates: list = None) -> Optional[Response]:
+def render_hierarchy_tree(table_name: str, href: str, term_id: str = None) -> str:
+    """Render the tree view for a class from the in-memory class hierarchy: the path to the class
+    and its children on the left, and the annotations of the class on the right.
+
+    :param table_name: name of ontology statement table
+    :param href: link pattern for terms, with '{curie}' as the placeholder for the term ID
+    :param term_id: class to render tree view for - if None, the top-level classes are shown
+    :return: HTML string
+    """
+    hierarchy = HIERARCHIES.get(table_name)
+    tree = hierarchy.get_tree(term_id, href, max_children=OPTIONS["max_children"])
+    if not term_id or term_id == "owl:Class":
+        return render(["div", {"id": "gadgetTree", "class": "row"}, tree])
+
+    # Get the predicates used by this term, in the configured display order
+    results = CONN.execute(
+        sql_text(f'SELECT DISTINCT predicate FROM "{table_name}" WHERE subject = :term_id'),
+        term_id=term_id,
+    )
+    term_predicates = [res["predicate"] for res in results]
+    predicate_labels = METADATA.get(table_name).get_predicate_labels(term_predicates)
+    tree_predicates = OPTIONS["tree_predicates"] or ["rdfs:label", "*"]
+    predicate_ids = [p for p in tree_predicates if p in term_predicates]
+    if "*" in tree_predicates:
+        # All remaining predicates are sorted by label
+        remaining = [p for p in term_predicates if p not in predicate_ids]
+        remaining.sort(key=lambda p: str(predicate_labels.get(p) or p).lower())
+        before = tree_predicates[: tree_predicates.index("*")]
+        idx = len([p for p in before if p in term_predicates])
+        predicate_ids = predicate_ids[:idx] + remaining + predicate_ids[idx:]
+
+    annotations = ["ul", {"id": "annotations", "class": "col-md"}]
+    if predicate_ids:
+        data = gs.get_objects(
+            CONN,
+            predicate_ids,
+            include_all_predicates=False,
+            statement=table_name,
+            term_ids=[term_id],
+        )
+        rendered = terms2dicts(
+            CONN, data, include_annotations=True, rdfa=True, statement=table_name
+        )
+        rendered = rendered[0] if rendered else {}
+        for predicate_id in predicate_ids:
+            hiccup = rendered.get(predicate_id)
+            if not hiccup:
+                continue
+            pred_label = BUILTIN_LABELS.get(predicate_id) or predicate_labels.get(predicate_id)
+            annotations.append(
+                [
+                    "li",
+                    [
+                        "a",
+                        {"href": href.format(curie=predicate_id)},
+                        pred_label or predicate_id,
+                    ],
+                    insert_href(hiccup, href=href),
+                ]
+            )
+
+    return render(
+        [
+            "div",
+            {"id": "gadgetTree", "class": "row"},
+            tree,
+            [
+                "div",
+                {"class": "col-md"},
+                ["h2", hierarchy.get_label(term_id)],
+                ["a", {"href": href.format(curie=term_id)}, term_id],
+                annotations,
+            ],
+        ]
+    )
+
+
+def render_ontology_table(
+    table_name, data, predicates: list = None, total: int = None, version: int = None
+) -> Optional[Response]:
     """Render an ontology statement table as a Response for downloads or an HTML table (string).
 
     :param table_name: name of SQL table that contains terms
     :param data: data to render - dict of term ID -> predicate ID -> list of JSON objects
     :param predicates: list of predicate IDs - if not provided, predicate IDs are taken from data
+    :param total: if provided, data is the already ordered page of terms at the requested offset and
+                  total is the number of terms in the full listing
+    :param version: data version read before data was loaded (see get_render_version) - if not
+                    provided, rendered terms are not cached
     :return: Response or HTML string
     """
     # TODO: do we care about displaying annotations in this table view? Or only on term view?
     # Reverse the ID -> label dictionary to translate column names to IDs
     if not predicates:
         predicates = set(chain.from_iterable([list(x.keys()) for x in data.values()]))
-    predicate_labels = gs.get_labels(CONN, list(predicates), statement=table_name)
-
-    # TODO: how do we want to handle these? Sometimes they are URNs, e.g. swrl
-    # Exclude full IRIs
-    data = {k: v for k, v in data.items() if not k.startswith("<")}
-
-    # Order based on raw value of 'object', don't worry about rendering
-    if request.args.get("order"):
-        label_to_id = {v: k for k, v in predicate_labels.items()}
-        order_by = parse_order_by(request.args["order"])
-        for ob in order_by:
-            reverse = False
-            if ob["order"] == "desc":
-                reverse = True
-
-            if ob["key"] == "ID":
-                # ID is never null
-                # sorted is more efficient here so we don't need to turn dict into list of tuples
-                data = {k: v for k, v in sorted(data.items(), reverse=reverse)}
-                continue
-
-            key = label_to_id.get(ob["key"], ob["key"])  # e.g., rdfs:label
-
-            # Separate out the items with no list entries for this predicate
-            nulls = {k: v for k, v in data.items() if not v[key]}
-            non_nulls = [[k, v] for k, v in data.items() if v[key]]
-
-            # Sort the items with entries for this predicate
-            non_nulls.sort(key=lambda itm: itm[1][key][0]["object"], reverse=reverse)
-
-            # ... then put the nulls in the correct spot
-            if ob["nulls"] == "first":
-                data = nulls
-                data.update({k: v for k, v in non_nulls})
-            else:
-                data = {k: v for k, v in non_nulls}
-                data.update(nulls)
+    predicate_labels = METADATA.get(table_name).get_predicate_labels(list(predicates))
 
     # Offset and limit used to determine which terms to render
     # Rendering objects for all terms is very slow
     offset = int(request.args.get("offset", "0"))
-    limit = int(request.args.get("limit", "100")) + offset
+    limit = int(request.args.get("limit", "100"))
 
-    data = [[k, v] for k, v in data.items()]
-    data_subset = {k: v for k, v in data[offset:limit]}
-    post_subset = {k: v for k, v in data[limit:]}
-    data = {k: v for k, v in data[:offset]}
+    if total is None:
+        # TODO: how do we want to handle these? Sometimes they are URNs, e.g. swrl
+        # Exclude full IRIs
+        items = [[k, v] for k, v in data.items() if not k.startswith("<")]
+
+        # Order based on raw value of 'object', don't worry about rendering
+        if request.args.get("order"):
+            label_to_id = {v: k for k, v in predicate_labels.items()}
+            items = sort_terms(items, parse_order_by(request.args["order"]), label_to_id)
+
+        total = len(items)
+        data_subset = {k: v for k, v in items[offset : offset + limit]}
+    else:
+        data_subset = data
 
     fmt = request.args.get("format")
     if not fmt:
-        # Convert objects to hiccup with ofn
-        rendered = terms2dicts(
-            CONN,
-            data_subset,
-            include_annotations=True,
-            include_id=True,
-            rdfa=True,
-            statement=table_name,
-        )
-        for itm in rendered:
-            # Render using hiccup module
-            rendered_term = {}
-            term_id = itm["ID"]
-            for predicate_id, hiccup in itm.items():
-                if hiccup:
-                    if predicate_id == "ID":
-                        hiccup = ["a", {"resource": hiccup}, hiccup]
-                    hiccup = insert_href(
-                        hiccup,
-                        href=unquote(
-                            url_for("cmi-pb.term", table_name=table_name, term_id="{curie}")
-                        ),
-                    )
-                    rendered_term[predicate_id] = render(hiccup)
-                else:
-                    rendered_term[predicate_id] = None
-            data[term_id] = rendered_term
-        data.update(post_subset)
+        rendered_terms = {}
+        to_render = data_subset
+        if RENDER_CACHE and version is not None:
+            # Reuse the rendered cells of terms that have not changed since they were last rendered
+            rendered_terms, missing = RENDER_CACHE.get_many(
+                table_name, request.script_root, version, data_subset
+            )
+            to_render = {term_id: data_subset[term_id] for term_id in missing}
+
+        stored_terms = {}
+        if RENDER_STORE and to_render:
+            # Then reuse terms rendered by any process whose statements have not changed
+            stored_terms, missing = RENDER_STORE.get_terms(table_name, request.script_root, to_render)
+            to_render = {term_id: data_subset[term_id] for term_id in missing}
+
+        new_terms = {}
+        if to_render:
+            new_terms = render_terms(table_name, to_render)
+            if RENDER_STORE:
+                RENDER_STORE.put_terms(table_name, request.script_root, to_render, new_terms)
+        new_terms.update(stored_terms)
+        if RENDER_CACHE and version is not None and new_terms:
+            RENDER_CACHE.put_many(table_name, request.script_root, version, data_subset, new_terms)
+        rendered_terms.update(new_terms)
+
+        # Keep the order of the requested page & copy the cells so cached terms are not changed
+        data = {
+            term_id: dict(rendered_terms[term_id])
+            for term_id in data_subset
+            if term_id in rendered_terms
+        }
+        all_predicates = set(chain.from_iterable([list(x.keys()) for x in data.values()]))
+        for rendered_term in data.values():
+            # Cached terms only hold the cells they were rendered with
+            for predicate_id in all_predicates:
+                rendered_term.setdefault(predicate_id, None)
 
         if not predicates:
-            predicates = set(chain.from_iterable([list(x.keys()) for x in rendered]))
-        predicate_labels = gs.get_labels(CONN, list(predicates), statement=table_name)
+            predicates = all_predicates
+        predicate_labels = METADATA.get(table_name).get_predicate_labels(list(predicates))
 
         # Create the HTML output of data
-        table_data = []
+        page_data = []
         for term_id, predicate_objects in data.items():
             # We always display the ID, regardless of other columns
             term_id = html_escape(term_id)
@@ -1433,10 +1933,12 @@ def render_ontology_table(table_name, data, predicates: list = None) -> Optional
             }
             for predicate, objs in predicate_objects.items():
                 term_data[predicate_labels.get(predicate, predicate)] = objs
-            table_data.append(term_data)
-        if len(data) == 1:
+            page_data.append(term_data)
+        # Only the current page is held in memory, but the table still reports the full count
+        table_data = TermPage(page_data, offset, total)
+        if total == 1 and data:
             # Single term view
-            predicates = table_data[0].keys()
+            predicates = page_data[0].keys()
             base_url = url_for("cmi-pb.term", table_name=table_name, term_id=list(data.keys())[0])
         else:
             base_url = url_for("cmi-pb.table", table_name=table_name)
@@ -1481,7 +1983,16 @@ def render_subclass_of(table_name: str, param: str, arg: str) -> Optional[Respon
     id_to_label = get_terms_from_arg(table_name, arg)
 
     terms = set()
-    if param == "subClassOf":
+    if CLOSURE_TABLES and param in ["subClassOf", "subClassOf?", "subClassOfplus", "subClassOf*"]:
+        # Resolve all parent terms with a single lookup in the closure table
+        max_depth = None
+        if param in ["subClassOf", "subClassOf?"]:
+            max_depth = 1
+        closure = CLOSURE_TABLES.get(table_name)
+        terms.update(closure.get_descendants(id_to_label.keys(), max_depth=max_depth))
+        if param in ["subClassOf?", "subClassOf*"]:
+            terms.update(id_to_label.keys())
+    elif param == "subClassOf":
         for p in id_to_label.keys():
             terms.update(gs.get_children(CONN, p, statement=table_name))
     elif param == "subClassOf?":
@@ -1514,14 +2025,13 @@ def render_subclass_of(table_name: str, param: str, arg: str) -> Optional[Respon
     if select:
         # TODO: add form at top of page for user to select predicates to show?
         pred_labels = select.split(",")
-        predicates = gs.get_ids(
-            CONN, id_or_labels=pred_labels, id_type="predicate", statement=table_name
-        )
+        predicates = METADATA.get(table_name).get_predicate_ids(pred_labels)
 
+    version = get_render_version()
     data = gs.get_objects(
         CONN, predicates, exclude_json=True, statement=table_name, term_ids=list(terms)
     )
-    response = render_ontology_table(table_name, data, predicates=predicates)
+    response = render_ontology_table(table_name, data, predicates=predicates, version=version)
     if isinstance(response, Response):
         return response
 
@@ -1553,7 +2063,6 @@ def render_term_form(table_name: str, term_id: str) -> str:
     :param term_id: term to generate a form for
     :return: HTML page with form
     """
-    global FORM_ROW_ID
     entity_type = gs.get_top_entity_type(CONN, term_id, statement=table_name)
 
     # Get all annotation properties
@@ -1561,9 +2070,9 @@ def render_term_form(table_name: str, term_id: str) -> str:
         f'SELECT DISTINCT predicate FROM "{table_name}" WHERE predicate NOT IN :logic',
     ).bindparams(bindparam("logic", expanding=True))
     results = CONN.execute(query, {"logic": LOGIC_PREDICATES}).fetchall()
-    aps = gs.get_labels(CONN, [x["predicate"] for x in results], statement=table_name)
+    aps = METADATA.get(table_name).get_predicate_labels([x["predicate"] for x in results])
 
-    predicates = gs.get_ids(CONN, id_type="predicate", statement=table_name)
+    predicates = METADATA.get(table_name).predicates
     term_details = gs.get_objects(CONN, predicates, statement=table_name, term_ids=[term_id])
     if not term_details:
         return abort(400, f"Unable to find term {term_id} in '{table_name}' table")
@@ -1655,8 +2164,6 @@ def render_term_form(table_name: str, term_id: str) -> str:
     logic_html.insert(0, {"class": "row", "id": "term-logic"})
     logic_html.insert(0, "div")
 
-    # Reset form row ID for next time
-    FORM_ROW_ID = 0
     return render_template(
         "ontology_form.html",
         base_ontology=OPTIONS["base_ontology"],
@@ -1674,6 +2181,35 @@ def render_term_form(table_name: str, term_id: str) -> str:
     )
 
 
+def render_terms(table_name: str, data: Dict[str, dict]) -> Dict[str, dict]:
+    """Render the objects of ontology terms as HTML cells.
+
+    :param table_name: ontology statement table
+    :param data: data to render - dict of term ID -> predicate ID -> list of JSON objects
+    :return: dict of term ID -> predicate ID -> HTML (or None if the term has no objects)
+    """
+    # Convert objects to hiccup with ofn
+    rendered = terms2dicts(
+        CONN, data, include_annotations=True, include_id=True, rdfa=True, statement=table_name,
+    )
+    href = unquote(url_for("cmi-pb.term", table_name=table_name, term_id="{curie}"))
+    rendered_terms = {}
+    for itm in rendered:
+        # Render using hiccup module
+        rendered_term = {}
+        term_id = itm["ID"]
+        for predicate_id, hiccup in itm.items():
+            if hiccup:
+                if predicate_id == "ID":
+                    hiccup = ["a", {"resource": hiccup}, hiccup]
+                hiccup = insert_href(hiccup, href=href)
+                rendered_term[predicate_id] = render(hiccup)
+            else:
+                rendered_term[predicate_id] = None
+        rendered_terms[term_id] = rendered_term
+    return rendered_terms
+
+
 def render_tree(table_name: str, term_id: str = None) -> str:
     """Generate the page for the tree view for an ontology statement table. If a term_id is not supplied, the default
     'Class' page will show with a help message.
@@ -1686,17 +2222,18 @@ def render_tree(table_name: str, term_id: str = None) -> str:
         return abort(418, "Cannot show tree view for non-ontology table")
 
     # nothing to search, just return the tree view
-    href = unquote(url_for("cmi-pb.term", table_name=table_name, view="tree", term_id="{curie}"))
-    html = gadget_tree(
-        CONN,
-        href=href,
-        include_search=False,
-        predicate_ids=OPTIONS["tree_predicates"],
-        standalone=False,
-        max_children=OPTIONS["max_children"],
-        statement=table_name,
-        term_id=term_id,
-    )
+    if RENDER_STORE:
+        # Reuse the tree if it was rendered (by any process) since the table last changed
+        variant = get_tree_variant()
+        html, stamp = RENDER_STORE.get_tree(table_name, request.script_root, term_id or "", variant)
+        if not html:
+            html = render_tree_html(table_name, term_id=term_id)
+            if stamp:
+                RENDER_STORE.put_tree(
+                    table_name, request.script_root, term_id or "", variant, stamp, html
+                )
+    else:
+        html = render_tree_html(table_name, term_id=term_id)
 
     # Determine if we need to include add/edit buttons
     add_btn = None
@@ -1716,7 +2253,7 @@ def render_tree(table_name: str, term_id: str = None) -> str:
                 }
         elif table_name != OPTIONS["base_ontology"] and OPTIONS["import_table"]:
             # Only include add button if its not already in import
-            term_label = gs.get_labels(CONN, [term_id], statement=table_name)[term_id]
+            term_label = LABELS.get_labels(table_name, [term_id])[term_id]
             url_args = {
                 "table_name": OPTIONS["import_table"],
                 "view": "form",
@@ -1745,11 +2282,314 @@ def render_tree(table_name: str, term_id: str = None) -> str:
     )
 
 
+def render_tree_html(table_name: str, term_id: str = None) -> str:
+    """Render the tree for an ontology statement table as an HTML fragment.
+
+    :param table_name: name of ontology statement table
+    :param term_id: optional term_id to render tree for
+    :return: HTML tree
+    """
+    href = unquote(url_for("cmi-pb.term", table_name=table_name, view="tree", term_id="{curie}"))
+    if HIERARCHIES and (
+        not term_id
+        or term_id == "owl:Class"
+        or HIERARCHIES.get(table_name).is_class(term_id)
+    ):
+        # Classes are rendered from the in-memory hierarchy
+        return render_hierarchy_tree(table_name, href, term_id=term_id)
+    return gadget_tree(
+        CONN,
+        href=href,
+        include_search=False,
+        predicate_ids=OPTIONS["tree_predicates"],
+        standalone=False,
+        max_children=OPTIONS["max_children"],
+        statement=table_name,
+        term_id=term_id,
+    )
+
+
+def stream_ontology_export(table_name: str, predicates: list, fmt: str) -> Response:
+    """Export all terms of an ontology statement table as TSV or CSV. Terms are read and converted in
+    chunks, and each chunk is sent as soon as it is ready, so memory use does not depend on the
+    size of the ontology.
+
+    :param table_name: ontology statement table
+    :param predicates: predicate IDs to include as columns
+    :param fmt: export format (tsv or csv)
+    :return: streaming Response
+    """
+    if fmt.lower() not in ["tsv", "csv"]:
+        return abort(400, "Unknown export format: " + fmt)
+    field_sep = request.args.get("sep", "|")
+    mt = "text/tab-separated-values"
+    delimiter = "\t"
+    if fmt.lower() == "csv":
+        delimiter = ","
+        mt = "text/comma-separated-values"
+
+    def generate():
+        fieldnames = None
+        for term_ids in iter_term_chunks(CONN, table_name):
+            data = gs.get_objects(
+                CONN, predicates, exclude_json=True, statement=table_name, term_ids=term_ids
+            )
+            data = order_terms(data, predicates, term_ids)
+            rows = terms2dicts(CONN, data, sep=field_sep, statement=table_name)
+            if not rows:
+                continue
+            output = io.StringIO()
+            header = False
+            if not fieldnames:
+                # Use the columns of the first chunk for the whole export
+                fieldnames = list(rows[0].keys())
+                header = True
+            writer = csv.DictWriter(
+                output, fieldnames, delimiter=delimiter, extrasaction="ignore", lineterminator="\n"
+            )
+            if header:
+                writer.writeheader()
+            writer.writerows(rows)
+            yield output.getvalue()
+
+    return Response(stream_with_context(generate()), mimetype=mt)
+
+
+def search_terms(table_name: str, search_text: str) -> list:
+    """Search an ontology statement table by label and synonym for typeahead, returning at most
+    SEARCH_LIMIT results. If the search index is enabled, results come from the index.
+
+    :param table_name: table to search in
+    :param search_text: text to search for
+    :return: search results
+    """
+    if SEARCH_INDEXES:
+        return SEARCH_INDEXES.search(table_name, search_text, limit=SEARCH_LIMIT)
+    return search(CONN, limit=SEARCH_LIMIT, search_text=search_text, statement=table_name)
+
+
+def configure(
+    db: str, table_config: str, readonly: bool = False, change_counters: bool = False
+) -> dict:
+    """Read the table configuration and configure the database for it.
+
+    The table TSV and every file it references are fingerprinted, and the fingerprints are stored
+    in the database with the configuration. On the next start, the database is only configured
+    again if a config table (table, column, datatype or rule) changed, a table was added or
+    removed, a changed data table is referenced by another table with from(), or a changed data
+    table has more than RELOAD_MAX_ROWS rows. Other data tables whose files changed are reloaded
+    on their own, and if nothing changed, the stored configuration is used as it is (or read from
+    the config files if it was not stored).
+
+    :param db: path to database
+    :param table_config: path to table TSV file
+    :param readonly: if True, the database is used as it is and opened read-only
+    :param change_counters: if True, install triggers that count the changes to each table (see
+                            catalog.install_change_triggers)
+    :return: CONFIG dict, with a sqlite3 connection to the database as "db"
+    :raises FileNotFoundError: if the table TSV or a file it references does not exist
+    """
+    start = time.perf_counter()
+    logger = logging.getLogger("cmi_pb_logger")
+    parser = Lark(grammar, parser="lalr", transformer=TreeToDict())
+    if readonly:
+        conn = connect_reader(os.path.abspath(db), immutable=True)
+        _, config = load_config_state(conn)
+        if config is None:
+            config = read_config_files(table_config, parser)
+        config["parser"] = parser
+        config["db"] = conn
+        return config
+
+    # sqlite3 is required for executescript used in load
+    conn = sqlite3.connect(db, check_same_thread=False)
+    stored, config = load_config_state(conn)
+    fingerprints = get_source_fingerprints(table_config, stored)
+    changed = get_changed_sources(fingerprints, stored)
+    # Tables that reference a changed table must be validated again, so these changes & large
+    # changed tables are loaded with the rest of the database
+    full = not stored or is_config_change(changed, fingerprints, stored)
+    if not full:
+        full = bool(get_referenced_tables(conn).intersection(changed))
+    reloads = {}
+    if not full:
+        for table_name in changed:
+            with open(fingerprints[table_name]["path"], "r") as f:
+                reloads[table_name] = parse_rows(f.read(), "tsv")
+            if len(reloads[table_name]) > RELOAD_MAX_ROWS:
+                full = True
+                break
+    if full:
+        config = read_config_files(table_config, parser)
+        config["db"] = conn
+        configure_db(config)
+        clear_stored_trees(get_render_store_path(db))
+        logger.info(f"Configured database in {time.perf_counter() - start:.2f}s")
+    else:
+        if config is None:
+            config = read_config_files(table_config, parser)
+        config["parser"] = parser
+        config["db"] = conn
+        for table_name, rows in reloads.items():
+            path = fingerprints[table_name]["path"]
+            result = replace_rows(config, table_name, rows)
+            logger.info(f"Reloaded {result['inserted']} rows into '{table_name}' from {path}")
+        if changed:
+            clear_stored_trees(get_render_store_path(db))
+        logger.info(
+            f"Database configuration checked in {time.perf_counter() - start:.2f}s "
+            f"({len(changed)} changed tables reloaded)"
+        )
+    save_config_state(conn, fingerprints, config)
+    if change_counters:
+        with conn:
+            install_change_triggers(conn)
+    return config
+
+
+def create_app(
+    db: str,
+    table_config: str,
+    config: dict = None,
+    debug: bool = False,
+    log_file: str = None,
+    render_cache_size: int = 0,
+    render_store: bool = False,
+    response_cache_size: int = 0,
+    **options,
+) -> Flask:
+    """Create a nanobot Flask app. Each app has its own database connections and caches, so apps
+    can be created in each worker process of a server (after forking) or several times in a test.
+
+    :param db: path to database
+    :param table_config: path to table TSV file
+    :param config: CONFIG dict that was already read for this database (see configure) - its
+                   connection is not used; if not provided, the configuration is read and the
+                   database configured (unless the readonly option is set)
+    :param debug: if True, run the app in debug mode (see run)
+    :param log_file: path to a log file - if not provided, logging will output to console
+    :param render_cache_size: max size in MB of the cache of rendered ontology term HTML
+    :param render_store: if True, keep rendered term rows and tree fragments in a sidecar database
+    :param response_cache_size: max size in MB of the cache of full GET responses
+    :param options: display options (see run) - options that are not provided or empty keep their
+                    defaults
+    :return: Flask app
+    """
+    start = time.perf_counter()
+    unknown = [k for k in options.keys() if k not in DEFAULT_OPTIONS]
+    if unknown:
+        raise TypeError("Unknown nanobot option(s): " + ", ".join(unknown))
+
+    state = AppState()
+    state.options = copy.deepcopy(DEFAULT_OPTIONS)
+    for k, v in options.items():
+        if v:
+            state.options[k] = v
+
+    app = Flask(__name__)
+    app.debug = debug
+    app.register_blueprint(BLUEPRINT)
+    app.url_map.strict_slashes = False
+    app.extensions["nanobot"] = state
+    # Pages change with the options & the code as well as the database, so ETags include the token
+    state.app_token = get_app_token(state.options)
+
+    # Set up logging to file
+    state.logger = logging.getLogger("cmi_pb_logger")
+    state.logger.setLevel(logging.DEBUG)
+    if log_file and not any(
+        isinstance(h, logging.FileHandler) and h.baseFilename == os.path.abspath(log_file)
+        for h in state.logger.handlers
+    ):
+        fh = logging.FileHandler(log_file)
+        fh.setLevel(logging.DEBUG)
+        fh.setFormatter(
+            logging.Formatter("%(asctime)s - %(levelname)s: %(message)s", "%Y-%m-%d %H:%M:%S")
+        )
+        state.logger.addHandler(fh)
+
+    readonly = state.options["readonly"]
+    if not config:
+        config = configure(
+            db, table_config, readonly=readonly, change_counters=state.options["change_counters"]
+        )
+        config["db"].close()
+    # Each request gets its own sqlite3 connection as "db" (see get_request_config)
+    state.config = {k: v for k, v in config.items() if k != "db"}
+
+    # All writes go through one writer connection, which also switches the database to WAL mode
+    abspath = os.path.abspath(db)
+    if not readonly:
+        state.writer = WriteQueue(state.config, connect_writer(abspath))
+
+    # SQLAlchemy connection required for sprocket/gizmos - requests check out their own read-only
+    # connections from the pool, while the caches share one connection for their version checks
+    engine = create_engine(
+        "sqlite:///" + abspath,
+        creator=lambda: connect_reader(abspath, immutable=readonly),
+        poolclass=QueuePool,
+        pool_size=10,
+        max_overflow=-1,
+    )
+    event.listen(engine, "before_cursor_execute", count_query)
+    app.teardown_appcontext(release_request_handles)
+    state.engine = engine
+    conn = SerializedConnection(engine.connect(), immutable=readonly, engine=engine)
+    state.conn = conn
+    state.catalog = SchemaCatalog(conn, parser=state.config["parser"])
+    state.version = DatabaseVersion(conn, abspath)
+    state.labels = LabelCache(conn)
+    state.metadata = OntologyMetadataCache(conn)
+    if render_cache_size:
+        state.render_cache = RenderCache(conn, render_cache_size * 1024 * 1024)
+    if render_store:
+        state.render_store = RenderStore(
+            get_render_store_path(abspath),
+            conn,
+            lambda table_name, term_ids: state.labels.get_labels(table_name, term_ids),
+        )
+    if response_cache_size:
+        state.response_cache = ResponseCache(response_cache_size * 1024 * 1024)
+    if state.options["search_index"]:
+        state.search_indexes = SearchIndexes(conn, synonym=state.options["synonym"])
+    if state.options["subclass_closure"]:
+        state.closure_tables = ClosureTables(conn)
+    if state.options["class_hierarchy"]:
+        state.hierarchies = ClassHierarchies(conn)
+    state.logger.info(f"Started nanobot in {time.perf_counter() - start:.2f}s")
+    return app
+
+
+def load_rows(db: str, table_config: str, table_name: str, path: str, fmt: str = None) -> dict:
+    """Validate the rows in a TSV or JSON file and insert them into a table in a single
+    transaction, without running the Flask app.
+
+    :param db: path to database
+    :param table_config: path to table TSV file
+    :param table_name: table to insert rows into
+    :param path: path to TSV file (with headers) or JSON file (array of objects) of rows
+    :param fmt: format of the file (tsv or json) - if not provided, this is taken from the extension
+    :return: import results - counts, timing and per-row row numbers & messages
+    """
+    if not fmt:
+        fmt = os.path.splitext(path)[1].lstrip(".") or "tsv"
+    with open(path, "r") as f:
+        rows = parse_rows(f.read(), fmt)
+    config = configure(db, table_config)
+    try:
+        return import_rows(config, table_name, rows)
+    finally:
+        config["db"].close()
+
+
 def run(
     db,
     table_config,
     base_ontology=None,
     cgi_path=None,
+    change_counters: bool = False,
+    class_hierarchy: bool = False,
+    debug: bool = False,
     default_params=None,
     default_table=None,
     flask_host="127.0.0.1",
@@ -1758,17 +2598,30 @@ def run(
     import_table=None,
     log_file=None,
     max_children: int = 20,
+    readonly: bool = False,
+    render_cache_size: int = 0,
+    render_store: bool = False,
+    response_cache_size: int = 0,
+    search_index: bool = False,
+    subclass_closure: bool = False,
     synonym: str = "IAO:0000118",
     title: str = "Terminology",
     tree_predicates: list = None,
+    workers: int = 0,
 ):
     """Run nanobot with supplied options.
 
     :param db: path to database
     :param table_config: path to table TSV file
     :param base_ontology: the name of the LDTab table for the base ontology of this project
+    :param class_hierarchy: if True, render the tree view for classes from an in-memory class
+                            hierarchy for each ontology table, loaded on first use
     :param cgi_path: path to the script to use as SCRIPT_NAME environment variable
                      - this will run the app in CGI mode
+    :param change_counters: if True, install triggers in the database that count the rows written
+                            to each table, so that the caches only reload the tables that changed
+    :param debug: if True, run the Flask app in debug mode and report the number of queries run for
+                  each page in the log and the X-Query-Count response header
     :param default_params: the query parameters to use for the default_table redirection
     :param default_table: the name of the table to redirect to from index (if None, will show index)
     :param flask_host: host to run the Flask app on
@@ -1778,52 +2631,62 @@ def run(
                          columns specified by https://github.com/ontodev/gadget
     :param log_file: path to a log file - if not provided, logging will output to console
     :param max_children: max number of child nodes to display in tree view
+    :param readonly: if True, serve a database that never changes (e.g. a released snapshot): the
+                     database is not configured, it is opened as immutable, POST requests are
+                     rejected, and the caches never check for changes
+    :param render_cache_size: max size in MB of the cache of rendered ontology term HTML - if 0,
+                              terms are rendered on every request
+    :param render_store: if True, keep rendered term rows and tree fragments in a sidecar database
+                         next to the database, shared by all processes and kept up to date in the
+                         background
+    :param response_cache_size: max size in MB of the cache of full GET responses - if 0, pages
+                                are built on every request
+    :param search_index: if True, serve typeahead searches from an in-memory label & synonym index
+                         for each ontology table, built on the first search
+    :param subclass_closure: if True, resolve subClassOf queries from an in-memory transitive closure
+                             of the subClassOf hierarchy for each ontology table, built on the first
+                             query
     :param synonym: ID for the annotation property to use as synonym in search table (IAO:0000118)
     :param title: project title to display in header
     :param tree_predicates: ordered list of predicates to display in tree browser - all remaining
                             predicates can be displayed in alphabetical order after the sorted
                             predicates using '*'
+    :param workers: if greater than 0, serve the app from this many forked worker processes that
+                    share the listening socket, each with its own connections and caches
     """
-    global CONFIG, CONN, LOGGER, OPTIONS
-
-    # Override default options
-    for k in OPTIONS.keys():
-        v = locals().get(k)
-        if v:
-            OPTIONS[k] = v
-
-    app = Flask(__name__)
-    app.register_blueprint(BLUEPRINT)
-    app.url_map.strict_slashes = False
-
-    # Set up logging to file
-    LOGGER = logging.getLogger("cmi_pb_logger")
-    LOGGER.setLevel(logging.DEBUG)
-    if log_file:
-        fh = logging.FileHandler(log_file)
-        fh.setLevel(logging.DEBUG)
-        fh.setFormatter(
-            logging.Formatter("%(asctime)s - %(levelname)s: %(message)s", "%Y-%m-%d %H:%M:%S")
-        )
-        LOGGER.addHandler(fh)
-
-    # sqlite3 is required for executescript used in load
-    setup_conn = sqlite3.connect(db, check_same_thread=False)
-    CONFIG = read_config_files(table_config, Lark(grammar, parser="lalr", transformer=TreeToDict()))
-    CONFIG["db"] = setup_conn
-    configure_db(CONFIG)
-
-    # SQLAlchemy connection required for sprocket/gizmos
-    abspath = os.path.abspath(db)
-    db_url = "sqlite:///" + abspath + "?check_same_thread=False"
-    engine = create_engine(db_url)
-    CONN = engine.connect()
-
+    args = locals()
+    options = {k: args[k] for k in DEFAULT_OPTIONS.keys()}
+    app_args = {
+        "debug": debug,
+        "log_file": log_file,
+        "render_cache_size": render_cache_size,
+        "render_store": render_store,
+        "response_cache_size": response_cache_size,
+    }
+
+    if workers and not cgi_path:
+        # Configure the database once, then create an app in each worker after it is forked
+        config = configure(db, table_config, readonly=readonly, change_counters=change_counters)
+        config["db"].close()
+
+        def create_worker_app() -> Flask:
+            app = create_app(db, table_config, config=config, **app_args, **options)
+            if app.extensions["nanobot"].render_store:
+                threading.Thread(target=rebuild_render_store, args=(app,), daemon=True).start()
+            return app
+
+        serve_prefork(create_worker_app, flask_host, flask_port, workers)
+        return
+
+    app = create_app(db, table_config, **app_args, **options)
+    state = app.extensions["nanobot"]
     if cgi_path:
         os.environ["SCRIPT_NAME"] = cgi_path
         from wsgiref.handlers import CGIHandler
 
         CGIHandler().run(app)
     else:
-        LOGGER.error(os.path.abspath(os.path.join(os.path.dirname(__file__), "templates")))
+        if state.render_store:
+            threading.Thread(target=rebuild_render_store, args=(app,), daemon=True).start()
+        state.logger.error(os.path.abspath(os.path.join(os.path.dirname(__file__), "templates")))
         app.run(host=flask_host, port=flask_port)
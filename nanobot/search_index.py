@@ -0,0 +1,258 @@
+import logging
+import sqlite3
+import threading
+import traceback
+
+from sqlalchemy.engine import Connection
+from typing import Dict, List, Optional, Tuple
+
+from .catalog import get_data_version, get_table_fingerprint
+
+LOGGER = logging.getLogger("cmi_pb_logger")
+
+
+class SearchIndex:
+    """Bounded label and synonym search for one ontology statement table.
+
+    The index is an in-memory SQLite database holding the normalised label and synonyms of every
+    term. Matches are ranked exact match first, then prefix matches, then substring matches, and
+    each search stops as soon as the limit is reached. When FTS5 with the trigram tokenizer is
+    available, substring matches use it instead of scanning the index.
+
+    The index is built by the first search. When the statement table changes, a new index is built
+    in the background and searches are answered from the old index until it is ready.
+    """
+
+    def __init__(self, conn: Connection, table_name: str, synonym: str = "IAO:0000118"):
+        """
+        :param conn: database connection to load labels and synonyms from
+        :param table_name: ontology statement table
+        :param synonym: predicate ID of the synonym annotation property
+        """
+        self.conn = conn
+        self.table_name = table_name
+        self.synonym = synonym
+        self.data_version = None  # type: Optional[int]
+        self.fingerprint = None  # type: Optional[Tuple[int, int, int]]
+        self.index = None  # type: Optional[sqlite3.Connection]
+        self.use_fts = False
+        # Background thread that is rebuilding the index, if any
+        self.builder = None  # type: Optional[threading.Thread]
+        # Held while the index is queried or replaced
+        self.lock = threading.Lock()
+        # Held while checking for changes & starting a build
+        self.refresh_lock = threading.Lock()
+
+    def build(self):
+        """Build (or rebuild) the index from the statement table."""
+        index = sqlite3.connect(":memory:", check_same_thread=False)
+        index.execute(
+            """CREATE TABLE entry (
+                term_id TEXT,
+                label TEXT,
+                value TEXT,
+                property TEXT,
+                norm TEXT
+            )"""
+        )
+        results = self.conn.execute(
+            f"""SELECT s.subject, s.predicate, s.object, l.object AS label
+            FROM "{self.table_name}" s
+            LEFT JOIN "{self.table_name}" l
+                ON l.subject = s.subject AND l.predicate = 'rdfs:label'
+            WHERE s.predicate IN ('rdfs:label', :synonym)
+              AND s.datatype NOT IN ('_JSON', '_IRI')
+              AND s.subject NOT LIKE '<%%'""",
+            synonym=self.synonym,
+        )
+        rows = []
+        seen = set()
+        for res in results:
+            key = (res["subject"], res["predicate"], res["object"])
+            if key in seen:
+                # A term with several labels is joined once per label
+                continue
+            seen.add(key)
+            rows.append(
+                (
+                    res["subject"],
+                    res["label"],
+                    res["object"],
+                    res["predicate"],
+                    res["object"].casefold(),
+                )
+            )
+        index.executemany("INSERT INTO entry VALUES (?, ?, ?, ?, ?)", rows)
+        index.execute("CREATE INDEX entry_norm_idx ON entry(norm)")
+
+        use_fts = False
+        try:
+            index.execute(
+                """CREATE VIRTUAL TABLE entry_fts USING fts5(
+                    norm, content='entry', tokenize='trigram'
+                )"""
+            )
+            index.execute("INSERT INTO entry_fts(rowid, norm) SELECT rowid, norm FROM entry")
+            use_fts = True
+        except sqlite3.OperationalError:
+            # FTS5 or the trigram tokenizer is not available, fall back to LIKE
+            pass
+        index.commit()
+
+        with self.lock:
+            old_index = self.index
+            self.index = index
+            self.use_fts = use_fts
+        if old_index:
+            old_index.close()
+
+    def refresh(self):
+        """Build the index if it has not been built, or start rebuilding it in the background if
+        the statement table has changed since it was built."""
+        with self.refresh_lock:
+            data_version = get_data_version(self.conn)
+            if self.index and data_version == self.data_version:
+                return
+            fingerprint = get_table_fingerprint(self.conn, self.table_name)
+            if self.index and fingerprint == self.fingerprint:
+                self.data_version = data_version
+                return
+            if not self.index:
+                # Nothing to search yet
+                self.build()
+                self.data_version = data_version
+                self.fingerprint = fingerprint
+                return
+            if not self.builder:
+                self.builder = threading.Thread(
+                    target=self._rebuild, args=(data_version, fingerprint), daemon=True
+                )
+                self.builder.start()
+
+    def _rebuild(self, data_version: int, fingerprint: Tuple[int, int, int]):
+        try:
+            self.build()
+        except Exception:
+            LOGGER.error(traceback.format_exc())
+            with self.refresh_lock:
+                self.builder = None
+            return
+        with self.refresh_lock:
+            # Changes made while building are picked up by the next refresh
+            self.data_version = data_version
+            self.fingerprint = fingerprint
+            self.builder = None
+
+    def search(self, search_text: str, limit: int = 30) -> List[dict]:
+        """Search for terms by label or synonym.
+
+        :param search_text: text to search for
+        :param limit: max number of results to return
+        :return: list of search results (id, label, short_label, synonym, property & order)
+        """
+        self.refresh()
+        with self.lock:
+            text = search_text.strip().casefold()
+            matches = []
+            matched_ids = set()
+            for query, params in self._get_queries(text):
+                if len(matches) >= limit:
+                    break
+                for row in self.index.execute(query, params + [limit * 2]):
+                    if row[0] in matched_ids:
+                        continue
+                    matched_ids.add(row[0])
+                    matches.append(row)
+                    if len(matches) >= limit:
+                        break
+
+        results = []
+        for i, (term_id, label, value, prop) in enumerate(matches):
+            short_label = label or term_id
+            synonym = value if prop != "rdfs:label" else None
+            display = short_label
+            if synonym:
+                display = f"{short_label} - {synonym}"
+            results.append(
+                {
+                    "id": term_id,
+                    "label": display,
+                    "short_label": short_label,
+                    "synonym": synonym,
+                    "property": prop,
+                    "order": i + 1,
+                }
+            )
+        return results
+
+    def _get_queries(self, text: str) -> List[Tuple[str, list]]:
+        select = "SELECT term_id, label, value, property FROM entry"
+        if not text:
+            return [(f"{select} ORDER BY norm LIMIT ?", [])]
+        # Upper bound for a prefix range scan on the norm index
+        upper = text + "\U0010ffff"
+        queries = [
+            (f"{select} WHERE norm = ? ORDER BY property != 'rdfs:label' LIMIT ?", [text]),
+            (
+                f"""{select} WHERE norm > ? AND norm < ?
+                ORDER BY length(norm), norm LIMIT ?""",
+                [text, upper],
+            ),
+        ]
+        if self.use_fts and len(text) >= 3:
+            phrase = '"' + text.replace('"', '""') + '"'
+            queries.append(
+                (
+                    f"""{select} WHERE rowid IN (SELECT rowid FROM entry_fts WHERE entry_fts MATCH ?)
+                    ORDER BY length(norm), norm LIMIT ?""",
+                    [phrase],
+                )
+            )
+        else:
+            escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            queries.append(
+                (
+                    f"""{select} WHERE norm LIKE ? ESCAPE '\\'
+                    ORDER BY length(norm), norm LIMIT ?""",
+                    ["%" + escaped + "%"],
+                )
+            )
+        return queries
+
+
+class SearchIndexes:
+    """Lazily created search indexes for all ontology statement tables."""
+
+    def __init__(self, conn: Connection, synonym: str = "IAO:0000118"):
+        """
+        :param conn: database connection to load labels and synonyms from
+        :param synonym: predicate ID of the synonym annotation property
+        """
+        self.conn = conn
+        self.synonym = synonym
+        self.indexes = {}  # type: Dict[str, SearchIndex]
+        self.lock = threading.Lock()
+
+    def get(self, table_name: str) -> SearchIndex:
+        """Get the search index for an ontology statement table, creating it if needed. The index
+        itself is built on the first search.
+
+        :param table_name: ontology statement table
+        :return: search index
+        """
+        with self.lock:
+            index = self.indexes.get(table_name)
+            if not index:
+                index = SearchIndex(self.conn, table_name, synonym=self.synonym)
+                self.indexes[table_name] = index
+            return index
+
+    def search(self, table_name: str, search_text: str, limit: int = 30) -> List[dict]:
+        """Search for terms by label or synonym in an ontology statement table.
+
+        :param table_name: ontology statement table
+        :param search_text: text to search for
+        :param limit: max number of results to return
+        :return: list of search results
+        """
+        return self.get(table_name).search(search_text, limit=limit)
@@ -0,0 +1,81 @@
+import logging
+import os
+import signal
+import socket
+import traceback
+
+from flask import Flask
+from typing import Callable, Dict
+from werkzeug.serving import make_server
+
+LOGGER = logging.getLogger("cmi_pb_logger")
+
+
+def serve_prefork(create_app: Callable[[], Flask], host: str, port: int, workers: int):
+    """Serve an app from several worker processes that share one listening socket. The socket is
+    opened before forking, and each worker creates its own app (and so its own database
+    connections) after the fork. Workers that exit unexpectedly are replaced.
+
+    :param create_app: function that creates the app, called in each worker
+    :param host: host to listen on
+    :param port: port to listen on
+    :param workers: number of worker processes
+    """
+    if not hasattr(os, "fork"):
+        raise RuntimeError("Serving with several workers requires os.fork")
+
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+    LOGGER.info(f"Listening on {host}:{port} with {workers} workers")
+
+    children = {}  # type: Dict[int, int]
+    stopping = False
+
+    def start_worker(worker_id: int):
+        pid = os.fork()
+        if pid:
+            children[pid] = worker_id
+            return
+        # In the worker: restore default signal handling & serve until terminated
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        code = 0
+        try:
+            app = create_app()
+            server = make_server(host, port, app, threaded=True, fd=sock.fileno())
+            server.serve_forever()
+        except Exception:
+            LOGGER.error(traceback.format_exc())
+            code = 1
+        finally:
+            os._exit(code)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children.keys()):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for i in range(workers):
+        start_worker(i)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        worker_id = children.pop(pid, None)
+        if worker_id is not None and not stopping:
+            LOGGER.error(f"Worker {worker_id} (pid {pid}) exited with status {status}, restarting")
+            start_worker(worker_id)
+    sock.close()
@@ -0,0 +1,225 @@
+import csv
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+
+from typing import Dict, List, Optional, Set, Tuple
+
+from .catalog import CONFIG_TABLES
+
+LOGGER = logging.getLogger("cmi_pb_logger")
+
+
+# Types of tables in the table TSV that define the schema - when one of these changes, the whole
+# database must be configured again
+CONFIG_SOURCE_TYPES = CONFIG_TABLES + ["rule"]
+# Structure of a column whose values must be in a column of another table
+FROM_PATTERN = re.compile(r"from\(\s*([^.\s)]+)\.")
+# Size of the chunks that source files are hashed in
+HASH_CHUNK_SIZE = 1024 * 1024
+# Max number of rows in a changed data table to reload on its own - larger tables are loaded with
+# the rest of the database, which is faster than validating & inserting them one row at a time
+RELOAD_MAX_ROWS = 10000
+# Tables that the configuration state is stored in
+STATE_TABLES = ["nanobot_config", "nanobot_source"]
+
+
+def get_changed_sources(current: Dict[str, dict], stored: Dict[str, dict]) -> List[str]:
+    """Get the tables whose sources changed since the fingerprints were stored, including tables
+    that were added or removed.
+
+    :param current: current fingerprints - dict of table name -> fingerprint
+    :param stored: stored fingerprints - dict of table name -> fingerprint
+    :return: sorted list of changed table names
+    """
+    changed = []
+    for table_name in set(current.keys()).union(stored.keys()):
+        cur = current.get(table_name)
+        old = stored.get(table_name)
+        if not cur or not old or not cur["sha256"]:
+            changed.append(table_name)
+        elif (cur["path"], cur["type"], cur["sha256"]) != (old["path"], old["type"], old["sha256"]):
+            changed.append(table_name)
+    return sorted(changed)
+
+
+def get_file_fingerprint(path: str, previous: Optional[dict] = None) -> dict:
+    """Get the fingerprint of a source file: its modification time, size and content hash. The
+    file is only read when its modification time or size differ from the previous fingerprint.
+
+    :param path: path to file
+    :param previous: previous fingerprint of the file, if any
+    :return: fingerprint - dict with mtime, size and sha256 (None if the file does not exist)
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return {"mtime": None, "size": None, "sha256": None}
+    if (
+        previous
+        and previous.get("sha256")
+        and previous.get("mtime") == st.st_mtime
+        and previous.get("size") == st.st_size
+    ):
+        return {"mtime": st.st_mtime, "size": st.st_size, "sha256": previous["sha256"]}
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return {"mtime": st.st_mtime, "size": st.st_size, "sha256": h.hexdigest()}
+
+
+def get_referenced_tables(conn: sqlite3.Connection) -> Set[str]:
+    """Get the tables that columns of other tables reference with from() - when one of these
+    changes, the tables that reference it must be validated again.
+
+    :param conn: sqlite3 connection to the database
+    :return: set of table names
+    """
+    res = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'column'"
+    ).fetchone()
+    if not res:
+        return set()
+    referenced = set()
+    for table_name, structure in conn.execute('SELECT "table", "structure" FROM "column"'):
+        for other in FROM_PATTERN.findall(structure or ""):
+            if other != table_name:
+                referenced.add(other)
+    return referenced
+
+
+def get_source_fingerprints(table_config: str, stored: Dict[str, dict]) -> Dict[str, dict]:
+    """Get the fingerprints of the table TSV and of every file it references.
+
+    :param table_config: path to table TSV file
+    :param stored: stored fingerprints, used to skip hashing files that were not modified
+    :return: dict of table name -> fingerprint with path, type, mtime, size and sha256
+    :raises FileNotFoundError: if the table TSV or a file it references does not exist
+    """
+    sources = {"table": {"path": table_config, "type": "table"}}
+    with open(table_config, "r") as f:
+        for row in csv.DictReader(f, delimiter="\t", quoting=csv.QUOTE_NONE):
+            table_name = row.get("table")
+            path = row.get("path")
+            if not table_name or not path or table_name == "table":
+                continue
+            sources[table_name] = {"path": path, "type": row.get("type") or ""}
+    fingerprints = {}
+    for table_name, source in sources.items():
+        fingerprint = get_file_fingerprint(source["path"], previous=stored.get(table_name))
+        if not fingerprint["sha256"]:
+            raise FileNotFoundError(
+                f"The file for table '{table_name}' does not exist: {source['path']}"
+            )
+        fingerprint.update(source)
+        fingerprints[table_name] = fingerprint
+    return fingerprints
+
+
+def is_config_change(
+    changed: List[str], current: Dict[str, dict], stored: Dict[str, dict]
+) -> bool:
+    """Check if changes to sources require the whole database to be configured again, i.e. if a
+    table was added or removed or a config table (table, column, datatype or rule) changed.
+
+    :param changed: changed table names (see get_changed_sources)
+    :param current: current fingerprints
+    :param stored: stored fingerprints
+    :return: True if the database must be configured again
+    """
+    for table_name in changed:
+        if table_name not in current or table_name not in stored:
+            return True
+        if current[table_name]["type"] in CONFIG_SOURCE_TYPES:
+            return True
+        if stored[table_name]["type"] in CONFIG_SOURCE_TYPES:
+            return True
+    return False
+
+
+def load_config_state(conn: sqlite3.Connection) -> Tuple[Dict[str, dict], Optional[dict]]:
+    """Load the source fingerprints and the configuration stored by save_config_state.
+
+    :param conn: sqlite3 connection to the database
+    :return: dict of table name -> fingerprint, and the stored CONFIG dict (without "db" and
+             "parser") or None if no configuration could be loaded
+    """
+    tables = {
+        r[0]
+        for r in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name IN (?, ?)",
+            STATE_TABLES,
+        )
+    }
+    if set(STATE_TABLES) != tables:
+        return {}, None
+    fingerprints = {}
+    for table_name, path, source_type, mtime, size, sha256 in conn.execute(
+        "SELECT * FROM nanobot_source"
+    ):
+        fingerprints[table_name] = {
+            "path": path,
+            "type": source_type,
+            "mtime": mtime,
+            "size": size,
+            "sha256": sha256,
+        }
+    res = conn.execute("SELECT config FROM nanobot_config").fetchone()
+    config = None
+    if res and res[0] is not None:
+        try:
+            config = json.loads(res[0])
+        except ValueError:
+            LOGGER.warning("Stored configuration cannot be loaded, reading configuration files")
+            return fingerprints, None
+        if not isinstance(config, dict):
+            LOGGER.warning("Stored configuration is not valid, reading configuration files")
+            return fingerprints, None
+    return fingerprints, config
+
+
+def save_config_state(conn: sqlite3.Connection, fingerprints: Dict[str, dict], config: dict):
+    """Store the source fingerprints and the configuration that the database was configured with,
+    so that the next start can skip configuring the database if no source changed.
+
+    :param conn: sqlite3 connection to the database
+    :param fingerprints: dict of table name -> fingerprint
+    :param config: CONFIG dict - "db" and "parser" are not stored (the parser is created again on
+                   each start)
+    """
+    stored = {k: v for k, v in config.items() if k not in ["db", "parser"]}
+    try:
+        data = json.dumps(stored)
+        if json.loads(data) != stored:
+            # e.g. tuples, which would be loaded as lists
+            data = None
+    except (TypeError, ValueError):
+        data = None
+    if data is None:
+        LOGGER.info("Configuration cannot be stored as JSON, configuration files are read on start")
+    with conn:
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS nanobot_source (
+                "table" TEXT PRIMARY KEY,
+                path TEXT,
+                type TEXT,
+                mtime REAL,
+                size INTEGER,
+                sha256 TEXT
+            )"""
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS nanobot_config (config TEXT)")
+        conn.execute("DELETE FROM nanobot_source")
+        conn.execute("DELETE FROM nanobot_config")
+        conn.executemany(
+            "INSERT INTO nanobot_source VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (t, f["path"], f["type"], f["mtime"], f["size"], f["sha256"])
+                for t, f in fingerprints.items()
+            ],
+        )
+        conn.execute("INSERT INTO nanobot_config VALUES (?)", (data,))
@@ -0,0 +1,101 @@
+from flask import current_app, g
+from logging import Logger
+from sqlalchemy.engine import Connection, Engine
+from typing import Optional
+from werkzeug.local import LocalProxy
+
+from .cache import LabelCache, RenderCache, ResponseCache, ValidationCache
+from .catalog import DatabaseVersion, SchemaCatalog
+from .db import SerializedConnection, WriteQueue
+from .hierarchy import ClassHierarchies, ClosureTables
+from .ontology import OntologyMetadataCache
+from .render_store import RenderStore
+from .search_index import SearchIndexes
+
+
+class AppState:
+    """All the state of one nanobot app: configuration, database connections and caches.
+
+    The state is created by create_app and stored in app.extensions["nanobot"], so that several
+    apps (or several forked worker processes) never share connections or caches. Within an app,
+    the caches share one serialized connection for their version checks, while each request gets
+    its own read-only connections from the engine pool (see get_request_conn and
+    get_request_config). All writes go through the writer of the process.
+    """
+
+    def __init__(self):
+        self.app_token = ""  # type: str
+        self.catalog = None  # type: Optional[SchemaCatalog]
+        self.closure_tables = None  # type: Optional[ClosureTables]
+        self.config = None  # type: Optional[dict]
+        self.conn = None  # type: Optional[SerializedConnection]
+        self.engine = None  # type: Optional[Engine]
+        self.hierarchies = None  # type: Optional[ClassHierarchies]
+        self.labels = None  # type: Optional[LabelCache]
+        self.logger = None  # type: Optional[Logger]
+        self.metadata = None  # type: Optional[OntologyMetadataCache]
+        self.options = {}  # type: dict
+        self.render_cache = None  # type: Optional[RenderCache]
+        self.render_store = None  # type: Optional[RenderStore]
+        self.response_cache = None  # type: Optional[ResponseCache]
+        self.search_indexes = None  # type: Optional[SearchIndexes]
+        self.validations = ValidationCache()
+        self.version = None  # type: Optional[DatabaseVersion]
+        self.writer = None  # type: Optional[WriteQueue]
+
+
+def get_request_config() -> dict:
+    """Get the CONFIG dict for the current request (or app context), with its own read-only
+    sqlite3 connection from the engine pool as "db", so that validation in one request never runs
+    on the connection of another. Writes are submitted to the writer instead.
+
+    :return: CONFIG dict
+    """
+    if "nanobot_config" not in g:
+        config = dict(get_state().config)
+        config["db"] = get_state().engine.raw_connection()
+        g.nanobot_config = config
+    return g.nanobot_config
+
+
+def get_request_conn() -> Connection:
+    """Get the SQLAlchemy connection for the current request (or app context), checked out from
+    the engine pool on first use.
+
+    :return: connection
+    """
+    if "nanobot_conn" not in g:
+        g.nanobot_conn = get_state().engine.connect()
+    return g.nanobot_conn
+
+
+def get_state() -> AppState:
+    """Get the state of the current app.
+
+    :return: app state
+    """
+    return current_app.extensions["nanobot"]
+
+
+def release_request_handles(exc):
+    """Return the connections of the current request (or app context) to the engine pool. This is
+    registered as a teardown_appcontext function.
+
+    :param exc: exception that ended the request, if any
+    """
+    config = g.pop("nanobot_config", None)
+    if config:
+        config["db"].close()
+    conn = g.pop("nanobot_conn", None)
+    if conn:
+        conn.close()
+
+
+def state_proxy(name: str) -> LocalProxy:
+    """Get a proxy to an attribute of the state of the current app, resolved on each use.
+
+    :param name: name of AppState attribute
+    :return: proxy
+    """
+    return LocalProxy(lambda: getattr(get_state(), name))
+
@@ -0,0 +1,128 @@
+import importlib.util
+import random
+import threading
+
+import pytest
+
+
+def has_module(name: str) -> bool:
+    spec = importlib.util.find_spec(name)
+    return spec is not None and spec.origin is not None
+
+
+# The app is only tested with the real cmi_pb_script, gadget & sprocket packages
+pytestmark = pytest.mark.skipif(
+    not all(has_module(m) for m in ["cmi_pb_script", "gadget", "sprocket"]),
+    reason="cmi_pb_script, gadget and sprocket are required to create the app",
+)
+
+# Fixture tables, with "|" between the cells of each row
+TABLES = {
+    "table": """table|path|type|description
+table|{dir}/table.tsv|table|All of the tables in this project.
+column|{dir}/column.tsv|column|Columns for all of the tables.
+datatype|{dir}/datatype.tsv|datatype|Datatypes for all of the columns
+sample|{dir}/sample.tsv||Samples
+ontology|{dir}/ontology.tsv||LDTab statements""",
+    "column": """table|column|nulltype|datatype|structure|description
+table|table||label|primary|name of this table
+table|path||line|unique|path to the TSV file for this table
+table|type|empty|table_type||type of this table
+table|description|empty|text||a description of this table
+column|table||label|from(table.table)|the table that this column belongs to
+column|column||label||the name of this column
+column|nulltype|empty|word|from(datatype.datatype)|the datatype for NULL values
+column|datatype||word|from(datatype.datatype)|the datatype for this column
+column|structure|empty|label||schema information for this column
+column|description|empty|text||a description of this column
+datatype|datatype||word|primary|the name of this datatype
+datatype|parent|empty|word|tree(datatype)|the parent datatype
+datatype|transform|empty|word||a transformation to apply
+datatype|condition|empty|line||the method for testing the datatype
+datatype|structure|empty|line||schema information for this datatype
+datatype|description|empty|text||a description of this datatype
+datatype|SQL type|empty|line||the SQL type for this datatype
+datatype|HTML type|empty|line||the HTML type for this datatype
+sample|id||word|primary|the ID of this sample
+sample|label|empty|label||the label of this sample
+ontology|assertion||text||
+ontology|retraction||text||
+ontology|graph||text||
+ontology|subject||text||
+ontology|predicate||text||
+ontology|object||text||
+ontology|datatype||text||
+ontology|annotation|empty|text||""",
+    "datatype": r"""datatype|parent|transform|condition|structure|description|SQL type|HTML type
+text|||any||any text|TEXT|textarea
+empty|text||equals('')||the empty string|NULL|
+line|text||exclude(/\n/)||one line of text||input
+label|line||match(/[^\s]+.+[^\s]/)||text without surrounding whitespace||
+word|label||exclude(/\W/)||a single word||
+table_type|word||in('table', 'column', 'datatype')||a table type||search""",
+    "sample": "id|label\n" + "\n".join(f"s{i}|Sample {i}" for i in range(1, 11)),
+    "ontology": """assertion|retraction|graph|subject|predicate|object|datatype|annotation
+1|0|ex|ex:A|rdf:type|owl:Class|_IRI|
+1|0|ex|ex:A|rdfs:label|thing A|xsd:string|
+1|0|ex|ex:B|rdf:type|owl:Class|_IRI|
+1|0|ex|ex:B|rdfs:label|thing B|xsd:string|
+1|0|ex|ex:B|rdfs:subClassOf|ex:A|_IRI|
+1|0|ex|ex:C|rdf:type|owl:Class|_IRI|
+1|0|ex|ex:C|rdfs:label|thing C|xsd:string|
+1|0|ex|ex:C|rdfs:subClassOf|ex:B|_IRI|""",
+}
+
+URLS = [
+    "/sample",
+    "/sample?offset=5",
+    "/sample/row/1?view=form",
+    "/sample/row/3?view=form",
+    "/ontology",
+    "/ontology/ex:B",
+    "/ontology/ex:C",
+    "/ontology/ex:A/children",
+]
+
+
+@pytest.fixture
+def app(tmp_path):
+    from nanobot.run import create_app
+
+    for table_name, rows in TABLES.items():
+        with open(tmp_path / f"{table_name}.tsv", "w") as f:
+            for row in rows.format(dir=tmp_path).split("\n"):
+                f.write(row.replace("|", "\t") + "\n")
+    return create_app(str(tmp_path / "test.db"), str(tmp_path / "table.tsv"))
+
+
+def test_concurrent_requests(app):
+    # Build each page once to compare the concurrent responses with
+    with app.test_client() as client:
+        expected = {}
+        for url in URLS:
+            response = client.get(url)
+            assert response.status_code == 200, url
+            expected[url] = response.data
+
+    errors = []
+    barrier = threading.Barrier(8)
+
+    def get_pages(seed: int):
+        urls = URLS * 5
+        random.Random(seed).shuffle(urls)
+        barrier.wait(timeout=30)
+        with app.test_client() as client:
+            for url in urls:
+                response = client.get(url)
+                if response.status_code != 200:
+                    errors.append(f"{url}: status {response.status_code}")
+                elif response.data != expected[url]:
+                    errors.append(f"{url}: different response")
+
+    threads = [threading.Thread(target=get_pages, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=120)
+    assert not any(t.is_alive() for t in threads)
+    assert not errors
@@ -0,0 +1,101 @@
+import json
+import sqlite3
+
+import pytest
+
+import nanobot.bulk as bulk
+
+
+def get_db():
+    conn = sqlite3.connect(":memory:")
+    conn.execute('CREATE TABLE "sample" (row_number INTEGER, "id" TEXT, "a" TEXT, "b" TEXT)')
+    conn.execute(
+        """CREATE TABLE "sample_view" (
+            row_number INTEGER, "a" TEXT, "a_meta" TEXT, "b" TEXT, "b_meta" TEXT
+        )"""
+    )
+    # "b" is invalid, so it is stored as NULL with the entered value in its meta column
+    conn.execute(
+        'INSERT INTO "sample_view" VALUES (1, ?, NULL, NULL, ?)',
+        ("old", json.dumps({"value": "not a number", "valid": False, "messages": []})),
+    )
+    return conn
+
+
+def test_get_rows_keeps_invalid_values():
+    rows = bulk.get_rows(get_db(), "sample", [1])
+    assert rows == {1: {"a": "old", "b": "not a number"}}
+
+
+def test_update_rows_keeps_invalid_value_in_other_column(monkeypatch):
+    updated = {}
+
+    def validate_row(config, table_name, row, row_number=None):
+        return row
+
+    def update_row(config, table_name, row, row_number):
+        updated[row_number] = {c: v["value"] for c, v in row.items()}
+
+    monkeypatch.setattr(bulk, "validate_row", validate_row)
+    monkeypatch.setattr(bulk, "update_row", update_row)
+    result = bulk.update_rows(
+        {"db": get_db()}, "sample", [{"row_number": 1, "values": {"a": "new"}}]
+    )
+    assert result["updated"] == 1
+    assert updated == {1: {"a": "new", "b": "not a number"}}
+
+
+def test_import_rows_validates_against_earlier_rows(monkeypatch):
+    inserted = []
+
+    def validate_row(config, table_name, row, existing_row=False):
+        # Primary key check against the rows that are already in the table
+        valid = row["id"] not in [r["id"]["value"] for r in inserted]
+        messages = [] if valid else [{"level": "error", "message": "duplicate primary key"}]
+        return {c: {"value": v, "valid": valid, "messages": messages} for c, v in row.items()}
+
+    def insert_new_row(config, table_name, row):
+        inserted.append(row)
+        return len(inserted)
+
+    monkeypatch.setattr(bulk, "validate_row", validate_row)
+    monkeypatch.setattr(bulk, "insert_new_row", insert_new_row)
+    result = bulk.import_rows({"db": get_db()}, "sample", [{"id": "1"}, {"id": "1"}])
+    assert result["inserted"] == 2
+    assert result["errors"] == 1
+    assert not result["results"][0]["messages"].get("error")
+    assert result["results"][1]["messages"].get("error")
+
+
+def test_import_rows_rejects_unknown_columns(monkeypatch):
+    inserted = []
+
+    def validate_row(config, table_name, row, existing_row=False):
+        return {c: {"value": v, "valid": True, "messages": []} for c, v in row.items()}
+
+    def insert_new_row(config, table_name, row):
+        inserted.append(row)
+        return len(inserted)
+
+    monkeypatch.setattr(bulk, "validate_row", validate_row)
+    monkeypatch.setattr(bulk, "insert_new_row", insert_new_row)
+    rows = [{"id": "1"}, {"id": "2", "c": "x"}]
+    result = bulk.import_rows({"db": get_db()}, "sample", rows)
+    assert result["inserted"] == 1
+    assert result["errors"] == 1
+    assert result["results"][1] == {
+        "row": 2,
+        "row_number": None,
+        "messages": {"error": ["Unknown column(s): c"]},
+    }
+
+
+@pytest.mark.parametrize("text", ["id\ta\n1\tx\n2\n", "id\ta\n1\tx\n2\ty\tz\n"])
+def test_parse_rows_rejects_ragged_rows(text):
+    with pytest.raises(ValueError, match="Row 2 "):
+        bulk.parse_rows(text, "tsv")
+
+
+def test_parse_rows_json_values():
+    rows = bulk.parse_rows('[{"a": null, "b": 1, "c": true, "d": "x"}]', "json")
+    assert rows == [{"a": "", "b": "1", "c": "true", "d": "x"}]
@@ -0,0 +1,122 @@
+import sqlite3
+import threading
+import time
+
+from lark import Lark, Transformer
+from sqlalchemy import create_engine
+
+import nanobot.catalog as catalog
+
+from nanobot.catalog import (
+    DatabaseVersion,
+    DatatypeGraph,
+    get_table_fingerprint,
+    install_change_triggers,
+)
+from nanobot.db import SerializedConnection
+
+
+def get_conns(tmp_path):
+    path = str(tmp_path / "test.db")
+    writer = sqlite3.connect(path)
+    writer.execute("CREATE TABLE statement (subject TEXT, predicate TEXT, object TEXT)")
+    writer.executemany(
+        "INSERT INTO statement VALUES (?, 'rdfs:subClassOf', ?)",
+        [("ex:B", "ex:A"), ("ex:C", "ex:B"), ("ex:D", "ex:C")],
+    )
+    install_change_triggers(writer)
+    writer.commit()
+    return writer, create_engine("sqlite:///" + path).connect()
+
+
+def test_fingerprint_changes_on_update(tmp_path):
+    writer, conn = get_conns(tmp_path)
+    before = get_table_fingerprint(conn, "statement")
+    writer.execute("UPDATE statement SET object = 'ex:A' WHERE subject = 'ex:C'")
+    writer.commit()
+    assert get_table_fingerprint(conn, "statement") != before
+
+
+def test_fingerprint_changes_on_delete_then_insert(tmp_path):
+    writer, conn = get_conns(tmp_path)
+    before = get_table_fingerprint(conn, "statement")
+    # Same max rowid & row count afterwards
+    writer.execute("DELETE FROM statement WHERE rowid = (SELECT MAX(rowid) FROM statement)")
+    writer.execute("INSERT INTO statement VALUES ('ex:E', 'rdfs:subClassOf', 'ex:A')")
+    writer.commit()
+    after = get_table_fingerprint(conn, "statement")
+    assert after != before
+    assert after[0] == before[0] and after[1] == before[1] + 1 and after[2] == before[2] + 1
+
+
+def test_version_is_shared_by_processes(tmp_path):
+    writer, conn = get_conns(tmp_path)
+    path = str(tmp_path / "test.db")
+    # Each process has its own connection & version
+    other = create_engine("sqlite:///" + path).connect()
+    a, b = DatabaseVersion(conn, path), DatabaseVersion(other, path)
+    before = a.get()
+    assert b.get() == before
+    writer.execute("UPDATE statement SET object = 'ex:A' WHERE subject = 'ex:C'")
+    writer.commit()
+    assert a.get() != before
+    assert b.get() == a.get()
+
+
+def test_catalog_is_reloaded_once_by_concurrent_requests(tmp_path, monkeypatch):
+    writer, _ = get_conns(tmp_path)
+    conn = create_engine(
+        "sqlite:///" + str(tmp_path / "test.db"), connect_args={"check_same_thread": False}
+    ).connect()
+    loads = []
+
+    def get_sql_tables(conn):
+        loads.append(1)
+        # Give the other threads time to reach the refresh
+        time.sleep(0.05)
+        return ["statement"]
+
+    monkeypatch.setattr(catalog, "get_sql_tables", get_sql_tables)
+    monkeypatch.setattr(catalog, "get_sql_columns", lambda conn, table: ["subject"])
+    cat = catalog.SchemaCatalog(SerializedConnection(conn))
+    writer.execute("CREATE TABLE other (x TEXT)")
+    writer.commit()
+
+    threads = [threading.Thread(target=cat.refresh) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(loads) == 2
+    assert cat.columns == {"statement": ["subject"]}
+
+
+class InTransformer(Transformer):
+    # The structure of the in(...) conditions parsed with the cmi_pb_script grammar
+    def start(self, args):
+        return [{"args": args}]
+
+    def value(self, tokens):
+        return {"value": str(tokens[0])}
+
+
+def test_datatype_graph_skips_malformed_condition(caplog):
+    parser = Lark(
+        r"""start: "in(" value ("," value)* ")"
+        value: /'[^']*'/ | /[0-9]+/
+        %ignore " "
+        """,
+        parser="lalr",
+        transformer=InTransformer(),
+    )
+    conn = create_engine("sqlite://").connect()
+    conn.execute(
+        'CREATE TABLE datatype (datatype TEXT, parent TEXT, "HTML type" TEXT, condition TEXT)'
+    )
+    conn.execute(
+        "INSERT INTO datatype VALUES (?, NULL, NULL, ?), (?, NULL, NULL, ?), (?, NULL, NULL, ?)",
+        ("letter", "in('a', 'b')", "digit", "in(1, 2)", "broken", "in('a'"),
+    )
+    graph = DatatypeGraph(conn, parser=parser)
+    assert graph.values == {"letter": ["a", "b"], "digit": ["1", "2"]}
+    assert "Cannot parse condition of datatype 'broken'" in caplog.text
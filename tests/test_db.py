@@ -0,0 +1,39 @@
+import sqlite3
+import threading
+
+from sqlalchemy import create_engine
+
+from nanobot.catalog import get_data_version
+from nanobot.db import SerializedConnection
+
+
+def get_conn(tmp_path):
+    path = str(tmp_path / "test.db")
+    writer = sqlite3.connect(path)
+    writer.execute("CREATE TABLE a (x TEXT)")
+    writer.execute("INSERT INTO a VALUES ('a1')")
+    writer.commit()
+    engine = create_engine("sqlite:///" + path, connect_args={"check_same_thread": False})
+    return writer, SerializedConnection(engine.connect(), engine=engine)
+
+
+def test_reads_do_not_wait_for_shared_connection(tmp_path):
+    _, conn = get_conn(tmp_path)
+    rows = []
+    # The shared connection is busy for as long as the lock is held
+    with conn.lock:
+        t = threading.Thread(target=lambda: rows.extend(conn.execute("SELECT x FROM a")))
+        t.start()
+        t.join(timeout=10)
+        assert not t.is_alive()
+    assert [r[0] for r in rows] == ["a1"]
+
+
+def test_data_version_on_shared_connection(tmp_path):
+    writer, conn = get_conn(tmp_path)
+    before = get_data_version(conn)
+    conn.execute("SELECT x FROM a").fetchall()
+    assert get_data_version(conn) == before
+    writer.execute("INSERT INTO a VALUES ('a2')")
+    writer.commit()
+    assert get_data_version(conn) != before
@@ -0,0 +1,35 @@
+import sqlite3
+
+from sqlalchemy import create_engine
+
+from nanobot.hierarchy import ClassHierarchy
+
+
+def get_hierarchy(tmp_path, child_count):
+    path = str(tmp_path / "test.db")
+    writer = sqlite3.connect(path)
+    writer.execute(
+        "CREATE TABLE statement (subject TEXT, predicate TEXT, object TEXT, datatype TEXT)"
+    )
+    writer.executemany(
+        "INSERT INTO statement VALUES (?, 'rdfs:subClassOf', 'ex:A', '_IRI')",
+        [(f"ex:{i}",) for i in range(child_count)],
+    )
+    writer.commit()
+    return ClassHierarchy(create_engine("sqlite:///" + path).connect(), "statement")
+
+
+def test_truncated_children_load_more(tmp_path):
+    hierarchy = get_hierarchy(tmp_path, 5)
+    tree = hierarchy.get_tree("ex:A", "/statement/{curie}", max_children=3)
+    children = tree[2][2][1][2]
+    assert children[0] == "ul"
+    assert [li[1][1]["data-children"] for li in children[2:5]] == ["0", "0", "0"]
+    assert children[5] == [
+        "li",
+        [
+            "a",
+            {"href": "#", "class": "show-more", "data-parent": "ex:A", "data-offset": "3"},
+            "Show more (2 remaining)",
+        ],
+    ]
@@ -0,0 +1,42 @@
+import sqlite3
+
+import pytest
+from sqlalchemy import create_engine
+
+from nanobot.ontology import OntologyMetadata, TermPage
+
+
+def test_term_page_only_reads_page():
+    page = TermPage([{"ID": "ex:C"}, {"ID": "ex:D"}], 2, 10)
+    assert len(page) == 10
+    assert page[3] == {"ID": "ex:D"}
+    assert page[2:4] == [{"ID": "ex:C"}, {"ID": "ex:D"}]
+    assert list(page) == [{"ID": "ex:C"}, {"ID": "ex:D"}]
+    for index in [0, 4, 10]:
+        with pytest.raises(IndexError):
+            page[index]
+
+
+def test_term_order_kept_until_reload(tmp_path):
+    path = str(tmp_path / "test.db")
+    writer = sqlite3.connect(path)
+    writer.execute(
+        "CREATE TABLE statement (subject TEXT, predicate TEXT, object TEXT, datatype TEXT)"
+    )
+    writer.executemany(
+        "INSERT INTO statement VALUES (?, 'rdfs:label', ?, 'xsd:string')",
+        [("ex:A", "cherry"), ("ex:B", "apple"), ("ex:C", "banana")],
+    )
+    writer.commit()
+    metadata = OntologyMetadata(create_engine("sqlite:///" + path).connect(), "statement")
+    order_by = [{"key": "rdfs:label", "order": "asc", "nulls": "last"}]
+    assert metadata.get_term_page(order_by=order_by, limit=2) == ["ex:B", "ex:C"]
+
+    # Later pages use the same order
+    writer.execute("INSERT INTO statement VALUES ('ex:D', 'rdfs:label', 'apricot', 'xsd:string')")
+    writer.commit()
+    assert metadata.get_term_page(order_by=order_by, offset=2, limit=2) == ["ex:A"]
+
+    # Reloading the changed table (see OntologyMetadata.load) orders the terms again
+    metadata.ordered_terms.clear()
+    assert metadata.get_term_page(order_by=order_by, limit=2) == ["ex:B", "ex:D"]
@@ -0,0 +1,55 @@
+import sqlite3
+
+from sqlalchemy import create_engine
+
+from nanobot.catalog import install_change_triggers
+from nanobot.render_store import clear_stored_trees, get_render_store_path, RenderStore
+
+
+def get_store(tmp_path, name, edges):
+    path = str(tmp_path / f"{name}.db")
+    writer = sqlite3.connect(path)
+    writer.execute("CREATE TABLE statement (subject TEXT, predicate TEXT, object TEXT)")
+    writer.executemany("INSERT INTO statement VALUES (?, 'rdfs:subClassOf', ?)", edges)
+    install_change_triggers(writer)
+    writer.commit()
+    conn = create_engine("sqlite:///" + path).connect()
+    return RenderStore(get_render_store_path(path), conn, lambda table, ids: {})
+
+
+def test_tree_stamp_is_content_hash(tmp_path):
+    # Both tables have the same change counters, but different statements
+    a = get_store(tmp_path, "a", [("ex:B", "ex:A"), ("ex:C", "ex:B")])
+    b = get_store(tmp_path, "b", [("ex:B", "ex:A"), ("ex:C", "ex:A")])
+    assert a.get_table_stamp("statement") != b.get_table_stamp("statement")
+
+
+def test_tree_not_served_until_stamp_known(tmp_path):
+    store = get_store(tmp_path, "a", [("ex:B", "ex:A")])
+    # The background rebuild hashes the table
+    store.background = True
+    assert store.get_tree("statement", "", "", "") == (None, None)
+    stamp = store.get_table_stamp("statement")
+    store.put_tree("statement", "", "", "", stamp, "<ul></ul>")
+    assert store.get_tree("statement", "", "", "") == ("<ul></ul>", stamp)
+
+
+def test_tree_shared_by_processes(tmp_path):
+    store = get_store(tmp_path, "a", [("ex:B", "ex:A")])
+    html, stamp = store.get_tree("statement", "", "", "")
+    assert html is None and stamp
+    store.put_tree("statement", "", "", "", stamp, "<ul></ul>")
+
+    # Another process (or a restart) with a background rebuild gets the stored stamp & tree
+    conn = create_engine("sqlite:///" + str(tmp_path / "a.db")).connect()
+    other = RenderStore(store.path, conn, lambda table, ids: {})
+    other.background = True
+    assert other.get_tree("statement", "", "", "") == ("<ul></ul>", stamp)
+
+
+def test_clear_stored_trees(tmp_path):
+    store = get_store(tmp_path, "a", [("ex:B", "ex:A")])
+    stamp = store.get_table_stamp("statement")
+    store.put_tree("statement", "", "", "", stamp, "<ul></ul>")
+    clear_stored_trees(store.path)
+    assert store.get_tree("statement", "", "", "") == (None, stamp)
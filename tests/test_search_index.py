@@ -0,0 +1,45 @@
+import sqlite3
+import threading
+
+from sqlalchemy import create_engine
+
+from nanobot.catalog import install_change_triggers
+from nanobot.db import SerializedConnection
+from nanobot.search_index import SearchIndex
+
+
+def get_index(tmp_path):
+    path = str(tmp_path / "test.db")
+    writer = sqlite3.connect(path)
+    writer.execute(
+        "CREATE TABLE statement (subject TEXT, predicate TEXT, object TEXT, datatype TEXT)"
+    )
+    writer.execute("INSERT INTO statement VALUES ('ex:A', 'rdfs:label', 'apple', 'xsd:string')")
+    install_change_triggers(writer)
+    writer.commit()
+    engine = create_engine("sqlite:///" + path, connect_args={"check_same_thread": False})
+    return writer, SearchIndex(SerializedConnection(engine.connect()), "statement")
+
+
+def test_search_serves_old_index_while_rebuilding(tmp_path):
+    writer, index = get_index(tmp_path)
+    assert [r["id"] for r in index.search("apple")] == ["ex:A"]
+
+    # Hold the rebuild until the old index was searched
+    searched = threading.Event()
+    build = index.build
+
+    def wait_and_build():
+        searched.wait(timeout=10)
+        build()
+
+    index.build = wait_and_build
+    writer.execute("INSERT INTO statement VALUES ('ex:B', 'rdfs:label', 'apricot', 'xsd:string')")
+    writer.commit()
+    # The first search after the change starts a rebuild & is answered from the old index
+    assert index.search("apricot") == []
+    builder = index.builder
+    searched.set()
+    builder.join(timeout=10)
+    assert [r["id"] for r in index.search("apricot")] == ["ex:B"]
+    assert index.builder is None
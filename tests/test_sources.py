@@ -0,0 +1,63 @@
+import pickle
+import sqlite3
+
+import pytest
+
+from nanobot.sources import (
+    get_referenced_tables,
+    get_source_fingerprints,
+    load_config_state,
+    save_config_state,
+)
+
+FINGERPRINTS = {
+    "table": {"path": "table.tsv", "type": "table", "mtime": 1.0, "size": 10, "sha256": "abc"}
+}
+
+
+def test_config_state_round_trip():
+    conn = sqlite3.connect(":memory:")
+    config = {"table": {"sample": {"path": "sample.tsv"}}, "db": conn, "parser": object()}
+    save_config_state(conn, FINGERPRINTS, config)
+    assert load_config_state(conn) == (FINGERPRINTS, {"table": {"sample": {"path": "sample.tsv"}}})
+
+
+def test_config_state_is_not_unpickled(caplog):
+    conn = sqlite3.connect(":memory:")
+    save_config_state(conn, FINGERPRINTS, {})
+    with conn:
+        conn.execute("UPDATE nanobot_config SET config = ?", (pickle.dumps({"table": {}}),))
+    assert load_config_state(conn) == (FINGERPRINTS, None)
+    assert "cannot be loaded" in caplog.text
+
+
+def test_config_state_without_json_config():
+    conn = sqlite3.connect(":memory:")
+    save_config_state(conn, FINGERPRINTS, {"rule": ("a", "b")})
+    assert load_config_state(conn) == (FINGERPRINTS, None)
+
+
+def test_missing_source_file(tmp_path):
+    with open(tmp_path / "table.tsv", "w") as f:
+        f.write("table\tpath\ttype\n")
+        f.write(f"table\t{tmp_path}/table.tsv\ttable\n")
+        f.write(f"sample\t{tmp_path}/sample.tsv\t\n")
+    with pytest.raises(FileNotFoundError, match="table 'sample'"):
+        get_source_fingerprints(str(tmp_path / "table.tsv"), {})
+
+
+def test_referenced_tables():
+    conn = sqlite3.connect(":memory:")
+    conn.execute('CREATE TABLE "column" ("table" TEXT, "column" TEXT, "structure" TEXT)')
+    conn.executemany(
+        'INSERT INTO "column" VALUES (?, ?, ?)',
+        [
+            ("column", "table", "from(table.table)"),
+            ("sample", "id", "primary"),
+            ("sample", "parent", "from(sample.id)"),
+            ("result", "sample", "from(sample.id)"),
+            ("result", "value", None),
+        ],
+    )
+    assert get_referenced_tables(conn) == {"table", "sample"}
+    assert get_referenced_tables(sqlite3.connect(":memory:")) == set()
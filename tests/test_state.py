@@ -0,0 +1,81 @@
+import json
+import sqlite3
+import threading
+
+from flask import Flask
+from sqlalchemy import create_engine
+
+from nanobot.run import CONFIG, CONN, get_app_token, get_form_row_id
+from nanobot.state import AppState, release_request_handles
+
+
+def get_app(tmp_path, barrier):
+    path = str(tmp_path / "test.db")
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE a (x TEXT)")
+    db.execute("CREATE TABLE b (x TEXT)")
+    db.executemany("INSERT INTO a VALUES (?)", [("a1",), ("a2",)])
+    db.execute("INSERT INTO b VALUES ('b1')")
+    db.commit()
+    db.close()
+
+    state = AppState()
+    state.config = {"table": {"a": {}, "b": {}}}
+    state.engine = create_engine("sqlite:///" + path)
+    app = Flask(__name__)
+    app.extensions["nanobot"] = state
+    app.teardown_appcontext(release_request_handles)
+
+    @app.route("/<table_name>")
+    def view(table_name):
+        conn = CONN._get_current_object()
+        db = CONFIG["db"]
+        form_row_ids = [get_form_row_id()]
+        # Both requests hold their handles at the same time from here on
+        barrier.wait(timeout=10)
+        rows = CONN.execute(f'SELECT x FROM "{table_name}"').fetchall()
+        rows += db.cursor().execute(f'SELECT x FROM "{table_name}"').fetchall()
+        form_row_ids.append(get_form_row_id())
+        barrier.wait(timeout=10)
+        return json.dumps(
+            {
+                "conn": id(conn),
+                "db": id(db),
+                "same": CONN._get_current_object() is conn and CONFIG["db"] is db,
+                "rows": [r[0] for r in rows],
+                "form_row_ids": form_row_ids,
+            }
+        )
+
+    return app
+
+
+def test_concurrent_requests_use_own_handles(tmp_path):
+    barrier = threading.Barrier(2)
+    app = get_app(tmp_path, barrier)
+    results = {}
+
+    def get(table_name):
+        with app.test_client() as client:
+            results[table_name] = json.loads(client.get("/" + table_name).data)
+
+    threads = [threading.Thread(target=get, args=(t,)) for t in ["a", "b"]]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=30)
+
+    a, b = results["a"], results["b"]
+    assert a["conn"] != b["conn"]
+    assert a["db"] != b["db"]
+    assert a["same"] and b["same"]
+    assert a["rows"] == ["a1", "a2", "a1", "a2"]
+    assert b["rows"] == ["b1", "b1"]
+    assert a["form_row_ids"] == [0, 1]
+    assert b["form_row_ids"] == [0, 1]
+
+
+def test_app_token_changes_with_options():
+    token = get_app_token({"title": "Terminology", "max_children": 20})
+    assert token == get_app_token({"max_children": 20, "title": "Terminology"})
+    assert token != get_app_token({"title": "Terminology", "max_children": 50})